@@ -31,13 +31,13 @@ import time
 # Button class from https://github.com/Mekire/pg-button
 from button import Button
 
-import numpy as np
 import librosa
 import shutil
 import json
 
-from d3audiorecon.renderer.classes import Microphone, SoundSource, Scene, \
+from d3audiorecon.renderer.classes import SoundSource, Scene, \
     INPUT_OUTPUT_TARGET_SAMPLE_RATE
+from d3audiorecon.renderer.mic_array import MicArray
 
 from d3audiorecon.tools.utils import read_file, log_mel_spec_tfm, \
     save_spectrogram, save_mask, log_cqt
@@ -55,6 +55,11 @@ PIXELS_PER_METER = DISPLAY_HEIGHT // ROOM_SIZE
 # Size of bin in degrees
 BIN_SIZE = 30
 
+# 8 mics on a 0.3m circle at the room center, with delays and gains precomputed over the room
+NUM_MICS = 8
+MIC_ARRAY = MicArray.circular(NUM_MICS)
+MIC_LOOKUP = MIC_ARRAY.lookup_grid(ROOM_SIZE / 2, INPUT_OUTPUT_TARGET_SAMPLE_RATE)
+
 # Color defnititions
 BLACK = (0,0,0)
 WHITE = (255,255,255)
@@ -327,19 +332,11 @@ def render():
     bin_in = None
     global rendered
     rendered = False
-    NUM_MICS = 8
     RENDER_TIME = 6.0
     all_sources = []
-    mic_array = []
+    mic_array = MIC_ARRAY.microphones()
     metadata = {}
 
-    radius = 0.3  # Mic array has radius 0.3m
-    for i in range(NUM_MICS):
-        position_x = radius * np.cos(2 * np.pi / 8 * i)
-        position_y = radius * np.sin(2 * np.pi / 8 * i)
-        position_z = 0  # Assume planar for now
-        mic_array.append(Microphone([position_x, position_y, position_z]))
-
     # generate the sound sources
     for i in range(0, len(source_list)):
         print(source_list[i].position[0])
@@ -355,7 +352,7 @@ def render():
         }
 
     scene = Scene(all_sources, mic_array)
-    scene.render(cutoff_time=RENDER_TIME, volume_boost=4.0)
+    result = scene.render(cutoff_time=RENDER_TIME, volume_boost=4.0, lookup=MIC_LOOKUP)
 
 
     output_data_dir = os.path.dirname(os.path.abspath(__file__))
@@ -367,10 +364,7 @@ def render():
     os.makedirs(output_data_dir)
 
     # Write every mic buffer to outputs
-    for i, mic in enumerate(mic_array):
-        output_prefix = os.path.join(output_data_dir, "mic{:02d}_".format(i))
-        mic.save(output_prefix)
-        mic.reset()
+    result.write_wavs(output_data_dir)
 
     metadata_file = os.path.join(output_data_dir, "metadata.json")
     with open(metadata_file, "w") as f:
@@ -386,7 +380,7 @@ def render():
     specgram_image = pg.transform.scale(specgram_image, SPECGRAM_SIZE)
 
     processes = []
-    for i in range(8):
+    for i in range(NUM_MICS):
         p = subprocess.Popen(["scp", "output/mic{:02d}_mixed.wav".format(i), "vjayaram@lungo.cs.washington.edu:/projects/grail/vjayaram/d3audiorecon/gui/output/"])
         processes.append(p)
 
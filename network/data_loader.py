@@ -3,13 +3,27 @@ import json
 import os
 import sys
 import math
+import time
 
 import numpy as np
 import torch
 import librosa
 
 from d3audiorecon.tools.utils import read_file, log_mel_spec_tfm, \
-    save_spectrogram, save_mask, log_cqt
+    save_spectrogram, save_mask, multi_file_log_cqt, read_multi_file, \
+    resample, voice_mask, FEATURE_SAMPLE_RATE
+from d3audiorecon.renderer.audio_cache import AudioCache
+from d3audiorecon.renderer.shards import ShardReader, is_sharded
+from d3audiorecon.renderer.features import has_features, \
+    multi_mic_log_cqt, scene_features, MIXED_CQT_FILENAME, VOICE_MASK_FILENAME
+from d3audiorecon.renderer.feature_store import FeatureStore, \
+    scene_log_cqt, scene_voice_mask
+from d3audiorecon.renderer.partition import has_dataset_index, \
+    load_dataset_index
+from d3audiorecon.renderer.metadata_index import MetadataIndex, \
+    has_metadata_index
+from d3audiorecon.renderer.main import build_arg_parser, verify_args, \
+    open_scene_inputs, synthesize_scene
 
 NUM_BINS = 12  # Directional binning
 NUM_BGS = 3  # Number of background files
@@ -19,99 +33,366 @@ TASK_SEPARATION = 1
 
 
 class SpatialAudioDataset(torch.utils.data.Dataset):
-    def __init__(self, data_dir, task=0):
+    def __init__(self, data_dir, task=0, feature_store: FeatureStore = None,
+                 waveforms=False, read_cache: AudioCache = None):
+        """
+        With waveforms, inputs are NUM_MICS x samples audio at
+        FEATURE_SAMPLE_RATE for a network/frontend.py module to turn into
+        features on the model's device, instead of log_cqt spectrograms.
+        Separation masks are still computed here.
+
+        read_cache keeps WAV scenes resampled to FEATURE_SAMPLE_RATE, see
+        read_file. read_multi_file stacks its read only entries into new
+        arrays, so returned samples stay writable.
+        """
         super(SpatialAudioDataset, self).__init__()
 
-        # Data is stored in subdirectories. Get all of them
-        self.dirs = sorted(glob.glob(os.path.join(data_dir, '*')))
+        # Data is stored in subdirectories, either as audio or as features
+        # precomputed by the renderer, or in shards written by the renderer.
+        # A merged multi-node render lists its scenes in a dataset index.
+        if has_dataset_index(data_dir):
+            output_format, part_dirs, scenes = load_dataset_index(data_dir)
+            self.dirs = [os.path.join(curr_dir, "{:05d}".format(idx))
+                         for idx, curr_dir in scenes]
+            shard_dirs = part_dirs if output_format == "shards" else []
+        else:
+            self.dirs = sorted(x for x in glob.glob(os.path.join(data_dir, '*'))
+                               if os.path.isdir(x))
+            shard_dirs = [data_dir] if is_sharded(data_dir) else []
+        self.use_features = len(self.dirs) > 0 and \
+            all(has_features(x) for x in self.dirs)
+        self.shards = ShardReader(shard_dirs) \
+            if not self.use_features and shard_dirs else None
+        if waveforms and self.use_features:
+            raise ValueError("{} holds only precomputed features, no waveforms".format(data_dir))
         self.cache = {}
         self.task = task
+        self.waveforms = waveforms
+        # Features of WAV scenes are looked up by content in the store
+        self.feature_store = feature_store
+        self.read_cache = read_cache
+
+        # With a metadata index, direction labels of every sample are
+        # computed here at once instead of from each sample's metadata
+        self.metadata_index = None
+        self.labels = None
+        if has_metadata_index(data_dir):
+            if self.shards is not None:
+                self.scene_idxs = self.shards.scene_idxs
+            else:
+                self.scene_idxs = [int(os.path.basename(x)) for x in self.dirs
+                                   if os.path.basename(x).isdigit()]
+            metadata_index = MetadataIndex(data_dir)
+            try:
+                if len(self.scene_idxs) == len(self):
+                    self.labels = metadata_index.direction_bins(NUM_BINS, self.scene_idxs)
+                    self.metadata_index = metadata_index
+            except KeyError:
+                pass  # Stale index, read every sample's metadata instead
 
     def __len__(self):
+        if self.shards is not None:
+            return len(self.shards)
         return len(self.dirs)
 
     def __getitem__(self, idx):
-        curr_dir = self.dirs[idx]
+        if self.waveforms:
+            mixed_data = self.mixed_audio(idx)  # NUM_MICS x Samples
+        else:
+            mixed_data = self.mixed_specgrams(idx)  # NUM_MICS x Freq_bins x Time_bins
+
+        if self.task == TASK_DIRECTION:
+            if self.labels is not None:
+                return (torch.tensor(mixed_data).float(),
+                        torch.tensor(int(self.labels[idx])))
+            return self.direction_labels(mixed_data, self.metadata(idx))
+
+        elif self.task == TASK_SEPARATION:
+            if self.waveforms:
+                return waveform_unet_labels(mixed_data, self.voice_mask(idx))
+            return self.unet_voice_labels(mixed_data, idx)
+
+    def metadata(self, idx):
+        """
+        Source positions and filenames of one sample
+        """
+        if self.metadata_index is not None:
+            return self.metadata_index.metadata(self.scene_idxs[idx])
+        if self.shards is not None:
+            return self.shards[idx][2]["metadata"]
+        with open(os.path.join(self.dirs[idx], "metadata.json")) as f:
+            return json.load(f)
+
+    def mixed_specgrams(self, idx):
+        """
+        NUM_MICS x Freq_bins x Time_bins log_cqt of the mixed audio
+        """
+        if self.use_features:
+            return np.load(os.path.join(self.dirs[idx], MIXED_CQT_FILENAME))
+
+        if self.shards is not None:
+            mixed, _, entry = self.shards[idx]
+            return multi_mic_log_cqt(mixed, entry["sample_rate"])
+
+        if self.feature_store is not None:
+            return scene_log_cqt(self.feature_store, self.dirs[idx])
 
         # Get all WAV files in subdirectory
         mixed_audio_files = sorted(
-            glob.glob(os.path.join(curr_dir, "*_mixed.wav")))
+            glob.glob(os.path.join(self.dirs[idx], "*_mixed.wav")))
 
-        # Load mixed data
-        mixed_specgrams = []
-        for i, mixed_audio_file in enumerate(mixed_audio_files):
-            specgram = log_cqt(mixed_audio_file, sample_rate=22500)
-            mixed_specgrams.append(torch.from_numpy(specgram))
-            #save_spectrogram(specgram, "../data/cqtspectrogram{:02}.png".format(i))
-        mixed_data = np.stack(
-            mixed_specgrams)  # NUM_MICS x Freq_bins x Time_bins
+        return multi_file_log_cqt(mixed_audio_files, sample_rate=FEATURE_SAMPLE_RATE,
+                                  cache=self.read_cache)
 
-        if self.task == TASK_DIRECTION:
-            return self.direction_labels(mixed_data, curr_dir)
+    def mixed_audio(self, idx):
+        """
+        NUM_MICS x Samples mixed audio at FEATURE_SAMPLE_RATE
+        """
+        if self.shards is not None:
+            mixed, _, entry = self.shards[idx]
+            return resample(np.asarray(mixed, dtype=np.float32),
+                            entry["sample_rate"], FEATURE_SAMPLE_RATE)[0]
 
-        elif self.task == TASK_SEPARATION:
-            return self.unet_voice_labels(mixed_data, curr_dir)
+        mixed_audio_files = sorted(
+            glob.glob(os.path.join(self.dirs[idx], "*_mixed.wav")))
+        return read_multi_file(mixed_audio_files, sample_rate=FEATURE_SAMPLE_RATE,
+                               cache=self.read_cache)[0]
 
-    def direction_labels(self, mixed_data, curr_dir):
+    def source_specgrams(self, idx, source_idx):
+        """
+        NUM_MICS x Freq_bins x Time_bins log_cqt of one ground truth source
+        """
+        if self.shards is not None:
+            _, sources_gt, entry = self.shards[idx]
+            return multi_mic_log_cqt(sources_gt[:, source_idx], entry["sample_rate"])
+
+        gt_audio_files = sorted(
+            glob.glob(
+                os.path.join(self.dirs[idx],
+                             "*_source{:02d}_gt.wav".format(source_idx))))
+        return multi_file_log_cqt(gt_audio_files, sample_rate=FEATURE_SAMPLE_RATE,
+                                  cache=self.read_cache)
+
+    def direction_labels(self, mixed_data, metadata):
         """
         Returns input mixed spectrogram and directional label
         """
-        # Now load labels
-        with open(os.path.join(curr_dir, "metadata.json")) as f:
-            metadata = json.load(f)
+        return direction_labels(mixed_data, metadata)
+
+    def voice_mask(self, idx):
+        """
+        NUM_MICS x Freq_bins x Time_bins mask where the voice is louder
+        than every background
+        """
+        if self.use_features:
+            return np.load(os.path.join(self.dirs[idx], VOICE_MASK_FILENAME))
+        if self.feature_store is not None and self.shards is None:
+            return scene_voice_mask(self.feature_store, self.dirs[idx], NUM_BGS)
 
-        # Get the direction in radians from -pi to pi
-        position = metadata["source00"]["position"]  # x,y,z
-        angular_direction = np.arctan2(position[1], position[0])
-        label = int(
-            math.floor((angular_direction + np.pi) * NUM_BINS / (2 * np.pi)))
-        return (torch.tensor(mixed_data).float(), torch.tensor(label))
+        # Ground truth voice and background specs
+        gt_data = self.source_specgrams(idx, 0)
+        bg_specgrams = (self.source_specgrams(idx, bg_source_idx)
+                        for bg_source_idx in range(1, NUM_BGS + 1))
+        return voice_mask(gt_data, bg_specgrams)
 
-    def unet_voice_labels(self, mixed_data, curr_dir):
+    def unet_voice_labels(self, mixed_data, idx):
         """
         Returns input mixed spectrogram and binary mask for voice class
         """
-        # Ground truth voice files
-        gt_audio_files = sorted(
-            glob.glob(os.path.join(curr_dir, "*_source00_gt.wav")))
-        gt_specgrams = []
-        for gt_audio_file in gt_audio_files:
-            specgram = log_cqt(gt_audio_file, sample_rate=22500)
-            gt_specgrams.append(torch.from_numpy(specgram))
-
-        gt_data = torch.stack(gt_specgrams)  # NUM_MICS x Freq_bins x Time_bins
-
-        # Background ground truth specs
-        bg_max = np.ones_like(
-            gt_data.numpy()) * np.NINF  # NUM_MICS x Freq x Time
-        for bg_source_idx in range(1, NUM_BGS + 1):
-            gt_bg_files = sorted(
-                glob.glob(
-                    os.path.join(
-                        curr_dir,
-                        "*_source{:02d}_gt.wav".format(bg_source_idx))))
-            curr_bg_stack = np.zeros_like(bg_max)
-            for bg_mic_idx, gt_bg_file in enumerate(gt_bg_files):
-                curr_bg_stack[bg_mic_idx, :, :] = log_cqt(gt_bg_file,
-                                                          sample_rate=22500)
-            bg_max = np.maximum(bg_max, curr_bg_stack)
-
-        mask = gt_data.numpy() > bg_max
-
-        # UNet requires all dims to be divisible by 32
-        time_dim = mask.shape[2]
-        time_dim_padded = math.ceil(time_dim / DIM_DIVISOR) * DIM_DIVISOR
-
-        # Padded inputs
-        input_padded = np.zeros(
-            (mixed_data.shape[0], mixed_data.shape[1], time_dim_padded))
-        input_padded[:mixed_data.shape[0], :mixed_data.shape[1], :mixed_data.
-                     shape[2]] = mixed_data
-
-        # Padded labels
-        mask_padded = np.zeros((mask.shape[0], mask.shape[1], time_dim_padded))
-        mask_padded[:mask.shape[0], :mask.shape[1], :mask.shape[2]] = mask
-        save_mask(mask_padded, "../data/")
-
-        return (torch.tensor(input_padded).float(),
-                torch.tensor(mask_padded).float())
+        input_padded, mask_padded = unet_labels(mixed_data, self.voice_mask(idx))
+        save_mask(mask_padded.numpy(), "../data/")
+        return input_padded, mask_padded
+
+
+def collate_with_lookups(samples):
+    """
+    DataLoader collate_fn returning the default batch and the feature
+    store hits and misses its worker took since its previous batch
+    """
+    info = torch.utils.data.get_worker_info()
+    feature_store = getattr(info.dataset, "feature_store", None) \
+        if info is not None else None
+    lookups = feature_store.take_lookups() if feature_store is not None else (0, 0)
+    return torch.utils.data.dataloader.default_collate(samples), lookups
+
+
+def reset_lookups(worker_id):
+    """
+    DataLoader worker_init_fn for collate_with_lookups, so a forked
+    worker does not report the lookups its parent counted
+    """
+    feature_store = getattr(torch.utils.data.get_worker_info().dataset,
+                            "feature_store", None)
+    if feature_store is not None:
+        feature_store.take_lookups()
+
+
+class LookupCountingLoader(object):
+    def __init__(self, loader, feature_store: FeatureStore):
+        """
+        Iterates over the batches of a DataLoader built with
+        collate_fn=collate_with_lookups and worker_init_fn=reset_lookups,
+        adding the lookups of its workers
+        to feature_store. Without workers the dataset counts in
+        feature_store itself.
+        """
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.feature_store = feature_store
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for batch, (hits, misses) in self.loader:
+            self.feature_store.add_lookups(hits, misses)
+            yield batch
+
+
+class SyntheticSceneDataset(torch.utils.data.IterableDataset):
+    def __init__(self, voices_dir, bg_sounds_dir=None, task=0,
+                 scenes_per_epoch=1000, seed=0, render_args=(),
+                 waveforms=False):
+        """
+        Renders every scene and its features inside the DataLoader workers
+        instead of reading a rendered dataset, typically from one packed
+        corpus holding both voices and backgrounds.
+
+        Epoch e yields scenes e * scenes_per_epoch onwards, so every epoch
+        is new, and each scene is seeded from its index like
+        renderer/main.py, whichever worker renders it. Call set_epoch
+        before iterating. render_args are extra renderer/main.py flags,
+        e.g. ["--num-mics", "4"]. waveforms is as in SpatialAudioDataset.
+        """
+        super(SyntheticSceneDataset, self).__init__()
+        bg_sounds_dir = voices_dir if bg_sounds_dir is None else bg_sounds_dir
+        self.args = build_arg_parser().parse_args(
+            [voices_dir, bg_sounds_dir, "", "--seed", str(seed)] + list(render_args))
+        verify_args(self.args)
+        self.task = task
+        self.waveforms = waveforms
+        self.scenes_per_epoch = scenes_per_epoch
+        self.epoch = 0
+        self.inputs = None  # Opened in each worker
+
+    def __len__(self):
+        return self.scenes_per_epoch
+
+    def __getstate__(self):
+        # Corpora are memory mapped, reopen them in each worker
+        state = self.__dict__.copy()
+        state["inputs"] = None
+        return state
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def scene_idxs(self):
+        """
+        This worker's share of the epoch's scene indices
+        """
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else \
+            (worker_info.id, worker_info.num_workers)
+        first = self.epoch * self.scenes_per_epoch
+        return range(first + worker_id, first + self.scenes_per_epoch, num_workers)
+
+    def scene(self, scene_idx: int):
+        """
+        Renders one scene, returns it with its metadata
+        """
+        if self.inputs is None:
+            self.inputs = open_scene_inputs(self.args)
+        return synthesize_scene(self.args, scene_idx, **self.inputs)
+
+    def __iter__(self):
+        for scene_idx in self.scene_idxs():
+            scene, metadata = self.scene(scene_idx)
+            if self.waveforms:
+                mixed_audio = resample(scene.mix, scene.sample_rate,
+                                       FEATURE_SAMPLE_RATE)[0]
+                if self.task == TASK_DIRECTION:
+                    yield direction_labels(mixed_audio, metadata)
+                elif self.task == TASK_SEPARATION:
+                    _, mask = scene_features(scene.mix, scene.sources_gt,
+                                             scene.sample_rate)
+                    yield waveform_unet_labels(mixed_audio, mask)
+            elif self.task == TASK_DIRECTION:
+                mixed_data = multi_mic_log_cqt(scene.mix, scene.sample_rate)
+                yield direction_labels(mixed_data, metadata)
+            elif self.task == TASK_SEPARATION:
+                mixed_data, mask = scene_features(scene.mix, scene.sources_gt,
+                                                  scene.sample_rate)
+                yield unet_labels(mixed_data, mask)
+
+    def measure_throughput(self, num_scenes: int = 4):
+        """
+        Scenes/sec one worker renders and featurizes, from scenes past
+        the ones any epoch will use
+        """
+        start_idx = np.iinfo(np.int32).max - num_scenes
+        self.scene(start_idx)  # Warm up caches and corpora
+        start = time.time()
+        for scene_idx in range(start_idx, start_idx + num_scenes):
+            scene, _ = self.scene(scene_idx)
+            scene_features(scene.mix, scene.sources_gt, scene.sample_rate)
+        return num_scenes / (time.time() - start)
+
+
+def workers_for_throughput(scenes_per_sec: float, target_scenes_per_sec: float,
+                           max_workers: int):
+    """
+    DataLoader workers needed for on-the-fly scenes to keep up with
+    training at target_scenes_per_sec, and whether max_workers suffice
+    """
+    num_workers = int(math.ceil(target_scenes_per_sec / scenes_per_sec))
+    return min(max(num_workers, 1), max_workers), num_workers <= max_workers
+
+
+def direction_labels(mixed_data, metadata):
+    """
+    Returns input mixed spectrogram and directional label
+    """
+    # Get the direction in radians from -pi to pi
+    position = metadata["source00"]["position"]  # x,y,z
+    angular_direction = np.arctan2(position[1], position[0])
+    label = int(
+        math.floor((angular_direction + np.pi) * NUM_BINS / (2 * np.pi)))
+    return (torch.tensor(mixed_data).float(), torch.tensor(label))
+
+
+def unet_labels(mixed_data, mask):
+    """
+    Returns input mixed spectrogram and binary voice mask, zero padded
+    """
+    # UNet requires all dims to be divisible by 32
+    time_dim = mask.shape[2]
+    time_dim_padded = math.ceil(time_dim / DIM_DIVISOR) * DIM_DIVISOR
+
+    # Padded inputs
+    input_padded = np.zeros(
+        (mixed_data.shape[0], mixed_data.shape[1], time_dim_padded))
+    input_padded[:mixed_data.shape[0], :mixed_data.shape[1], :mixed_data.
+                 shape[2]] = mixed_data
+
+    # Padded labels
+    mask_padded = np.zeros((mask.shape[0], mask.shape[1], time_dim_padded))
+    mask_padded[:mask.shape[0], :mask.shape[1], :mask.shape[2]] = mask
+
+    return (torch.tensor(input_padded).float(),
+            torch.tensor(mask_padded).float())
+
+
+def waveform_unet_labels(mixed_audio, mask):
+    """
+    Returns input mixed audio and binary voice mask, the mask zero padded
+    like unet_labels. The front end's spectrogram is padded to the mask
+    in the training loop.
+    """
+    time_dim = mask.shape[2]
+    time_dim_padded = math.ceil(time_dim / DIM_DIVISOR) * DIM_DIVISOR
+    mask_padded = np.zeros((mask.shape[0], mask.shape[1], time_dim_padded))
+    mask_padded[:, :, :time_dim] = mask
+
+    return (torch.tensor(mixed_audio).float(),
+            torch.tensor(mask_padded).float())
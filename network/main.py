@@ -7,14 +7,33 @@ import torch
 import torch.optim as optim
 
 from d3audiorecon.network.data_loader import SpatialAudioDataset, \
-    NUM_BINS
+    SyntheticSceneDataset, LookupCountingLoader, collate_with_lookups, \
+    reset_lookups, workers_for_throughput, NUM_BINS
+from d3audiorecon.renderer.audio_cache import AudioCache, DEFAULT_CACHE_BYTES
+from d3audiorecon.renderer.corpus import is_packed_corpus
+from d3audiorecon.renderer.feature_store import FeatureStore
 from d3audiorecon.network.train_test import train, test, \
     test_unet
+from d3audiorecon.network.frontend import LogCQT
 from d3audiorecon.network.resnet import resnet18, resnet50
 from d3audiorecon.network.simplenet import SimpleNet
 from d3audiorecon.network.UNet import unet
 
 
+def open_dataset(path, task, seed, scenes_per_epoch, feature_store=None,
+                 waveforms=False, read_cache=None):
+    """
+    A packed source corpus is rendered on the fly, anything else is a
+    rendered dataset directory
+    """
+    if is_packed_corpus(path):
+        return SyntheticSceneDataset(path, task=task, seed=seed,
+                                     scenes_per_epoch=scenes_per_epoch,
+                                     waveforms=waveforms)
+    return SpatialAudioDataset(path, task=task, feature_store=feature_store,
+                               waveforms=waveforms, read_cache=read_cache)
+
+
 def main(args):
     """
     Factor out common code to be used by all data corpuses.
@@ -28,24 +47,54 @@ def main(args):
     PRINT_INTERVAL = 100
     LOG_PATH = "../data/logs/log.pkl"
 
-    data_train = SpatialAudioDataset(args.data_train_path, task=args.task)
-    data_test = SpatialAudioDataset(args.data_test_path, task=args.task)
+    # Synthetic test scenes use another seed and always epoch 0, so they
+    # stay fixed and never overlap the training scenes
+    feature_store = FeatureStore(args.feature_store) \
+        if args.feature_store is not None else None
+    read_cache = AudioCache(args.read_cache, args.read_cache_bytes) \
+        if args.read_cache is not None else None
+    data_train = open_dataset(args.data_train_path, args.task, 0, args.scenes_per_epoch,
+                              feature_store, args.waveforms, read_cache)
+    data_test = open_dataset(args.data_test_path, args.task, 1, args.scenes_per_epoch,
+                             feature_store, args.waveforms, read_cache)
 
     use_cuda = USE_CUDA and torch.cuda.is_available()
 
     device = torch.device("cuda" if use_cuda else "cpu")
     print('Using device', device)
+    # Loaders return waveforms and the log-CQT is computed batched on the device
+    frontend = LogCQT().to(device) if args.waveforms else None
 
     num_workers = multiprocessing.cpu_count()
+    synthetic = isinstance(data_train, SyntheticSceneDataset)
+    if synthetic and args.target_scenes_per_sec is not None:
+        # Only start as many render workers as training can consume
+        scenes_per_sec = data_train.measure_throughput()
+        num_workers, keeps_up = workers_for_throughput(
+            scenes_per_sec, args.target_scenes_per_sec, num_workers)
+        print('{:.2f} scenes/sec per worker'.format(scenes_per_sec))
+        if not keeps_up:
+            print('Warning: {} workers cannot render {} scenes/sec, training will wait on data'.format(
+                num_workers, args.target_scenes_per_sec))
     print('num workers:', num_workers)
 
     kwargs = {'num_workers': num_workers,
               'pin_memory': True} if use_cuda else {}
+    if synthetic:
+        kwargs['num_workers'] = num_workers  # Rendering needs workers even on CPU
+    if feature_store is not None:
+        # Workers report their lookups with every batch
+        kwargs.update(collate_fn=collate_with_lookups, worker_init_fn=reset_lookups)
 
+    # Synthetic scenes are already random, and iterable datasets cannot be shuffled
     train_loader = torch.utils.data.DataLoader(data_train, batch_size=BATCH_SIZE,
-                                               shuffle=True, **kwargs)
+                                               shuffle=not synthetic, **kwargs)
     test_loader = torch.utils.data.DataLoader(data_test, batch_size=TEST_BATCH_SIZE,
-                                              shuffle=True, **kwargs)
+                                              shuffle=not isinstance(data_test, SyntheticSceneDataset),
+                                              **kwargs)
+    if feature_store is not None:
+        train_loader = LookupCountingLoader(train_loader, feature_store)
+        test_loader = LookupCountingLoader(test_loader, feature_store)
 
     # Key modifcations to resnet include changing the input and output channels
     #model = resnet50(pretrained=True, num_classes=NUM_BINS).to(device)
@@ -67,15 +116,23 @@ def main(args):
     try:
         for epoch in range(start_epoch, EPOCHS + 1):
             #lr = LEARNING_RATE * np.power(0.25, (int(epoch / 6)))
-            train_loss = train(model, device, optimizer, train_loader, None, epoch, PRINT_INTERVAL)
+            if synthetic:
+                data_train.set_epoch(epoch)  # Fresh scenes every epoch
+            train_loss = train(model, device, optimizer, train_loader, None, epoch, PRINT_INTERVAL,
+                               frontend)
             if args.task == 0:
-                test_loss = test(model, device, test_loader, PRINT_INTERVAL)
+                test_loss = test(model, device, test_loader, PRINT_INTERVAL, frontend)
             elif args.task == 1:
-                test_loss = test_unet(model, device, test_loader, PRINT_INTERVAL)
+                test_loss = test_unet(model, device, test_loader, PRINT_INTERVAL, frontend)
             train_losses.append((epoch, train_loss))
             print("Train Loss: {}".format(train_loss))
             print("Test Loss: {}".format(test_loss))
             test_losses.append((epoch, test_loss))
+            if feature_store is not None:
+                # Counted across all DataLoader workers since training started
+                stats = feature_store.stats()
+                print("Feature store: {:.1%} hit rate ({} hits, {} misses), {:.1f} MB on disk".format(
+                    stats["hit_rate"], stats["hits"], stats["misses"], stats["bytes_on_disk"] / 2**20))
             
             torch.save(model, os.path.join(args.checkpoints_dir, "{}_{}.pt".format(save_prefix, epoch)))
     except KeyboardInterrupt as ke:
@@ -100,10 +157,16 @@ def main(args):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='arguments for network/main.py')
-    parser.add_argument("data_train_path", type=str, help="Path to training samples")
-    parser.add_argument("data_test_path", type=str, help="Path to testing samples")
+    parser.add_argument("data_train_path", type=str, help="Path to training samples, or a packed corpus to render them from on the fly")
+    parser.add_argument("data_test_path", type=str, help="Path to testing samples, or a packed corpus to render them from on the fly")
     parser.add_argument("task", type=int, help="0 for position prediction, 1 for source separation")
     parser.add_argument("--checkpoints-dir", type=str, help="Path to save model")
     parser.add_argument("--model-load", type=str, help="Path to starting model weights")
     parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--scenes-per-epoch", type=int, default=1000, help="Scenes per epoch when rendering on the fly")
+    parser.add_argument("--target-scenes-per-sec", type=float, default=None, help="Rate training consumes scenes at, sizes the on the fly render workers to it")
+    parser.add_argument("--feature-store", type=str, default=None, help="Directory of a feature store to cache the CQTs and masks of WAV datasets in")
+    parser.add_argument("--read-cache", type=str, default=None, help="Directory to cache WAV scenes resampled to the feature rate in, ideally on tmpfs")
+    parser.add_argument("--read-cache-bytes", type=int, default=DEFAULT_CACHE_BYTES, help="Byte budget of the read cache")
+    parser.add_argument("--waveforms", action="store_true", help="Load raw multichannel waveforms and compute the log-CQT on the training device")
     main(parser.parse_args())
@@ -4,17 +4,33 @@ import json
 import tqdm
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 import cv2
 import numpy as np
 
 
-def train(model, device, optimizer, train_loader, lr, epoch, log_interval=20):
+def model_input(data, label, frontend=None):
+    """
+    Normalized model input of a batch. With a front end (network/frontend.py)
+    data are waveforms and their features are computed here, zero padded
+    to the width of a separation mask like unet_labels pads them.
+    """
+    if frontend is not None:
+        with torch.no_grad():
+            data = frontend(data)
+        if label.dim() == data.dim():
+            data = F.pad(data, (0, label.shape[-1] - data.shape[-1]))
+    return (data - data.mean()) / (data.std() + 1e-8)
+
+
+def train(model, device, optimizer, train_loader, lr, epoch, log_interval=20,
+          frontend=None):
     model.train()
     losses = []
     for batch_idx, (data, label) in enumerate(tqdm.tqdm(train_loader)):
         data, label = data.to(device), label.to(device)
-        data = (data - data.mean()) / (data.std() + 1e-8)
+        data = model_input(data, label, frontend)
         # Separates the hidden state across batches. 
         # Otherwise the backward would try to go all the way to the beginning every time.
         optimizer.zero_grad()
@@ -35,7 +51,7 @@ def train(model, device, optimizer, train_loader, lr, epoch, log_interval=20):
     return np.mean(losses)
 
 
-def test(model, device, test_loader, log_interval=100):
+def test(model, device, test_loader, log_interval=100, frontend=None):
     model.eval()
     test_loss = 0
     correct = 0
@@ -43,7 +59,7 @@ def test(model, device, test_loader, log_interval=100):
     with torch.no_grad():
         for batch_idx, (data, label) in enumerate(test_loader):
             data, label = data.to(device), label.to(device)
-            data = (data - data.mean()) / (data.std() + 1e-8)
+            data = model_input(data, label, frontend)
             output = model(data)
             loss = model.loss(output, label)
             test_loss += loss
@@ -63,14 +79,14 @@ def test(model, device, test_loader, log_interval=100):
 
     return test_loss
 
-def test_unet(model, device, test_loader, log_interval=20):
+def test_unet(model, device, test_loader, log_interval=20, frontend=None):
     model.eval()
     test_loss = 0
 
     with torch.no_grad():
         for batch_idx, (data, label) in enumerate(test_loader):
             data, label = data.to(device), label.to(device)
-            data = (data - data.mean()) / (data.std() + 1e-8)
+            data = model_input(data, label, frontend)
             output = model(data)
             loss = model.loss(output, label)
             test_loss += loss
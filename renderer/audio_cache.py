@@ -0,0 +1,142 @@
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+import librosa
+
+DEFAULT_CACHE_BYTES = 4 * 1024**3  # 4 GiB
+DEFAULT_CACHE_DIR = os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    "d3audiorecon_audio_cache")
+
+
+class AudioCache(object):
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR,
+                 max_bytes: int = DEFAULT_CACHE_BYTES):
+        """
+        Decoded, resampled float32 audio shared between processes.
+
+        Every entry is an .npy file in cache_dir that is memory mapped on
+        load, so all workers read the same pages. Least recently used
+        entries (by mtime, bumped on every hit) are deleted once the
+        directory exceeds max_bytes.
+
+        Args:
+            cache_dir: directory holding the entries, ideally on tmpfs
+            max_bytes: byte budget for the whole directory
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, filename: str, *params):
+        """
+        Cache file for a (path, params...) key, e.g. sample rate, offset and
+        duration. Size and mtime of the source are part of the key so edits
+        invalidate it.
+        """
+        stat = os.stat(filename)
+        key = repr((os.path.abspath(filename), stat.st_size, stat.st_mtime_ns) +
+                   params)
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def load(self, filename: str, sr: int, offset: float = 0.0, duration=None):
+        """
+        Same as librosa.core.load(mono=True) but served from the cache.
+        Returned arrays are read only.
+        """
+        audio = self.cached(filename, (sr, offset, duration), lambda: librosa.core.load(
+            filename, sr=sr, mono=True, offset=offset, duration=duration)[0])
+        return audio, sr
+
+    def cached(self, filename: str, params: tuple, decode):
+        """
+        decode() of filename as float32, served from the cache entry for
+        (filename, params) if there is one. Returned arrays are read only.
+        """
+        return self.cached_entry(self.entry_path(filename, *params),
+                                 lambda: np.asarray(decode()).astype(np.float32, copy=False))
+
+    def cached_entry(self, path: str, compute):
+        """
+        The array in cache file path, or compute() stored there if it is
+        missing, counted as a hit or a miss
+        """
+        entry, hit = self._load_or_store(path, compute)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._evict()
+        return entry
+
+    def _load_or_store(self, path: str, compute):
+        """
+        Returns the entry and whether it was already stored
+        """
+        try:
+            entry = np.load(path, mmap_mode="r")
+            os.utime(path)  # Mark as recently used
+            return entry, True
+        except (FileNotFoundError, ValueError):
+            pass
+
+        entry = compute()
+        if entry.nbytes <= self.max_bytes:
+            self._store(path, entry)
+        return entry, False
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+    def _store(self, path: str, audio):
+        """
+        Write atomically so readers never see a partial entry
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, audio)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        """
+        Delete least recently used entries until under max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:  # Evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+
+def load_audio(filename: str, sr: int, offset: float = 0.0, duration=None,
+               cache: AudioCache = None):
+    """
+    Load mono audio at sr, through the cache if one is given
+    """
+    if cache is not None:
+        return cache.load(filename, sr, offset=offset, duration=duration)
+    return librosa.core.load(filename, sr=sr, mono=True, offset=offset,
+                             duration=duration)
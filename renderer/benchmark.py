@@ -0,0 +1,261 @@
+"""
+Render benchmark on fixed synthetic scenes, no dataset needed. Reports
+scenes/sec, wall time per stage (decode and resample, silence trim,
+render, WAV writes, metadata), peak RSS and optionally traced memory and
+allocated blocks per stage, as JSON that can be diffed between versions.
+
+Usage: python -m d3audiorecon.renderer.benchmark --output results.json
+       python -m d3audiorecon.renderer.benchmark --compare results.json
+"""
+import argparse
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+import multiprocessing as mp
+from contextlib import contextmanager
+
+import numpy as np
+import soundfile as sf
+
+from d3audiorecon.renderer.classes import SoundSource, Scene, \
+    INPUT_OUTPUT_TARGET_SAMPLE_RATE
+from d3audiorecon.renderer.audio_cache import load_audio
+from d3audiorecon.renderer.mic_array import MicArray
+
+# name -> (num_mics, num_sources, scene duration in seconds)
+SIZES = {
+    "small": (2, 2, 1.0),
+    "default": (8, 4, 6.0),
+    "large": (16, 8, 10.0),
+}
+STAGES = ("decode", "trim", "render", "save", "metadata")
+FILE_SAMPLE_RATE = 44100  # Sources are stored at this rate so decode resamples
+LEADING_SILENCE = 0.25  # s of silence before every source, for trim to remove
+BENCHMARK_SEED = 1234
+
+
+def new_blocks(before, after):
+    """
+    Blocks in tracemalloc snapshot after that were not in before, counted
+    per allocating line so frees of older blocks elsewhere do not cancel
+    them. Returns the count for all blocks and for NumPy array buffers.
+    """
+    arrays = [tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain)]
+    counts = []
+    for curr_before, curr_after in ((before, after), (before.filter_traces(arrays),
+                                                      after.filter_traces(arrays))):
+        counts.append(sum(max(0, stat.count_diff)
+                          for stat in curr_after.compare_to(curr_before, "lineno")))
+    return counts
+
+
+class StageTimer(object):
+    def __init__(self, trace_allocations=False):
+        """
+        Accumulates wall time of named stages, and with trace_allocations
+        their traced memory: peak_bytes is the most a stage ever held above
+        what was live when it started, temporaries included, and
+        retained_bytes what it left allocated. blocks and array_blocks
+        count the blocks and NumPy array buffers it allocated and left
+        alive, from snapshots before and after (see new_blocks);
+        temporaries it freed again only show in peak_bytes.
+        """
+        self.trace_allocations = trace_allocations
+        self.stages = {name: {"seconds": 0.0} for name in STAGES}
+        if trace_allocations:
+            for stats in self.stages.values():
+                stats.update(peak_bytes=0, retained_bytes=0, blocks=0, array_blocks=0)
+
+    @contextmanager
+    def stage(self, name: str):
+        # Memory is read outside the timed region, the first snapshot is
+        # taken before the stage's baseline so it is not counted in it
+        if self.trace_allocations:
+            start_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            start_bytes, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        stats = self.stages[name]
+        stats["seconds"] += elapsed
+        if self.trace_allocations:
+            end_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            stats["peak_bytes"] = max(stats["peak_bytes"], peak_bytes - start_bytes)
+            stats["retained_bytes"] += end_bytes - start_bytes
+            blocks, array_blocks = new_blocks(start_snapshot, tracemalloc.take_snapshot())
+            stats["blocks"] += blocks
+            stats["array_blocks"] += array_blocks
+
+    def per_scene(self, num_scenes: int):
+        """
+        Stage stats over num_scenes scenes as values per scene: mean
+        seconds, retained bytes and blocks, and the largest peak of any
+        one scene
+        """
+        stages = {}
+        for name, stats in self.stages.items():
+            stages[name] = dict(stats, seconds=stats["seconds"] / num_scenes)
+            if self.trace_allocations:
+                for key in ("retained_bytes", "blocks", "array_blocks"):
+                    stages[name][key] = stats[key] / num_scenes
+        return stages
+
+
+def write_sources(audio_dir: str, num_sources: int, duration: float):
+    """
+    Deterministic tone plus noise WAVs with leading silence, one per source
+    """
+    rng = np.random.RandomState(BENCHMARK_SEED)
+    t = np.arange(int(duration * FILE_SAMPLE_RATE)) / FILE_SAMPLE_RATE
+    filenames = []
+    for source_idx in range(num_sources):
+        frequency = 110.0 * (source_idx + 1)
+        audio = 0.5 * np.sin(2 * np.pi * frequency * t) + \
+            0.05 * rng.randn(len(t))
+        audio[:int(LEADING_SILENCE * FILE_SAMPLE_RATE)] = 0.0
+        filename = os.path.join(audio_dir, "source{:02d}.wav".format(source_idx))
+        sf.write(filename, audio.astype(np.float32), FILE_SAMPLE_RATE)
+        filenames.append(filename)
+    return filenames
+
+
+def render_scene(filenames, num_mics: int, duration: float, output_dir: str,
+                 timer: StageTimer):
+    """
+    One scene through the same steps as renderer/main.py
+    """
+    with timer.stage("decode"):
+        decoded = [load_audio(filename, sr=INPUT_OUTPUT_TARGET_SAMPLE_RATE)
+                   for filename in filenames]
+
+    rng = np.random.RandomState(BENCHMARK_SEED)
+    with timer.stage("trim"):
+        sources = [SoundSource([x, y, 0.0], data=audio, sr=sr)
+                   for (audio, sr), (x, y) in
+                   zip(decoded, rng.uniform(-5.0, 5.0, (len(decoded), 2)))]
+
+    mics = MicArray.circular(num_mics).microphones()
+    scene = Scene(sources, mics)
+    with timer.stage("render"):
+        result = scene.render(cutoff_time=duration)
+
+    with timer.stage("save"):
+        result.write_wavs(output_dir)
+
+    with timer.stage("metadata"):
+        metadata = {"source{:02d}".format(idx): {"position": list(source.position),
+                                                 "filename": filename}
+                    for idx, (source, filename) in enumerate(zip(sources, filenames))}
+        with open(os.path.join(output_dir, "metadata.json"), "w") as f:
+            json.dump(metadata, f, indent=4)
+
+
+def run_size(name: str, num_scenes: int, warmup: int, trace_allocations: bool):
+    """
+    Benchmark one size, meant to run in a fresh process so peak RSS is
+    its own
+    """
+    num_mics, num_sources, duration = SIZES[name]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filenames = write_sources(tmp_dir, num_sources, duration)
+        for _ in range(warmup):
+            render_scene(filenames, num_mics, duration, tmp_dir, StageTimer())
+
+        if trace_allocations:
+            tracemalloc.start()
+        timer = StageTimer(trace_allocations)
+        start = time.perf_counter()
+        for _ in range(num_scenes):
+            render_scene(filenames, num_mics, duration, tmp_dir, timer)
+        elapsed = time.perf_counter() - start
+        if trace_allocations:
+            tracemalloc.stop()
+
+    return {
+        "size": name,
+        "num_mics": num_mics,
+        "num_sources": num_sources,
+        "duration": duration,
+        "num_scenes": num_scenes,
+        "scenes_per_sec": num_scenes / elapsed,
+        "stages": timer.per_scene(num_scenes),
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def environment():
+    """
+    What the results were measured on
+    """
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(results: dict, baseline: dict):
+    """
+    Print this run relative to baseline, ratios above 1 are slower
+    """
+    baseline_sizes = {x["size"]: x for x in baseline["results"]}
+    for curr in results["results"]:
+        old = baseline_sizes.get(curr["size"])
+        if old is None:
+            continue
+        print("{}: {:.2f} -> {:.2f} scenes/sec, peak RSS {:.0f} -> {:.0f} MB".format(
+            curr["size"], old["scenes_per_sec"], curr["scenes_per_sec"],
+            old["peak_rss_bytes"] / 2**20, curr["peak_rss_bytes"] / 2**20))
+        for stage in STAGES:
+            old_seconds = old["stages"][stage]["seconds"]
+            curr_seconds = curr["stages"][stage]["seconds"]
+            ratio = curr_seconds / old_seconds if old_seconds > 0 else float("inf")
+            print("    {:<10} {:9.4f}s -> {:9.4f}s  x{:.2f}".format(
+                stage, old_seconds, curr_seconds, ratio))
+            if "blocks" in old["stages"][stage] and "blocks" in curr["stages"][stage]:
+                print("    {:<10} {:9.1f} -> {:9.1f} blocks, {:.1f} -> {:.1f} arrays".format(
+                    "", old["stages"][stage]["blocks"], curr["stages"][stage]["blocks"],
+                    old["stages"][stage]["array_blocks"], curr["stages"][stage]["array_blocks"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the renderer on synthetic scenes')
+    parser.add_argument("--sizes", type=lambda x: x.split(","), default=list(SIZES), help="Comma separated sizes to run, from " + ",".join(SIZES))
+    parser.add_argument("--num-scenes", type=int, default=5, help="Timed scenes per size")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed scenes per size before timing")
+    parser.add_argument("--trace-allocations", action="store_true", help="Also trace allocations per stage, slows every stage down")
+    parser.add_argument("--output", type=str, default=None, help="Write results JSON here, printed otherwise")
+    parser.add_argument("--compare", type=str, default=None, help="Results JSON of a previous run to compare against")
+    args = parser.parse_args()
+
+    results = {"environment": environment(), "results": []}
+    for name in args.sizes:
+        # A fresh process per size keeps peak RSS and caches separate
+        with mp.get_context("spawn").Pool(1) as pool:
+            results["results"].append(pool.apply(
+                run_size, (name, args.num_scenes, args.warmup, args.trace_allocations)))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -1,16 +1,28 @@
 import os
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 import librosa
+import scipy.fft
 import soundfile as sf
-from pysndfx import AudioEffectsChain
 
 from d3audiorecon.renderer.constants import \
     SPEED_OF_SOUND, ATTENUATION_ALPHA
+from d3audiorecon.renderer.audio_cache import AudioCache, load_audio
+from d3audiorecon.renderer.corpus import PackedCorpus
+from d3audiorecon.renderer.propagation import atmospheric_absorption, \
+    fractional_delay_response
+from d3audiorecon.renderer.reverb import ImpulseResponsePool, \
+    scene_impulse_responses, fft_convolve
+from d3audiorecon.renderer.room import ShoeboxRoom
+from d3audiorecon.renderer.trim_index import TrimIndex
 
 INPUT_OUTPUT_TARGET_SAMPLE_RATE = 48000
+FRACTIONAL_DELAY_GUARD = 256  # Extra FFT samples for fractional delay tails
+DEFAULT_BLOCK_SAMPLES = 4096  # Block size of the streaming renderer
+DEFAULT_WRITER_THREADS = 4  # Files RenderResult.write_wavs encodes at once
 
 
 class Microphone(object):
@@ -52,14 +64,31 @@ class SoundSource(object):
                  duration=None,
                  start_time: float = 0.0,
                  trim_silence=True,
-                 reduce_factor=1.0):
+                 reduce_factor=1.0,
+                 cache: AudioCache = None,
+                 corpus: PackedCorpus = None,
+                 trim_index: TrimIndex = None):
         """
-        Either filename should be passed, or data and sample rate
+        Either filename should be passed, or data and sample rate.
+        Files are decoded through cache if one is given. With a packed
+        corpus, filename is one or more corpus keys and the audio is a
+        slice of the corpus trimmed by its precomputed bounds. A trim
+        index does the same for files, unindexed files are trimmed here.
+        For several files the indexed bounds are each file's own, so
+        the result can differ from trimming the concatenation (see
+        renderer/trim_index.py).
         """
         assert (len(position) == 3)  # x, y, z
         self.position = np.array(position)
 
-        if filename is None:
+        if corpus is not None:
+            if offset != 0.0 or duration is not None:
+                raise ValueError("offset and duration are not supported with a packed corpus")
+            self.audio, self.sample_rate = corpus.load(filename, trim=trim_silence)
+            self.start_time = start_time
+            trim_silence = False  # Already trimmed
+
+        elif filename is None:
             if data is None or sr is None:
                 raise (ValueError(
                     "Either filename or audio and sampe rate must be provided")
@@ -69,30 +98,46 @@ class SoundSource(object):
             self.start_time = start_time
 
         elif type(filename) is str:
-            audio, sample_rate = librosa.core.load(
+            audio, sample_rate = load_audio(
                 filename,
                 sr=INPUT_OUTPUT_TARGET_SAMPLE_RATE,
-                mono=True,
                 offset=offset,
-                duration=duration)
+                duration=duration,
+                cache=cache)
             self.audio = audio
             self.sample_rate = sample_rate
             self.start_time = start_time
+            lengths = [len(audio)]
 
         else:
             audio = np.array([])
+            lengths = []
             for f in filename:
-                curr_audio, sample_rate = librosa.core.load(
+                curr_audio, sample_rate = load_audio(
                     f,
                     sr=INPUT_OUTPUT_TARGET_SAMPLE_RATE,
-                    mono=True,
                     offset=offset,
-                    duration=duration)
+                    duration=duration,
+                    cache=cache)
                 audio = np.concatenate((audio, curr_audio))
+                lengths.append(len(curr_audio))
 
             self.audio = audio
             self.sample_rate = sample_rate
             self.start_time = start_time
+
+        # Like a packed corpus, drop the leading silence of the first file
+        # and trailing silence of the last by their indexed bounds. Only if
+        # all files are indexed, so a scene never mixes the two trims
+        if trim_silence and trim_index is not None and filename is not None \
+                and corpus is None and offset == 0.0 and duration is None:
+            filenames = [filename] if type(filename) is str else filename
+            bounds = [trim_index.bounds(x, self.sample_rate, length)
+                      for x, length in zip(filenames, lengths)]
+            if all(x is not None for x in bounds):
+                first, last = bounds[0], bounds[-1]
+                self.audio = self.audio[first[0]:len(self.audio) - lengths[-1] + last[1]]
+                trim_silence = False
         # Trim silence at the beginning, making sure we have something
         if trim_silence:
             new_audio = librosa.effects.trim(self.audio, top_db=20)[0]
@@ -100,7 +145,8 @@ class SoundSource(object):
                 new_audio = librosa.effects.trim(self.audio, top_db=80)[0]
             self.audio = new_audio
 
-        self.audio *= reduce_factor
+        if reduce_factor != 1.0:
+            self.audio = self.audio * reduce_factor  # Cached audio is read only
 
     def save(self, filename: str):
         sf.write(filename, self.audio, self.sample_rate)
@@ -116,72 +162,499 @@ class Scene(object):
 
         self.sample_rate = sources[0].sample_rate
 
+    def distances(self, random_shift: float = 0.0, lookup=None):
+        """
+        Returns the num_mics x num_sources matrix of mic to source distances,
+        optionally jittered by a gaussian of std random_shift (meters).
+        lookup is a DelayGainGrid from renderer/mic_array.py built for
+        these mics, it interpolates distances instead of computing them.
+        """
+        source_positions = np.array([source.position for source in self.sources])
+        if lookup is not None:
+            distances = lookup.distances(source_positions).T
+        else:
+            mic_positions = np.array([mic.position for mic in self.mics])
+            diff = mic_positions[:, None, :] - source_positions[None, :, :]
+
+            # Batched matmul gives the same dot product as np.linalg.norm per pair
+            distances = np.sqrt(
+                (diff[..., None, :] @ diff[..., :, None])[..., 0, 0])
+        distances = distances + np.random.normal(scale=random_shift,
+                                                 size=distances.shape)
+        return distances
+
+    def start_samples(self, distances):
+        """
+        num_mics x num_sources arrival time of every source in (fractional) samples
+        """
+        start_times = np.array([source.start_time for source in self.sources])
+        return self.sample_rate * (start_times + distances / SPEED_OF_SOUND)
+
     def render(self,
                cutoff_time: float,
                geometric_attenuation=True,
                atmospheric_attenuation=True,
                volume_boost=1.0,
                random_shift=0.0,
-               random_reverb=False):
+               random_reverb=False,
+               dtype=np.float32,
+               fractional_delay=False,
+               impulse_responses: ImpulseResponsePool = None,
+               room: ShoeboxRoom = None,
+               lookup=None):
         """
         Render all sound sources to all microphones.
         Only does ITD and attenuation.
 
+        Every shifted source is written straight into one preallocated
+        num_mics x num_sources x total_samples tensor (self.sources_gt) and
+        summed into num_mics x total_samples (self.mix). mic.buffer and
+        mic.sources_gt are views into those. With dtype=np.float64 the
+        output is bit identical to rendering each pair separately.
+
+        With fractional_delay=True the ITD is not rounded to whole samples.
+        Each source is transformed once and the sub-sample delays and gains
+        of all mics are applied in the frequency domain, with frequency
+        dependent atmospheric absorption instead of ATTENUATION_ALPHA.
+
+        With random_reverb every source is convolved with the scene's room
+        response per mic, drawn once per render from impulse_responses or
+        synthesized. The response spectra are folded into the propagation
+        multiply, so every source still takes one forward and one inverse
+        FFT.
+
+        With a room, propagation uses its image source impulse responses
+        (which include the direct path) instead of free field delay and
+        attenuation. random_shift and lookup do not apply to it.
+
+        With a lookup grid (see Scene.distances) mic to source distances
+        are interpolated from it instead of computed per pair.
+
+        Returns a RenderResult over self.mix and self.sources_gt.
+
         cutoff_time: in seconds
         """
-        for mic in self.mics:
-            # Initialize mic buffer to be empty correct size
-            total_samples = int(cutoff_time * self.sample_rate)
-            mic.buffer = np.zeros((total_samples))
+        num_mics, num_sources = len(self.mics), len(self.sources)
+        total_samples = int(cutoff_time * self.sample_rate)
+        if room is not None and (random_reverb or fractional_delay):
+            raise ValueError("A room replaces reverb and fractional delay")
+        if room is not None and (random_shift != 0.0 or lookup is not None):
+            raise ValueError("A room computes its own distances, random_shift "
+                             "and lookup do not apply")
+
+        # All sources are in the same room, 1 or num_mics x ir_samples
+        responses = scene_impulse_responses(num_mics, self.sample_rate,
+                                            impulse_responses) \
+            if random_reverb else None
+
+        # ITD and attenuation for all (mic, source) pairs at once
+        distances = self.distances(random_shift, lookup)
+        start_samples = self.start_samples(distances)
+        spreading = distances**2  # energy spreading over area
+
+        self.sources_gt = np.zeros((num_mics, num_sources, total_samples),
+                                   dtype=dtype)
+        self.mix = np.empty((num_mics, total_samples), dtype=dtype)
+
+        if room is not None:
+            self._render_room(room, geometric_attenuation,
+                              atmospheric_attenuation)
+        elif fractional_delay:
+            self._render_fractional(start_samples, distances,
+                                    spreading if geometric_attenuation else None,
+                                    atmospheric_attenuation, responses)
+        else:
+            # https://en.wikibooks.org/wiki/Engineering_Acoustics/Outdoor_Sound_Propagation
+            absorption = np.exp(-ATTENUATION_ALPHA * distances)
+            if responses is not None:
+                self._render_reverb(start_samples.astype(int),
+                                    spreading if geometric_attenuation else None,
+                                    absorption if atmospheric_attenuation else None,
+                                    responses)
+            else:
+                self._shift_block(self.sources_gt, 0, start_samples.astype(int),
+                                  spreading if geometric_attenuation else None,
+                                  absorption if atmospheric_attenuation else None)
+
+        if volume_boost != 1.0:
+            self.sources_gt *= volume_boost
+        np.sum(self.sources_gt, axis=1, out=self.mix)
+
+        for mic_idx, mic in enumerate(self.mics):
+            mic.buffer = self.mix[mic_idx]
+            mic.sources_gt = self.sources_gt[mic_idx]
             mic.sample_rate = self.sample_rate
+        return self.result()
+
+    def result(self):
+        """
+        RenderResult of the last render()
+        """
+        return RenderResult(self.mix, self.sources_gt, self.sample_rate)
+
+    def render_batch(self, source_positions, cutoff_time: float, **kwargs):
+        """
+        Render the scene's sources at N placements in one call.
+
+        Args:
+            source_positions: N x num_sources x 3 positions, replacing
+                each source's own position
+            kwargs: passed to render_batch_stream
+        Returns:
+            N x num_mics x samples mixes, or (mixes, sources) with
+            N x num_mics x num_sources x samples sources
+        """
+        return next(self.render_batch_stream(source_positions, cutoff_time,
+                                             batch_size=len(source_positions),
+                                             **kwargs))
+
+    def render_batch_stream(self,
+                            source_positions,
+                            cutoff_time: float,
+                            batch_size: int = 16,
+                            geometric_attenuation=True,
+                            atmospheric_attenuation=True,
+                            volume_boost=1.0,
+                            dtype=np.float32,
+                            fractional_delay=False,
+                            return_sources=False,
+                            lookup=None):
+        """
+        Yields render_batch results for up to batch_size placements at a
+        time. Per source work is done once for all placements: with
+        fractional_delay every source is transformed once and only the
+        per placement delays and gains are applied to its spectrum.
+        Each placement matches render() with the sources moved there,
+        except that fractional delays use one FFT length for the batch.
 
-            # Render all sources to that mic
-            for source in self.sources:
-                # ITD
-                distance = np.linalg.norm(mic.position - source.position) + np.random.normal(scale=random_shift)
-                curr_start_time = source.start_time + distance / SPEED_OF_SOUND
-                curr_start_samples = int(source.sample_rate * curr_start_time)
-                curr_buffer = np.concatenate((np.zeros(
-                    (curr_start_samples)).astype(np.float64), source.audio))
-
-                # Attenuation
-                if (geometric_attenuation):
-                    curr_buffer = np.divide(
-                        curr_buffer, distance**
-                        2)  # attenuation due to energy spreading over area
-                if (atmospheric_attenuation):
-                    curr_buffer = np.multiply(
-                        curr_buffer, np.exp(-ATTENUATION_ALPHA * distance)
-                    )  # attenuation due to atmosphere https://en.wikibooks.org/wiki/Engineering_Acoustics/Outdoor_Sound_Propagation
-
-                # Reverb
-                if random_reverb:
-                    fx = (
-                        AudioEffectsChain()
-                        .reverb()
-                    )
-                curr_buffer = fx(curr_buffer)
-
-                # Pad if necessary to cutoff_time
-                curr_buffer = np.pad(curr_buffer, (0, total_samples))
-                curr_buffer = curr_buffer[:total_samples]
-                curr_buffer *= volume_boost
-
-                # Append to each mic
-                mic.sources_gt.append(curr_buffer)
-                mic.buffer += np.array(curr_buffer)
+        cutoff_time: in seconds
+        """
+        source_positions = np.asarray(source_positions, dtype=np.float64)
+        num_placements, num_sources, _ = source_positions.shape
+        assert num_sources == len(self.sources)
+        num_mics = len(self.mics)
+        total_samples = int(cutoff_time * self.sample_rate)
+        sources_audio = [source.audio for source in self.sources]
+
+        # N x num_mics x num_sources, like Scene.distances per placement
+        if lookup is not None:
+            distances = lookup.distances(source_positions.reshape(-1, 3)) \
+                .reshape(num_placements, num_sources, num_mics).transpose(0, 2, 1)
+        else:
+            mic_positions = np.array([mic.position for mic in self.mics])
+            diff = mic_positions[None, :, None, :] - source_positions[:, None, :, :]
+            distances = np.sqrt(
+                (diff[..., None, :] @ diff[..., :, None])[..., 0, 0])
+        start_samples = self.start_samples(distances)
+        spreading = distances**2 if geometric_attenuation else None
+        # https://en.wikibooks.org/wiki/Engineering_Acoustics/Outdoor_Sound_Propagation
+        absorption = np.exp(-ATTENUATION_ALPHA * distances) \
+            if atmospheric_attenuation else None
+
+        if fractional_delay:
+            # One spectrum per source, long enough for the latest placement
+            max_delay = int(np.ceil(start_samples.max(initial=0.0)))
+            n_fft = scipy.fft.next_fast_len(total_samples + max_delay +
+                                            FRACTIONAL_DELAY_GUARD)
+            frequencies = np.fft.rfftfreq(n_fft, d=1.0 / self.sample_rate)
+            spectra = [scipy.fft.rfft(audio[:total_samples], n=n_fft)
+                       for audio in sources_audio]
+            if atmospheric_attenuation:
+                absorption = atmospheric_absorption(frequencies)
+
+        for batch_start in range(0, num_placements, batch_size):
+            batch = slice(batch_start, min(batch_start + batch_size, num_placements))
+            curr_placements = batch.stop - batch.start
+            sources = np.zeros((curr_placements, num_mics, num_sources, total_samples),
+                               dtype=dtype)
+            if fractional_delay:
+                for source_idx, spectrum in enumerate(spectra):
+                    delays = start_samples[batch, :, source_idx].reshape(-1)
+                    curr_distances = distances[batch, :, source_idx].reshape(-1, 1)
+                    response = fractional_delay_response(frequencies, delays,
+                                                         self.sample_rate)
+                    if geometric_attenuation:
+                        response /= curr_distances**2
+                    if atmospheric_attenuation:
+                        response *= np.exp(-absorption[None, :] * curr_distances)
+                    response *= spectrum
+                    sources[:, :, source_idx] = scipy.fft.irfft(
+                        response, n=n_fft, axis=-1)[:, :total_samples] \
+                        .reshape(curr_placements, num_mics, total_samples)
+            else:
+                for placement_idx in range(batch.start, batch.stop):
+                    self._shift_block(
+                        sources[placement_idx - batch.start], 0,
+                        start_samples[placement_idx].astype(int),
+                        spreading[placement_idx] if spreading is not None else None,
+                        absorption[placement_idx] if absorption is not None else None,
+                        sources_audio)
+
+            if volume_boost != 1.0:
+                sources *= volume_boost
+            mix = np.sum(sources, axis=2)
+            yield (mix, sources) if return_sources else mix
+
+    def render_blocks(self,
+                      cutoff_time: float,
+                      block_samples: int = DEFAULT_BLOCK_SAMPLES,
+                      geometric_attenuation=True,
+                      atmospheric_attenuation=True,
+                      volume_boost=1.0,
+                      random_shift=0.0,
+                      dtype=np.float32,
+                      return_sources=False,
+                      lookup=None):
+        """
+        Streaming version of render with integer delays. Yields the mix as
+        num_mics x block_samples blocks (the last one may be shorter), or
+        (mix, sources) with num_mics x num_sources x block_samples sources.
+
+        The delay line state carried between blocks is every pair's read
+        position into its source, so the concatenated blocks are identical
+        to render() and memory does not grow with cutoff_time. Yielded
+        arrays are reused for the next block, copy them to keep them.
+
+        cutoff_time: in seconds
+        """
+        num_mics, num_sources = len(self.mics), len(self.sources)
+        total_samples = int(cutoff_time * self.sample_rate)
+
+        distances = self.distances(random_shift, lookup)
+        start_samples = self.start_samples(distances).astype(int)
+        spreading = distances**2 if geometric_attenuation else None
+        absorption = np.exp(-ATTENUATION_ALPHA * distances) \
+            if atmospheric_attenuation else None
+
+        sources_block = np.empty((num_mics, num_sources, block_samples), dtype=dtype)
+        mix_block = np.empty((num_mics, block_samples), dtype=dtype)
+        for block_start in range(0, total_samples, block_samples):
+            curr_samples = min(block_samples, total_samples - block_start)
+            sources = sources_block[:, :, :curr_samples]
+            sources[...] = 0
+            self._shift_block(sources, block_start, start_samples, spreading,
+                              absorption)
+            if volume_boost != 1.0:
+                sources *= volume_boost
+            mix = mix_block[:, :curr_samples]
+            np.sum(sources, axis=1, out=mix)
+            yield (mix, sources) if return_sources else mix
+
+    def render_to_files(self, output_prefix: str, cutoff_time: float,
+                        block_samples: int = DEFAULT_BLOCK_SAMPLES, **kwargs):
+        """
+        Streams every mic's mix to <output_prefix>micXX_mixed.wav block by
+        block. kwargs are passed to render_blocks
+        """
+        files = [sf.SoundFile(output_prefix + "mic{:02d}_mixed.wav".format(i),
+                              "w", samplerate=self.sample_rate, channels=1)
+                 for i in range(len(self.mics))]
+        try:
+            for mix in self.render_blocks(cutoff_time, block_samples, **kwargs):
+                for f, mic_mix in zip(files, mix):
+                    f.write(mic_mix)
+        finally:
+            for f in files:
+                f.close()
+
+    def _shift_block(self, block, block_start: int, start_samples, spreading,
+                     absorption, sources_audio=None):
+        """
+        Shift every source by a whole number of samples into block, a
+        num_mics x num_sources x samples window starting at output sample
+        block_start. sources_audio overrides the audio of each source.
+        """
+        if sources_audio is None:
+            sources_audio = [source.audio for source in self.sources]
+        num_mics, num_sources, block_samples = block.shape
+        block_end = block_start + block_samples
+        for mic_idx, source_idx in np.ndindex(num_mics, num_sources):
+            start = start_samples[mic_idx, source_idx]
+            audio = sources_audio[source_idx]
+            first = max(block_start, start)
+            last = min(block_end, start + len(audio))
+            if first >= last:
+                continue
+            audio = audio[first - start:last - start]
+            out = block[mic_idx, source_idx, first - block_start:last - block_start]
+
+            # Same op order as the per-pair path, in place. That path padded
+            # the audio as float64 first; casting here keeps NumPy 1.x from
+            # picking a float32 loop for a float64 block
+            if spreading is not None:
+                np.divide(audio.astype(out.dtype, copy=False),
+                          spreading[mic_idx, source_idx], out=out)
+            else:
+                out[:] = audio
+            if absorption is not None:
+                np.multiply(out, absorption[mic_idx, source_idx], out=out)
+
+    def _render_fractional(self, start_samples, distances, spreading,
+                           atmospheric_attenuation, responses=None):
+        """
+        Apply sub-sample delays and gains for all mics as one complex
+        multiply per source spectrum, along with the spectra of the room
+        responses (1 or num_mics x ir_samples) if given
+        """
+        num_mics, num_sources, total_samples = self.sources_gt.shape
+        ir_samples = responses.shape[1] if responses is not None else 1
+
+        # Long enough that the latest delayed copy does not wrap around
+        max_delay = int(np.ceil(start_samples.max(initial=0.0)))
+        n_fft = scipy.fft.next_fast_len(total_samples + max_delay + ir_samples - 1 +
+                                        FRACTIONAL_DELAY_GUARD)
+        frequencies = np.fft.rfftfreq(n_fft, d=1.0 / self.sample_rate)
+        if atmospheric_attenuation:
+            absorption = atmospheric_absorption(frequencies)
+        if responses is not None:
+            ir_spectra = scipy.fft.rfft(responses, n=n_fft, axis=-1)
+
+        for source_idx, source in enumerate(self.sources):
+            delays = start_samples[:, source_idx]
+            if delays.min() >= total_samples:
+                continue
+            spectrum = scipy.fft.rfft(source.audio[:total_samples], n=n_fft)
+
+            # num_mics x freq transfer function
+            response = fractional_delay_response(frequencies, delays,
+                                                 self.sample_rate)
+            if spreading is not None:
+                response /= spreading[:, source_idx, None]
+            if atmospheric_attenuation:
+                response *= np.exp(-absorption[None, :] *
+                                   distances[:, source_idx, None])
+            if responses is not None:
+                response *= ir_spectra
+            response *= spectrum
+
+            self.sources_gt[:, source_idx] = scipy.fft.irfft(
+                response, n=n_fft, axis=-1)[:, :total_samples]
+
+    def _render_reverb(self, start_samples, spreading, absorption, responses):
+        """
+        Whole sample delays with the room responses (1 or num_mics x
+        ir_samples): each source spectrum is multiplied by the response
+        spectra and gains of all mics, and the inverse transform of every
+        mic is shifted into place
+        """
+        num_mics, num_sources, total_samples = self.sources_gt.shape
+        n_fft = scipy.fft.next_fast_len(total_samples + responses.shape[1] - 1,
+                                        real=True)
+        ir_spectra = scipy.fft.rfft(responses, n=n_fft, axis=-1)
+        gains = np.ones((num_mics, num_sources), dtype=np.float32)  # Spectra stay complex64
+        if spreading is not None:
+            gains /= spreading
+        if absorption is not None:
+            gains *= absorption
+
+        for source_idx, source in enumerate(self.sources):
+            starts = start_samples[:, source_idx]
+            if starts.min() >= total_samples:
+                continue
+            spectrum = scipy.fft.rfft(source.audio[:total_samples], n=n_fft)
+            wet = scipy.fft.irfft(ir_spectra * (gains[:, source_idx, None] * spectrum),
+                                  n=n_fft, axis=-1)
+            for mic_idx, start in enumerate(starts):
+                if start < total_samples:
+                    self.sources_gt[mic_idx, source_idx, start:] = \
+                        wet[mic_idx, :total_samples - start]
+
+    def _render_room(self, room: ShoeboxRoom, geometric_attenuation,
+                     atmospheric_attenuation):
+        """
+        Convolve every source with the room responses of all mics
+        """
+        num_mics, num_sources, total_samples = self.sources_gt.shape
+        mic_positions = np.array([mic.position for mic in self.mics])
+        for source_idx, source in enumerate(self.sources):
+            # Responses do not depend on the start time, so they are cached
+            # across start times and it delays their output instead
+            start = int(self.sample_rate * source.start_time)
+            if start >= total_samples:
+                continue
+            rirs = room.impulse_responses(source.position, mic_positions,
+                                          self.sample_rate,
+                                          geometric_attenuation,
+                                          atmospheric_attenuation)
+            self.sources_gt[:, source_idx, start:] = fft_convolve(
+                source.audio, rirs, total_samples - start)
 
     def render_binaural(self, mic_idxs: List[int], output_filename: str,
-                        cutoff_time: float):
+                        cutoff_time: float, result=None):
+        """
+        Renders a stero output with two chosen mics. Pass the RenderResult
+        of an earlier render to write its stereo pair without rendering again.
+        """
+        if result is None:
+            result = self.render(cutoff_time)
+        result.write_stereo(output_filename, mic_idxs[0], mic_idxs[1])
+
+
+class RenderResult(object):
+    def __init__(self, mix, sources_gt, sample_rate: int):
+        """
+        Outputs of one render. Everything returned is a view of the
+        rendered arrays, nothing is copied until it is written.
+
+        Args:
+            mix: num_mics x samples
+            sources_gt: num_mics x num_sources x samples
+        """
+        self.mix = mix
+        self.sources_gt = sources_gt
+        self.sample_rate = sample_rate
+
+    @property
+    def num_mics(self):
+        return self.mix.shape[0]
+
+    @property
+    def num_sources(self):
+        return self.sources_gt.shape[1]
+
+    def mic_mix(self, mic_idx: int):
+        return self.mix[mic_idx]
+
+    def source_image(self, source_idx: int, mic_idx=None):
         """
-        Renders a stero output with two chosen mics
+        One source as heard by every mic (num_mics x samples) or by one
         """
-        self.render(cutoff_time)
-        left_data = self.mics[mic_idxs[0]].buffer
-        right_data = self.mics[mic_idxs[1]].buffer
-        left_data = np.expand_dims(left_data, 0)
-        right_data = np.expand_dims(right_data, 0)
+        if mic_idx is None:
+            return self.sources_gt[:, source_idx]
+        return self.sources_gt[mic_idx, source_idx]
 
-        stereo_data = np.concatenate((left_data, right_data))
-        sf.write(output_filename, np.swapaxes(stereo_data, 0, 1),
+    def stereo(self, left_idx: int, right_idx: int, source_idx=None):
+        """
+        samples x 2 downmix of two mics, of the mix or of one source
+        """
+        data = self.mix if source_idx is None else self.source_image(source_idx)
+        if left_idx == right_idx:
+            return np.broadcast_to(data[left_idx][:, None], (data.shape[1], 2))
+        # A strided slice over exactly the two rows stays a view
+        step = right_idx - left_idx
+        stop = right_idx + (1 if step > 0 else -1)
+        return data[left_idx:stop if stop >= 0 else None:step].T
+
+    def write_stereo(self, output_filename: str, left_idx: int,
+                     right_idx: int, source_idx=None):
+        sf.write(output_filename, self.stereo(left_idx, right_idx, source_idx),
                  self.sample_rate)
+
+    def write_wavs(self, output_dir: str, num_threads: int = DEFAULT_WRITER_THREADS):
+        """
+        Writes micXX_mixed.wav and micXX_sourceYY_gt.wav for every mic, as
+        Microphone.save does, encoding files on num_threads threads
+        """
+        jobs = []
+        for mic_idx in range(self.num_mics):
+            output_prefix = os.path.join(output_dir, "mic{:02d}_".format(mic_idx))
+            jobs.append((output_prefix + "mixed.wav", self.mix[mic_idx]))
+            for source_idx in range(self.num_sources):
+                jobs.append((output_prefix + "source{:02}_gt.wav".format(source_idx),
+                             self.sources_gt[mic_idx, source_idx]))
+
+        # libsndfile encodes without holding the GIL
+        with ThreadPoolExecutor(num_threads) as executor:
+            for future in [executor.submit(sf.write, filename, data, self.sample_rate)
+                           for filename, data in jobs]:
+                future.result()
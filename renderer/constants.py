@@ -1,2 +1,5 @@
 SPEED_OF_SOUND = 343.0  # m/s
-ATTENUATION_ALPHA = 4.98e-3 # dimensionless, @20.0C @1atm @1000Hz @70% RH https://en.wikibooks.org/wiki/Engineering_Acoustics/Outdoor_Sound_Propagation
\ No newline at end of file
+ATTENUATION_ALPHA = 4.98e-3 # dimensionless, @20.0C @1atm @1000Hz @70% RH https://en.wikibooks.org/wiki/Engineering_Acoustics/Outdoor_Sound_Propagation
+ATMOSPHERE_TEMPERATURE = 20.0  # C
+ATMOSPHERE_HUMIDITY = 70.0  # % RH
+ATMOSPHERE_PRESSURE = 101.325  # kPa
@@ -0,0 +1,157 @@
+"""
+Packed source corpus: every voice and background file decoded once at the
+render sample rate into one contiguous memory mappable blob, with an index
+of offsets, lengths and silence trim bounds.
+
+Usage: python -m d3audiorecon.renderer.corpus voices_dir bg_sounds_dir output_dir
+"""
+import argparse
+import os
+import json
+import multiprocessing as mp
+
+import numpy as np
+import librosa
+
+from d3audiorecon.renderer.trim_index import trim_bounds, TRIM_INDEX_FILENAME
+
+AUDIO_FILENAME = "audio.bin"
+INDEX_FILENAME = "index.json"
+SUPPORTED_DTYPES = ("float32", "int16")
+INT16_SCALE = np.iinfo(np.int16).max
+
+
+def is_packed_corpus(path: str):
+    return os.path.isfile(os.path.join(path, INDEX_FILENAME))
+
+
+class PackedCorpus(object):
+    def __init__(self, path: str):
+        """
+        Read only view of a corpus written by pack_corpus. The audio is
+        memory mapped, so open one per process rather than pickling it.
+        """
+        self.path = path
+        with open(os.path.join(path, INDEX_FILENAME)) as f:
+            index = json.load(f)
+        self.sample_rate = index["sample_rate"]
+        self.dtype = np.dtype(index["dtype"])
+        self.entries = index["entries"]  # key -> [offset, length, trim_start, trim_end]
+        self.speakers = index["speakers"]  # speaker -> sorted utterance keys
+        self.backgrounds = index["backgrounds"]
+        self.audio = np.memmap(os.path.join(path, AUDIO_FILENAME),
+                               dtype=self.dtype, mode="r",
+                               shape=(index["num_samples"],))
+
+    def load(self, keys, trim=True):
+        """
+        Audio of one key or several keys played back to back, as float32.
+
+        Consecutive utterances of a speaker are stored back to back, so for
+        a float32 corpus this is a zero copy slice. With trim the leading
+        silence of the first key and trailing silence of the last is removed.
+        """
+        if isinstance(keys, str):
+            keys = [keys]
+        entries = [self.entries[key] for key in keys]
+        start = entries[0][0] + (entries[0][2] if trim else 0)
+        end = entries[-1][0] + (entries[-1][3] if trim else entries[-1][1])
+
+        contiguous = all(prev[0] + prev[1] == curr[0]
+                         for prev, curr in zip(entries[:-1], entries[1:]))
+        if contiguous:
+            audio = self.audio[start:end]
+        else:
+            pieces = [self.audio[offset:offset + length]
+                      for offset, length, _, _ in entries]
+            pieces[-1] = pieces[-1][:end - entries[-1][0]]
+            pieces[0] = pieces[0][start - entries[0][0]:]
+            audio = np.concatenate(pieces)
+
+        if self.dtype == np.int16:
+            audio = audio.astype(np.float32) / INT16_SCALE
+        return audio, self.sample_rate
+
+
+def _decode(job):
+    filename, sample_rate, dtype = job
+    audio, _ = librosa.core.load(filename, sr=sample_rate, mono=True)
+    start, end = trim_bounds(audio)
+    if dtype == "int16":
+        audio = np.round(np.clip(audio, -1.0, 1.0) * INT16_SCALE)
+    return audio.astype(dtype), start, end
+
+
+def pack_corpus(voices_dir: str, bg_sounds_dir: str, output_dir: str,
+                sample_rate: int, dtype: str = "float32", num_workers=None):
+    """
+    Decode and resample every voice (voices_dir/<speaker>/<file>) and
+    background (bg_sounds_dir/<file>) into output_dir
+    """
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError("Unsupported corpus dtype {}".format(dtype))
+
+    keys, filenames = [], []
+    speakers = {}
+    for speaker in sorted(os.listdir(voices_dir)):
+        speaker_dir = os.path.join(voices_dir, speaker)
+        if not os.path.isdir(speaker_dir):
+            continue
+        speakers[speaker] = []
+        for name in sorted(os.listdir(speaker_dir)):
+            key = "voices/{}/{}".format(speaker, name)
+            speakers[speaker].append(key)
+            keys.append(key)
+            filenames.append(os.path.join(speaker_dir, name))
+    backgrounds = []
+    for name in sorted(os.listdir(bg_sounds_dir)):
+        if name == TRIM_INDEX_FILENAME:
+            continue
+        key = "backgrounds/{}".format(name)
+        backgrounds.append(key)
+        keys.append(key)
+        filenames.append(os.path.join(bg_sounds_dir, name))
+
+    os.makedirs(output_dir, exist_ok=True)
+    entries = {}
+    offset = 0
+    jobs = [(filename, sample_rate, dtype) for filename in filenames]
+    with mp.Pool(num_workers) as pool, \
+            open(os.path.join(output_dir, AUDIO_FILENAME), "wb") as f:
+        for key, (audio, start, end) in zip(keys, pool.imap(_decode, jobs)):
+            f.write(audio.tobytes())
+            entries[key] = [offset, len(audio), start, end]
+            offset += len(audio)
+
+    index = {
+        "sample_rate": sample_rate,
+        "dtype": dtype,
+        "num_samples": offset,
+        "entries": entries,
+        "speakers": speakers,
+        "backgrounds": backgrounds,
+    }
+    tmp_index = os.path.join(output_dir, INDEX_FILENAME + ".tmp")
+    with open(tmp_index, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_index, os.path.join(output_dir, INDEX_FILENAME))
+    return index
+
+
+if __name__ == "__main__":
+    from d3audiorecon.renderer.classes import INPUT_OUTPUT_TARGET_SAMPLE_RATE
+
+    parser = argparse.ArgumentParser(description='Pack voices and backgrounds into one corpus file')
+    parser.add_argument("voices_dir", type=str, help="Path to voices dir from VCTK dataset")
+    parser.add_argument("bg_sounds_dir", type=str, help="Path to background sounds (non voices")
+    parser.add_argument("output_dir", type=str, help="Path to write the packed corpus")
+    parser.add_argument("--sample-rate", type=int, default=INPUT_OUTPUT_TARGET_SAMPLE_RATE, help="Rate to resample everything to")
+    parser.add_argument("--dtype", type=str, default="float32", choices=SUPPORTED_DTYPES, help="Sample format of the blob")
+    parser.add_argument("--num-workers", type=int, default=None, help="Decode processes, defaults to the core count")
+    args = parser.parse_args()
+
+    index = pack_corpus(args.voices_dir, args.bg_sounds_dir, args.output_dir,
+                        args.sample_rate, dtype=args.dtype,
+                        num_workers=args.num_workers)
+    print("Packed {} files, {} samples".format(len(index["entries"]),
+                                               index["num_samples"]))
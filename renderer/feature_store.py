@@ -0,0 +1,222 @@
+"""
+Content addressed store of training features. Log-CQTs and voice masks of
+rendered WAVs are keyed by a hash of the files' contents, the feature and
+its parameters, so every epoch, worker and copy of a dataset shares them.
+Entries are filled on first access by the data loader, or ahead of time:
+
+Usage: python -m d3audiorecon.renderer.feature_store data_dir
+"""
+import argparse
+import os
+import glob
+import hashlib
+import tempfile
+import multiprocessing as mp
+
+import numpy as np
+import librosa
+
+from d3audiorecon.renderer.audio_cache import AudioCache
+from d3audiorecon.renderer.partition import has_dataset_index, \
+    load_dataset_index
+from d3audiorecon.tools.utils import multi_file_log_cqt, voice_mask, \
+    FEATURE_SAMPLE_RATE, CQT_HOP_LENGTH, CQT_N_BINS, CQT_BINS_PER_OCTAVE, \
+    CQT_FILTER_SCALE
+
+DEFAULT_STORE_DIR = os.path.join(tempfile.gettempdir(), "d3audiorecon_features")
+DEFAULT_STORE_BYTES = 16 * 1024**3  # 16 GiB
+CQT_PARAMS = (FEATURE_SAMPLE_RATE, CQT_HOP_LENGTH, CQT_N_BINS,
+              CQT_BINS_PER_OCTAVE, CQT_FILTER_SCALE)
+HASH_CHUNK_BYTES = 1024**2
+
+
+class FeatureStore(AudioCache):
+    def __init__(self, store_dir: str = DEFAULT_STORE_DIR,
+                 max_bytes: int = DEFAULT_STORE_BYTES, dtype=np.float32):
+        """
+        Features as .npy files in store_dir, with the same atomic writes and
+        least recently used eviction as AudioCache. Spectrograms are stored
+        as dtype (float16 halves the size), masks as bits packed along the
+        frequency axis.
+
+        Args:
+            store_dir: directory holding the entries, shared by all processes
+            max_bytes: byte budget for the whole directory
+            dtype: np.float32 or np.float16 spectrograms
+        """
+        super(FeatureStore, self).__init__(store_dir, max_bytes)
+        self.dtype = np.dtype(dtype)
+        # Feature hits and misses of this process, plus those other
+        # processes report through add_lookups
+        self.lookups = [0, 0]
+
+    def file_hash(self, filename: str):
+        """
+        Hash of the file's contents. Hashes are stored as entries keyed by
+        path, size and mtime, so every process and epoch reuses them until
+        the file changes.
+        """
+        def content_hash():
+            sha1 = hashlib.sha1()
+            with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+                    sha1.update(chunk)
+            return np.frombuffer(sha1.digest(), dtype=np.uint8)
+        digest, _ = self._load_or_store(self.entry_path(filename, "content_sha1"),
+                                        content_hash)
+        return bytes(digest).hex()
+
+    def key_path(self, filenames, feature: str, params: tuple):
+        """
+        Entry for a feature of the contents of filenames, in order. The
+        librosa version is part of the key, features depend on its CQT.
+        """
+        key = repr((feature, params, self.dtype.str, librosa.__version__,
+                    [self.file_hash(x) for x in filenames]))
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def spectrogram(self, filenames, feature: str, params: tuple, compute):
+        """
+        compute() of filenames, e.g. their stacked log_cqt, served from the
+        store if present. Returned arrays are read only and of self.dtype.
+        """
+        return self.cached_entry(self.key_path(filenames, feature, params),
+                                 lambda: np.asarray(compute()).astype(self.dtype))
+
+    def mask(self, filenames, feature: str, params: tuple, compute):
+        """
+        Boolean compute() of filenames, e.g. a voice mask, served from the
+        store if present. Its second to last axis must be a multiple of 8.
+        """
+        def pack():
+            mask = np.asarray(compute(), dtype=bool)
+            if mask.shape[-2] % 8 != 0:
+                raise ValueError("Cannot pack {} rows into bytes".format(mask.shape[-2]))
+            return np.packbits(mask, axis=-2)
+        packed = self.cached_entry(self.key_path(filenames, feature, params), pack)
+        return np.unpackbits(packed, axis=-2).astype(bool)
+
+    def cached_entry(self, path: str, compute):
+        hits = self.hits
+        entry = super(FeatureStore, self).cached_entry(path, compute)
+        self.lookups[0 if self.hits > hits else 1] += 1
+        return entry
+
+    def take_lookups(self):
+        """
+        Feature hits and misses since the last call, which start again
+        from zero, e.g. for a worker to report them
+        """
+        hits, misses = self.lookups
+        self.lookups = [0, 0]
+        return hits, misses
+
+    def add_lookups(self, hits: int, misses: int):
+        """
+        Count feature lookups another process took
+        """
+        self.lookups[0] += hits
+        self.lookups[1] += misses
+
+    def stats(self):
+        """
+        Feature lookups of this process and those added to it, and the
+        size of the store
+        """
+        stats = super(FeatureStore, self).stats()
+        stats["hits"], stats["misses"] = self.lookups
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        stats["bytes_on_disk"] = self.bytes_on_disk()
+        return stats
+
+    def bytes_on_disk(self):
+        total_bytes = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy"):
+                try:
+                    total_bytes += os.stat(os.path.join(self.cache_dir, name)).st_size
+                except FileNotFoundError:  # Evicted by another process
+                    pass
+        return total_bytes
+
+
+def scene_log_cqt(store: FeatureStore, scene_dir: str):
+    """
+    NUM_MICS x Freq x Time log_cqt of a scene's mixed WAVs, through the store
+    """
+    filenames = sorted(glob.glob(os.path.join(scene_dir, "*_mixed.wav")))
+    return store.spectrogram(filenames, "log_cqt", CQT_PARAMS, lambda: multi_file_log_cqt(
+        filenames, sample_rate=FEATURE_SAMPLE_RATE))
+
+
+def scene_voice_mask(store: FeatureStore, scene_dir: str, num_backgrounds: int):
+    """
+    NUM_MICS x Freq x Time voice_mask of a scene's ground truth WAVs,
+    source 0 the voice, through the store
+    """
+    source_filenames = [sorted(glob.glob(os.path.join(
+        scene_dir, "*_source{:02d}_gt.wav".format(source_idx))))
+        for source_idx in range(num_backgrounds + 1)]
+
+    def compute():
+        voice_cqt, *bg_cqts = (multi_file_log_cqt(x, sample_rate=FEATURE_SAMPLE_RATE)
+                               for x in source_filenames)
+        return voice_mask(voice_cqt, bg_cqts)
+    return store.mask(sum(source_filenames, []), "voice_mask", CQT_PARAMS, compute)
+
+
+def wav_scene_dirs(data_dir: str):
+    """
+    Scene directories of a rendered dataset, merged parts included, that
+    hold WAVs. Sharded scenes have none.
+    """
+    if has_dataset_index(data_dir):
+        _, _, scenes = load_dataset_index(data_dir)
+        dirs = [os.path.join(part, "{:05d}".format(idx)) for idx, part in scenes]
+    else:
+        dirs = sorted(glob.glob(os.path.join(data_dir, "*")))
+    return [x for x in dirs if glob.glob(os.path.join(x, "*_mixed.wav"))]
+
+
+_worker_store = None
+
+
+def _init_worker(store_dir, max_bytes, dtype):
+    global _worker_store
+    _worker_store = FeatureStore(store_dir, max_bytes, dtype)
+
+
+def _precompute_worker(job):
+    """
+    Store one scene's features, returns the feature hits and misses it took
+    """
+    scene_dir, num_backgrounds = job
+    scene_log_cqt(_worker_store, scene_dir)
+    if num_backgrounds is not None:
+        scene_voice_mask(_worker_store, scene_dir, num_backgrounds)
+    return _worker_store.take_lookups()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Precompute the training features of a rendered dataset')
+    parser.add_argument("data_dir", type=str, help="Rendered dataset with WAV scene directories")
+    parser.add_argument("--store-dir", type=str, default=DEFAULT_STORE_DIR, help="Feature store directory")
+    parser.add_argument("--max-bytes", type=int, default=DEFAULT_STORE_BYTES, help="Byte budget of the store")
+    parser.add_argument("--float16", action="store_true", help="Store spectrograms as float16")
+    parser.add_argument("--num-backgrounds", type=int, default=None, help="Also store voice masks against this many backgrounds")
+    parser.add_argument("--num-workers", type=int, default=None, help="Processes, defaults to the core count")
+    args = parser.parse_args()
+
+    dtype = np.float16 if args.float16 else np.float32
+    jobs = [(x, args.num_backgrounds) for x in wav_scene_dirs(args.data_dir)]
+    hits, misses = 0, 0
+    with mp.Pool(args.num_workers, initializer=_init_worker,
+                 initargs=(args.store_dir, args.max_bytes, dtype)) as pool:
+        for job_hits, job_misses in pool.imap_unordered(_precompute_worker, jobs):
+            hits += job_hits
+            misses += job_misses
+    store = FeatureStore(args.store_dir, args.max_bytes, dtype)
+    print("Features of {} scenes: {} computed, {} already stored, {:.1f} MB on disk".format(
+        len(jobs), misses, hits, store.bytes_on_disk() / 2**20))
@@ -0,0 +1,51 @@
+"""
+Training features computed straight from rendered buffers, so the data
+loader only has to read arrays instead of decoding WAVs and running CQTs.
+"""
+import os
+
+import numpy as np
+
+from d3audiorecon.tools.utils import multi_channel_log_cqt, resample, \
+    voice_mask, FEATURE_SAMPLE_RATE
+
+MIXED_CQT_FILENAME = "mixed_cqt.npy"
+VOICE_MASK_FILENAME = "voice_mask.npy"
+
+
+def multi_mic_log_cqt(buffers, sample_rate: int):
+    """
+    NUM_MICS x Freq x Time log_cqt of num_mics x samples audio, resampled
+    to FEATURE_SAMPLE_RATE like SpatialAudioDataset does
+    """
+    return multi_channel_log_cqt(*resample(np.asarray(buffers, dtype=np.float32),
+                                           sample_rate, FEATURE_SAMPLE_RATE))
+
+
+def scene_features(mix, sources_gt, sample_rate: int):
+    """
+    Model input and separation target of one rendered scene
+
+    Args:
+        mix: num_mics x samples
+        sources_gt: num_mics x num_sources x samples, source 0 is the voice
+    Returns:
+        mixed log_cqt (NUM_MICS x Freq x Time) and voice mask (same shape, bool)
+    """
+    num_mics, num_sources, num_samples = sources_gt.shape
+    # The mix and every source in a single batch, source major
+    cqts = multi_mic_log_cqt(np.concatenate(
+        [mix, np.transpose(sources_gt, (1, 0, 2)).reshape(-1, num_samples)]),
+        sample_rate)
+    cqts = cqts.reshape((num_sources + 1, num_mics) + cqts.shape[1:])
+    return cqts[0], voice_mask(cqts[1], cqts[2:])
+
+
+def write_features(output_dir: str, mixed_cqt, mask):
+    np.save(os.path.join(output_dir, MIXED_CQT_FILENAME), mixed_cqt)
+    np.save(os.path.join(output_dir, VOICE_MASK_FILENAME), mask)
+
+
+def has_features(data_dir: str):
+    return os.path.isfile(os.path.join(data_dir, MIXED_CQT_FILENAME)) and \
+        os.path.isfile(os.path.join(data_dir, VOICE_MASK_FILENAME))
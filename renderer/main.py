@@ -1,128 +1,396 @@
 import argparse
 import os
 import json
-import random
-import multiprocessing.dummy as mp
+import time
+import multiprocessing as mp
 
 import numpy as np
-import librosa
 
-from d3audiorecon.renderer.classes import Microphone, SoundSource, Scene, \
+from d3audiorecon.renderer.classes import SoundSource, Scene, \
     INPUT_OUTPUT_TARGET_SAMPLE_RATE
+from d3audiorecon.renderer.mic_array import MicArray, DelayGainGrid
+from d3audiorecon.renderer.audio_cache import AudioCache, load_audio, \
+    DEFAULT_CACHE_DIR, DEFAULT_CACHE_BYTES
+from d3audiorecon.renderer.corpus import PackedCorpus, is_packed_corpus
+from d3audiorecon.renderer.trim_index import TrimIndex, has_trim_index, \
+    TRIM_INDEX_FILENAME
+from d3audiorecon.renderer.shards import ShardWriter, ShardReader, \
+    default_shard_name, is_sharded
+from d3audiorecon.renderer.features import scene_features, write_features
+from d3audiorecon.renderer.manifest import Manifest, \
+    scene_complete, scene_seed
+from d3audiorecon.renderer.partition import part_dir, in_partition
+from d3audiorecon.renderer.metadata_index import update_metadata_index, \
+    load_scene_metadata
+from d3audiorecon.renderer.reverb import ImpulseResponsePool
 
-POOL_SIZE = 25
+PROGRESS_INTERVAL = 100  # Report throughput every this many scenes
+LOOKUP_EXTENT = 10.0  # m, the lookup grid covers every random source position
 
 def generate_mic_array(args):
     """
     Generate a circular mic array with a fixed radius
     """
-    mic_array = []
-    radius = 0.3  # Mic array has radius 0.3m
-    for i in range(args.num_mics):
-        position_x = radius * np.cos(2 * np.pi / args.num_mics * i)
-        position_y = radius * np.sin(2 * np.pi / args.num_mics * i)
-        position_z = 0  # Assume planar for now
-        mic_array.append(Microphone([position_x, position_y, position_z]))
-    return mic_array
+    return MicArray.circular(args.num_mics)
+
+
+def generate_lookup(args):
+    """
+    Delay and gain grid of the mic array, or None to compute every
+    distance exactly
+    """
+    if args.lookup_resolution is None:
+        return None
+    return generate_mic_array(args).lookup_grid(
+        LOOKUP_EXTENT, INPUT_OUTPUT_TARGET_SAMPLE_RATE, args.lookup_resolution)
 
 
 def verify_args(args):
     """
-    Check that the input directories are valid
+    Check that the input directories are valid. Either may be a packed
+    corpus from renderer/corpus.py instead of a directory of files.
     """
+    voice_corpus, bg_corpus = open_corpora(args)
+
     # Voices dir
-    all_voices = os.listdir(args.voices_dir)
+    if voice_corpus is not None:
+        all_voices = sorted(voice_corpus.speakers)
+    else:
+        all_voices = sorted(x for x in os.listdir(args.voices_dir)
+                            if os.path.isdir(os.path.join(args.voices_dir, x)))
     if len(all_voices) == 0:
         raise ValueError("No directories found in {}".format(args.voices_dir))
     args.all_voices = all_voices
 
     # BG dir
-    all_bg_files = sorted(os.listdir(args.bg_sounds_dir))
+    if bg_corpus is not None:
+        all_bg_files = bg_corpus.backgrounds
+    else:
+        all_bg_files = sorted(x for x in os.listdir(args.bg_sounds_dir)
+                              if x != TRIM_INDEX_FILENAME)
     if len(all_bg_files) == 0:
         raise ValueError("No files found in {}".format(args.bg_sounds_dir))
     args.all_bg_files = all_bg_files
 
 
-def main(args):
-    verify_args(args)
+def open_corpora(args):
+    """
+    Open the packed corpora for voices and backgrounds, None for plain
+    directories. Both args may name the same corpus.
+    """
+    voice_corpus, bg_corpus = None, None
+    if is_packed_corpus(args.voices_dir):
+        voice_corpus = PackedCorpus(args.voices_dir)
+    if is_packed_corpus(args.bg_sounds_dir):
+        if voice_corpus is not None and \
+                os.path.samefile(args.voices_dir, args.bg_sounds_dir):
+            bg_corpus = voice_corpus
+        else:
+            bg_corpus = PackedCorpus(args.bg_sounds_dir)
+    return voice_corpus, bg_corpus
+
+
+def open_trim_indexes(args):
+    """
+    Trim bounds from renderer/trim_index.py for the voices and backgrounds
+    directories, None where there are none
+    """
+    return tuple(TrimIndex(x) if has_trim_index(x) else None
+                 for x in (args.voices_dir, args.bg_sounds_dir))
+
+
+def open_scene_inputs(args):
+    """
+    Everything synthesize_scene reads besides args, opened once per
+    process: the audio cache, packed corpora, trim indexes, impulse
+    responses and lookup grid. Returned as synthesize_scene kwargs.
+    """
+    voice_corpus, bg_corpus = open_corpora(args)  # memmaps are opened per process
+    cache = None
+    if args.audio_cache_bytes > 0:
+        cache = AudioCache(args.audio_cache_dir, args.audio_cache_bytes)
+    impulse_responses = None
+    if args.impulse_responses is not None:
+        impulse_responses = ImpulseResponsePool(
+            ir_dir=args.impulse_responses, sample_rate=INPUT_OUTPUT_TARGET_SAMPLE_RATE)
+    return {
+        "cache": cache,
+        "voice_corpus": voice_corpus,
+        "bg_corpus": bg_corpus,
+        "impulse_responses": impulse_responses,
+        "lookup": generate_lookup(args),
+        "trim_indexes": open_trim_indexes(args),
+    }
 
-    # Render a large number of scenes
-    def generate_sample(data_sample_idx):
-        mic_array = generate_mic_array(args)
-        print(data_sample_idx)
-        metadata = {}
-        all_sources = []
 
-        # First generate the voice
-        random_voice_dir = os.path.join(args.voices_dir, random.choice(args.all_voices))
+def synthesize_scene(args, data_sample_idx, output_data_dir=None,
+                     cache: AudioCache = None,
+                     voice_corpus: PackedCorpus = None,
+                     bg_corpus: PackedCorpus = None,
+                     impulse_responses: ImpulseResponsePool = None,
+                     lookup: DelayGainGrid = None,
+                     trim_indexes=(None, None)):
+    """
+    Pick and place the sources of one scene from its seed and render it.
+    Returns the rendered Scene and its metadata. output_data_dir is only
+    recorded in the metadata.
+    trim_indexes are the voice and background TrimIndex, if any.
+    """
+    seed = scene_seed(args.seed, data_sample_idx)
+    rng = np.random.RandomState(seed)
+    np.random.seed(seed)  # Anything drawing from the global state, e.g. render
+
+    mic_array = generate_mic_array(args).microphones()
+    metadata = {}
+    all_sources = []
+
+    # First generate the voice
+    random_voice = rng.choice(args.all_voices)
+    if voice_corpus is not None:
+        voice_files = voice_corpus.speakers[random_voice]
+    else:
+        random_voice_dir = os.path.join(args.voices_dir, random_voice)
         voice_files = sorted(os.listdir(random_voice_dir))
 
-        starting_voice_file = random.randint(0, len(voice_files) - args.num_voices_concat)
-        voice_files = voice_files[starting_voice_file:starting_voice_file + args.num_voices_concat]
+    starting_voice_file = rng.randint(0, len(voice_files) - args.num_voices_concat + 1)
+    voice_files = voice_files[starting_voice_file:starting_voice_file + args.num_voices_concat]
+    if voice_corpus is None:
         voice_files = [os.path.join(random_voice_dir, x) for x in voice_files]
 
-        # Data dir is 5 digit sequential numerical
-        output_data_dir = os.path.join(args.output_dir, "{:05d}".format(data_sample_idx))
-        if not os.path.exists(output_data_dir):
-            os.makedirs(output_data_dir)
+    # Generate random positions for the voice
+    random_x, random_y = rng.uniform(-5.0, 5.0, 2)
+    sound_source_voice = SoundSource([random_x, random_y, 0.0], voice_files,
+                                     cache=cache, corpus=voice_corpus,
+                                     trim_index=trim_indexes[0])
+    all_sources.append(sound_source_voice)
+    metadata["source00"] = {
+        "position" : [random_x, random_y, 0.0],
+        "filename" : os.path.join(output_data_dir, "gt_voice.wav")
+        if output_data_dir is not None else voice_files,
+        "gain" : 1.0
+    }
+    
 
-        # Generate random positions for the voice
-        random_x, random_y = np.random.uniform(-5.0, 5.0, 2)
-        sound_source_voice = SoundSource([random_x, random_y, 0.0], voice_files)
-        all_sources.append(sound_source_voice)
-        metadata["source00"] = {
-            "position" : [random_x, random_y, 0.0],
-            "filename" : os.path.join(output_data_dir, "gt_voice.wav")
-        }
-        
+    # Generate a number of background sources
+    for bg_source_idx in range(args.num_backgrounds):
+        bg_file = rng.choice(args.all_bg_files)
 
-        # Generate a number of background sources
-        for bg_source_idx in range(args.num_backgrounds):
-            bg_file = random.choice(args.all_bg_files)
-
-            # We start by using this music file
-            bg_data, bg_sr = librosa.core.load(
+        # We start by using this music file
+        if bg_corpus is not None:
+            # Trim bounds are stored, trimming is the same before the reduce factor
+            bg_data, bg_sr = bg_corpus.load(bg_file, trim=True)
+        else:
+            bg_data, bg_sr = load_audio(
                 os.path.join(args.bg_sounds_dir, bg_file),
                 sr=INPUT_OUTPUT_TARGET_SAMPLE_RATE,
-                mono=True,
+                cache=cache,
             )
-            bg_data *= args.bg_reduce_factor  # Quiet the background
-
-            random_x, random_y = np.random.uniform(-10.0, 10.0, 2)
-            sound_source_bg = SoundSource(
-                [random_x, random_y, 0.0],
-                data=bg_data,
-                sr=bg_sr)
-            all_sources.append(sound_source_bg)
-            metadata["source{:02d}".format(bg_source_idx + 1)] = {
-                "position" : [random_x, random_y, 0.0],
-                "filename" : os.path.join(args.bg_sounds_dir, bg_file)
-            }
-
-        scene = Scene(all_sources, mic_array)
-        scene.render(cutoff_time=args.scene_duration)
-
-        # Write every mic buffer to outputs
-        for i, mic in enumerate(mic_array):
-            output_prefix = os.path.join(output_data_dir, "mic{:02d}_".format(i))
-            mic.save(output_prefix)
-            mic.reset()
-
-        metadata_file = os.path.join(output_data_dir, "metadata.json")
-        with open(metadata_file, "w") as f:
-            json.dump(metadata, f, indent=4)
-        # scene.render_binaural([0, 4], os.path.join(OUTPUT_DIR, "stereo.wav"), cutoff_time=6)
-
-    # Multi-threading
-    pool = mp.Pool(POOL_SIZE)
-    pool.map(generate_sample, range(args.num_scenes))
-    pool.close()
-    pool.join()
+        bg_data = bg_data * args.bg_reduce_factor  # Quiet the background
+        trimmed = bg_corpus is not None
+        if not trimmed and trim_indexes[1] is not None:
+            bounds = trim_indexes[1].bounds(
+                os.path.join(args.bg_sounds_dir, bg_file), bg_sr, len(bg_data))
+            if bounds is not None:
+                bg_data = bg_data[bounds[0]:bounds[1]]
+                trimmed = True
 
-if __name__ == "__main__":
+        random_x, random_y = rng.uniform(-10.0, 10.0, 2)
+        sound_source_bg = SoundSource(
+            [random_x, random_y, 0.0],
+            data=bg_data,
+            sr=bg_sr,
+            trim_silence=not trimmed)
+        all_sources.append(sound_source_bg)
+        metadata["source{:02d}".format(bg_source_idx + 1)] = {
+            "position" : [random_x, random_y, 0.0],
+            "filename" : bg_file if bg_corpus is not None
+            else os.path.join(args.bg_sounds_dir, bg_file),
+            "gain" : args.bg_reduce_factor
+        }
+
+    scene = Scene(all_sources, mic_array)
+    scene.render(cutoff_time=args.scene_duration, random_reverb=args.reverb,
+                 impulse_responses=impulse_responses, lookup=lookup)
+
+    return scene, metadata
+
+
+def generate_sample(args, data_sample_idx, shard_writer: ShardWriter = None,
+                    **scene_inputs):
+    """
+    Render one scene to args.output_dir/<data_sample_idx>, or append it
+    to shard_writer if one is given. With args.features the model inputs
+    and separation mask are also written to the scene directory.
+    scene_inputs are passed to synthesize_scene. Returns the scene's
+    metadata.
+    """
+    # Data dir is 5 digit sequential numerical
+    output_data_dir = os.path.join(args.output_dir, "{:05d}".format(data_sample_idx))
+    if shard_writer is None or args.features:
+        os.makedirs(output_data_dir, exist_ok=True)
+
+    scene, metadata = synthesize_scene(args, data_sample_idx, output_data_dir,
+                                       **scene_inputs)
+
+    if args.features:
+        mixed_cqt, mask = scene_features(scene.mix, scene.sources_gt,
+                                         scene.sample_rate)
+        write_features(output_data_dir, mixed_cqt, mask)
+
+    if shard_writer is not None:
+        shard_writer.write(data_sample_idx, scene.mix, scene.sources_gt,
+                           scene.sample_rate, metadata)
+        if not args.features:
+            return metadata
+
+    # Write every mic buffer to outputs
+    elif args.output_format == "wav":
+        scene.result().write_wavs(output_data_dir)
+
+    metadata_file = os.path.join(output_data_dir, "metadata.json")
+    with open(metadata_file, "w") as f:
+        json.dump(metadata, f, indent=4)
+    # scene.result().write_stereo(os.path.join(output_data_dir, "stereo.wav"), 0, 4)
+    return metadata
+
+
+# Each worker process gets the parsed args once instead of with every task
+_worker_args = None
+_worker_inputs = {}
+_worker_shard = None
+
+
+def _init_worker(args):
+    global _worker_args, _worker_inputs, _worker_shard
+    _worker_args = args
+    _worker_inputs = open_scene_inputs(args)
+    if args.output_format == "shards":
+        # Every worker streams into its own shard
+        _worker_shard = ShardWriter(os.path.join(args.output_dir,
+                                                 default_shard_name()))
+
+
+def _generate_sample_worker(data_sample_idx):
+    metadata = generate_sample(_worker_args, data_sample_idx,
+                               shard_writer=_worker_shard, **_worker_inputs)
+    cache = _worker_inputs["cache"]
+    cache_stats = cache.stats() if cache is not None else None
+    return data_sample_idx, os.getpid(), cache_stats, metadata
+
+
+def report_progress(num_done: int, num_total: int, start_time: float):
+    """
+    Print completed scenes, aggregate scenes/sec and remaining time
+    """
+    elapsed = time.time() - start_time
+    rate = num_done / elapsed if elapsed > 0 else 0.0
+    remaining = (num_total - num_done) / rate if rate > 0 else float("inf")
+    print("{}/{} scenes, {:.2f} scenes/sec, {:.0f}s elapsed, {:.0f}s remaining".format(
+        num_done, num_total, rate, elapsed, remaining), flush=True)
+
+
+def report_cache(worker_cache_stats):
+    """
+    Print audio cache counters summed over all workers
+    """
+    if not worker_cache_stats:
+        return
+    totals = {key: sum(stats[key] for stats in worker_cache_stats.values())
+              for key in ("hits", "misses", "evictions")}
+    lookups = totals["hits"] + totals["misses"]
+    if lookups == 0:
+        return
+    hit_rate = 100.0 * totals["hits"] / lookups
+    print("Audio cache: {} hits, {} misses ({:.1f}% hit rate), {} evictions".format(
+        totals["hits"], totals["misses"], hit_rate, totals["evictions"]))
+
+
+def open_manifest(args):
+    """
+    Load the output directory's manifest, checking that it was rendered
+    with the same seed, inputs and scene settings, or start a new one
+    """
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = Manifest.from_args(args)
+    if os.path.exists(manifest.path):
+        existing = Manifest.load(manifest.path)
+        existing.check_compatible(manifest)
+        existing.num_scenes = max(existing.num_scenes, args.num_scenes)
+        # Written by older runs without it, the inputs are checked unchanged
+        existing.portable_fingerprint = manifest.portable_fingerprint
+        manifest = existing
+    manifest.save()
+    return manifest
+
+
+def main(args):
+    verify_args(args)
+    if args.output_format == "none" and not args.features:
+        raise ValueError("--output-format none writes nothing without --features")
+    if args.num_workers is None:
+        args.num_workers = os.cpu_count()
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError("--shard-index must be in [0, --num-shards)")
+    if args.num_shards > 1:
+        # Every node writes its own part, combined later by renderer/partition.py
+        args.output_dir = part_dir(args.output_dir, args.shard_index)
+    manifest = open_manifest(args)
+
+    # Explicitly requested scenes are always rendered, otherwise skip
+    # anything whose outputs are all there. The manifest is saved every
+    # PROGRESS_INTERVAL scenes, so after a crash it can miss scenes that
+    # are complete on disk, e.g. in a shard. Those are not rendered again.
+    rendered = {}  # Metadata of the scenes of this run, for the metadata index
+    if args.scenes is not None:
+        outside = [idx for idx in args.scenes
+                   if not in_partition(idx, args.shard_index, args.num_shards)]
+        if outside:
+            raise ValueError("Scenes {} belong to other shards than {} of {}".format(
+                outside, args.shard_index, args.num_shards))
+        scene_idxs = args.scenes
+    else:
+        shards = ShardReader(args.output_dir) if is_sharded(args.output_dir) else None
+        shard_scenes = set(shards.entries) if shards is not None else set()
+        partition_idxs = [idx for idx in range(args.num_scenes)
+                          if in_partition(idx, args.shard_index, args.num_shards)]
+        scene_idxs = []
+        for idx in partition_idxs:
+            if not scene_complete(args.output_dir, manifest.params, idx, shard_scenes):
+                scene_idxs.append(idx)
+            elif idx not in manifest.completed:
+                # Never indexed either, the run that rendered it did not finish
+                manifest.completed.add(idx)
+                rendered[idx] = load_scene_metadata(args.output_dir, idx, shards)
+        print("{} of {} scenes already rendered".format(
+            len(partition_idxs) - len(scene_idxs), len(partition_idxs)))
+
+    # Render a large number of scenes across processes, scenes arrive in any order
+    start_time = time.time()
+    num_done = 0
+    worker_cache_stats = {}  # Latest cumulative counters per worker pid
+    try:
+        with mp.Pool(args.num_workers, initializer=_init_worker, initargs=(args,)) as pool:
+            for idx, pid, cache_stats, metadata in pool.imap_unordered(
+                    _generate_sample_worker, scene_idxs, chunksize=args.chunk_size):
+                num_done += 1
+                manifest.completed.add(idx)
+                rendered[idx] = metadata
+                if cache_stats is not None:
+                    worker_cache_stats[pid] = cache_stats
+                if num_done % PROGRESS_INTERVAL == 0:
+                    manifest.save()
+                    report_progress(num_done, len(scene_idxs), start_time)
+    finally:
+        manifest.save()
+    report_progress(num_done, len(scene_idxs), start_time)
+    report_cache(worker_cache_stats)
+    update_metadata_index(args.output_dir, rendered.items())
+
+
+def build_arg_parser():
     parser = argparse.ArgumentParser(description='Render sounds to a mic array')
-    parser.add_argument("voices_dir", type=str, help="Path to voices dir from VCTK dataset")
-    parser.add_argument("bg_sounds_dir", type=str, help="Path to background sounds (non voices")
+    parser.add_argument("voices_dir", type=str, help="Path to voices dir from VCTK dataset, or a packed corpus")
+    parser.add_argument("bg_sounds_dir", type=str, help="Path to background sounds (non voices), or a packed corpus")
     parser.add_argument("output_dir", type=str, help="Path to output results")
     parser.add_argument("--num-scenes", type=int, default=1000, help="Number of scenes to render")
     parser.add_argument("--num-mics", type=int, default=8, help="Number of mics, default config is a circle")
@@ -130,6 +398,22 @@ if __name__ == "__main__":
     parser.add_argument("--num-backgrounds", type=int, default=3, help="Number of background sounds per scene")
     parser.add_argument("--bg-reduce-factor", type=float, default=0.5, help="Reduce the volume of the background")
     parser.add_argument("--num-voices-concat", type=int, default=3, help="Number of voice files to concatenate as foreground")
+    parser.add_argument("--num-workers", type=int, default=None, help="Number of render processes, defaults to the core count")
+    parser.add_argument("--chunk-size", type=int, default=4, help="Scenes handed to a worker at a time")
+    parser.add_argument("--output-format", type=str, default="wav", choices=("wav", "shards", "none"), help="A directory of WAVs per scene, append-only shards of many scenes, or no audio (with --features)")
+    parser.add_argument("--features", action="store_true", help="Also write the log-CQT model inputs and voice mask of every scene")
+    parser.add_argument("--reverb", action="store_true", help="Convolve every source with a room response")
+    parser.add_argument("--impulse-responses", type=str, default=None, help="Directory of impulse responses to draw reverb from, synthetic if not given")
+    parser.add_argument("--lookup-resolution", type=float, default=None, help="Interpolate mic distances from a grid with this spacing (m) instead of computing them, e.g. 0.05")
+    parser.add_argument("--audio-cache-dir", type=str, default=DEFAULT_CACHE_DIR, help="Shared decoded audio cache, ideally on tmpfs")
+    parser.add_argument("--audio-cache-bytes", type=int, default=DEFAULT_CACHE_BYTES, help="Byte budget of the audio cache, 0 disables it")
+    parser.add_argument("--seed", type=int, default=0, help="Run seed, every scene's RNG is derived from it and the scene index")
+    parser.add_argument("--shard-index", type=int, default=0, help="Index of this node when splitting the scenes across nodes")
+    parser.add_argument("--num-shards", type=int, default=1, help="Number of nodes the scenes are split across, each renders every num-shards'th scene into output_dir/part-XXXX")
+    parser.add_argument("--scenes", type=lambda x: [int(idx) for idx in x.split(",")], default=None, help="Comma separated scene indices of this shard to (re)render, e.g. 3,17")
+    return parser
 
-    main(parser.parse_args())
+
+if __name__ == "__main__":
+    main(build_arg_parser().parse_args())
 
@@ -0,0 +1,171 @@
+"""
+Generation manifest: what a dataset directory was rendered from and which
+scenes are done, so interrupted or extended runs only render what is
+missing and any scene can be regenerated exactly from its index.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from d3audiorecon.renderer.corpus import is_packed_corpus, INDEX_FILENAME, \
+    AUDIO_FILENAME
+from d3audiorecon.renderer.features import has_features
+from d3audiorecon.renderer.trim_index import TrimIndex, has_trim_index, \
+    TRIM_INDEX_FILENAME
+
+MANIFEST_FILENAME = "manifest.json"
+
+# Args that change the content or layout of a scene. Reruns into the same
+# output directory must match them
+RENDER_PARAMS = ("num_mics", "scene_duration", "num_backgrounds",
+                 "bg_reduce_factor", "num_voices_concat", "output_format",
+                 "features", "reverb", "impulse_responses", "lookup_resolution",
+                 "shard_index", "num_shards")
+
+
+def corpus_fingerprint(*paths, mtimes=True):
+    """
+    Hash of the names, sizes and mtimes of every input file. A packed
+    corpus is identified by its index and blob instead. A trim index
+    counts by its bounds, since it changes how concatenated voices are
+    trimmed. Without mtimes the hash is the same for copies of the
+    corpus on other nodes.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        if is_packed_corpus(path):
+            files = [os.path.join(path, INDEX_FILENAME),
+                     os.path.join(path, AUDIO_FILENAME)]
+        else:
+            # Its file holds mtimes, the index counts by its bounds below
+            files = sorted(os.path.join(root, name)
+                           for root, _, names in os.walk(path)
+                           for name in names if name != TRIM_INDEX_FILENAME)
+        for filename in files:
+            stat = os.stat(filename)
+            digest.update("{}\0{}\0{}\n".format(
+                os.path.relpath(filename, path), stat.st_size,
+                stat.st_mtime_ns if mtimes else "").encode())
+        if not is_packed_corpus(path) and has_trim_index(path):
+            digest.update(TrimIndex(path).fingerprint().encode())
+    return digest.hexdigest()
+
+
+def scene_seed(seed: int, data_sample_idx: int):
+    """
+    RNG seed for one scene, derived only from the run seed and scene index
+    so the output does not depend on which worker renders it
+    """
+    return int(np.random.SeedSequence([seed, data_sample_idx]).generate_state(1)[0])
+
+
+def scene_complete(output_dir: str, params: dict, data_sample_idx: int,
+                   shard_scenes):
+    """
+    Whether every output of a scene rendered with params is on disk.
+    metadata.json is written last, so its presence means the scene
+    directory is complete. shard_scenes are the scenes in output_dir's shards.
+    """
+    if params["output_format"] == "shards":
+        if data_sample_idx not in shard_scenes:
+            return False
+        if not params["features"]:
+            return True
+
+    output_data_dir = os.path.join(output_dir, "{:05d}".format(data_sample_idx))
+    if not os.path.isfile(os.path.join(output_data_dir, "metadata.json")):
+        return False
+    if params["features"] and not has_features(output_data_dir):
+        return False
+    if params["output_format"] == "wav":
+        expected = ["mixed.wav"] + ["source{:02}_gt.wav".format(idx)
+                                    for idx in range(params["num_backgrounds"] + 1)]
+        for i in range(params["num_mics"]):
+            output_prefix = os.path.join(output_data_dir, "mic{:02d}_".format(i))
+            if not all(os.path.isfile(output_prefix + x) for x in expected):
+                return False
+    return True
+
+
+class Manifest(object):
+    def __init__(self, path: str, seed: int, fingerprint: str, params: dict,
+                 num_scenes: int = 0, completed=(), portable_fingerprint=None):
+        """
+        Args:
+            path: manifest file, usually output_dir/manifest.json
+            seed: run seed every scene seed is derived from
+            fingerprint: corpus_fingerprint of the inputs, checked on resume
+            params: RENDER_PARAMS values
+            completed: indices of scenes that finished rendering
+            portable_fingerprint: corpus_fingerprint without mtimes,
+                checked when merging parts rendered from corpus copies
+        """
+        self.path = path
+        self.seed = seed
+        self.fingerprint = fingerprint
+        self.portable_fingerprint = portable_fingerprint
+        self.params = params
+        self.num_scenes = num_scenes
+        self.completed = set(completed)
+
+    @classmethod
+    def from_args(cls, args):
+        params = {name: getattr(args, name) for name in RENDER_PARAMS}
+        inputs = (args.voices_dir, args.bg_sounds_dir)
+        return cls(os.path.join(args.output_dir, MANIFEST_FILENAME), args.seed,
+                   corpus_fingerprint(*inputs), params, args.num_scenes,
+                   portable_fingerprint=corpus_fingerprint(*inputs, mtimes=False))
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            state = json.load(f)
+        return cls(path, state["seed"], state["corpus_fingerprint"],
+                   state["params"], state["num_scenes"], state["completed"],
+                   state.get("portable_fingerprint"))
+
+    def check_compatible(self, other, ignore=(), portable=False):
+        """
+        Raise if other would render different scenes into the same
+        directory. Params in ignore may differ. With portable, inputs are
+        compared without mtimes, e.g. for parts rendered on other nodes
+        """
+        differences = []
+        if self.seed != other.seed:
+            differences.append("seed {} != {}".format(self.seed, other.seed))
+        if portable:
+            if self.portable_fingerprint is None or \
+                    self.portable_fingerprint != other.portable_fingerprint:
+                differences.append("input corpus differs")
+        elif self.fingerprint != other.fingerprint:
+            differences.append("input corpus changed")
+        for name in RENDER_PARAMS:
+            if name in ignore:
+                continue
+            if self.params.get(name) != other.params.get(name):
+                differences.append("{} {} != {}".format(
+                    name, self.params.get(name), other.params.get(name)))
+        if differences:
+            raise ValueError("{} was rendered with different settings: {}".format(
+                self.path, ", ".join(differences)))
+
+    def save(self):
+        """
+        Write atomically, a crash leaves the previous manifest intact
+        """
+        state = {
+            "seed": self.seed,
+            "corpus_fingerprint": self.fingerprint,
+            "portable_fingerprint": self.portable_fingerprint,
+            "params": self.params,
+            "num_scenes": self.num_scenes,
+            "completed": sorted(self.completed),
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
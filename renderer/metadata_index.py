@@ -0,0 +1,225 @@
+"""
+Columnar metadata of a whole dataset: per scene seeds and per source
+positions, gains and files as arrays in one file, so labels and dataset
+statistics do not need a metadata.json per scene.
+
+renderer/main.py adds the scenes of every run to the index, and
+renderer/partition.py indexes merged parts. To rebuild it from scratch:
+
+Usage: python -m d3audiorecon.renderer.metadata_index data_dir
+"""
+import argparse
+import os
+import json
+
+import numpy as np
+
+from d3audiorecon.renderer.manifest import Manifest, MANIFEST_FILENAME, \
+    scene_seed
+from d3audiorecon.renderer.partition import has_dataset_index, \
+    load_dataset_index
+from d3audiorecon.renderer.shards import ShardReader, is_sharded
+
+METADATA_INDEX_FILENAME = "metadata_index.npz"
+UNKNOWN_SEED = -1
+
+
+def scene_metadata(data_dir: str):
+    """
+    (scene idx, metadata dict) of every scene of a rendered dataset:
+    scene directories, shards, or parts merged by renderer/partition.py
+    """
+    if has_dataset_index(data_dir):
+        output_format, part_dirs, scenes = load_dataset_index(data_dir)
+        shards = ShardReader(part_dirs) if output_format == "shards" else None
+        for idx, part in scenes:
+            yield idx, load_scene_metadata(part, idx, shards)
+        return
+
+    if is_sharded(data_dir):
+        shards = ShardReader(data_dir)
+        for idx in shards.scene_idxs:
+            yield idx, shards.entries[idx][1]["metadata"]
+        return
+
+    for name in sorted(os.listdir(data_dir)):
+        metadata_file = os.path.join(data_dir, name, "metadata.json")
+        if name.isdigit() and os.path.isfile(metadata_file):
+            with open(metadata_file) as f:
+                yield int(name), json.load(f)
+
+
+def load_scene_metadata(data_dir: str, scene_idx: int, shards: ShardReader = None):
+    """
+    Metadata of one scene, from its entry in shards if it has one or from
+    data_dir/<scene_idx>/metadata.json
+    """
+    if shards is not None and scene_idx in shards.entries:
+        return shards.entries[scene_idx][1]["metadata"]
+    with open(os.path.join(data_dir, "{:05d}".format(scene_idx), "metadata.json")) as f:
+        return json.load(f)
+
+
+def run_seed(data_dir: str):
+    """
+    Seed the dataset was rendered with, from its (first part's) manifest
+    """
+    paths = [os.path.join(data_dir, MANIFEST_FILENAME)]
+    if has_dataset_index(data_dir):
+        paths += [os.path.join(x, MANIFEST_FILENAME)
+                  for x in load_dataset_index(data_dir)[1]]
+    for path in paths:
+        if os.path.isfile(path):
+            return Manifest.load(path).seed
+    return None
+
+
+def build_metadata_index(data_dir: str):
+    """
+    Collect the metadata of every scene into data_dir/metadata_index.npz.
+    Scenes with fewer sources are padded with nan positions and gains
+    and empty filenames.
+    """
+    scenes = sorted(scene_metadata(data_dir), key=lambda x: x[0])
+    _write_index(data_dir, _index_arrays(scenes, run_seed(data_dir)))
+    return len(scenes)
+
+
+def update_metadata_index(data_dir: str, scenes):
+    """
+    Add (scene idx, metadata dict) pairs to data_dir/metadata_index.npz,
+    replacing rows of the same scenes, without reading the metadata of
+    any other scene. Builds the whole index if there is none yet.
+    Returns the number of indexed scenes.
+    """
+    if not has_metadata_index(data_dir):
+        return build_metadata_index(data_dir)
+    new = _index_arrays(sorted(scenes, key=lambda x: x[0]), run_seed(data_dir))
+    with np.load(os.path.join(data_dir, METADATA_INDEX_FILENAME)) as index:
+        old = {key: index[key] for key in index.files}
+
+    keep = ~np.isin(old["scenes"], new["scenes"])
+    num_sources = max(old["gains"].shape[1], new["gains"].shape[1])
+    arrays = {}
+    for key, fill in (("scenes", None), ("seeds", None), ("positions", np.nan),
+                      ("gains", np.nan), ("filenames", "")):
+        parts = [old[key][keep], new[key]]
+        if fill is not None:
+            parts = [_pad_sources(x, num_sources, fill) for x in parts]
+        arrays[key] = np.concatenate(parts)
+    order = np.argsort(arrays["scenes"], kind="stable")
+    _write_index(data_dir, {key: value[order] for key, value in arrays.items()})
+    return len(order)
+
+
+def _index_arrays(scenes, seed):
+    """
+    Index arrays of (scene idx, metadata dict) pairs sorted by scene idx
+    """
+    num_sources = max((len(metadata) for _, metadata in scenes), default=0)
+    scene_idxs = np.array([idx for idx, _ in scenes], dtype=np.int64)
+    seeds = np.array([scene_seed(seed, idx) if seed is not None else UNKNOWN_SEED
+                      for idx in scene_idxs], dtype=np.int64)
+    positions = np.full((len(scenes), num_sources, 3), np.nan)
+    gains = np.full((len(scenes), num_sources), np.nan)
+    filenames = [[""] * num_sources for _ in scenes]
+    for row, (_, metadata) in enumerate(scenes):
+        for source_idx in range(len(metadata)):
+            source = metadata["source{:02d}".format(source_idx)]
+            positions[row, source_idx] = source["position"]
+            gains[row, source_idx] = source.get("gain", np.nan)
+            filename = source["filename"]
+            # Concatenated voices are a list of files
+            filenames[row][source_idx] = filename if isinstance(filename, str) \
+                else os.pathsep.join(filename)
+    return {"scenes": scene_idxs, "seeds": seeds, "positions": positions,
+            "gains": gains, "filenames": np.array(filenames, dtype=str).reshape(
+                len(scenes), num_sources)}
+
+
+def _pad_sources(array, num_sources: int, fill):
+    """
+    array with its sources axis (the second) padded to num_sources with fill
+    """
+    pad = [(0, 0)] * array.ndim
+    pad[1] = (0, num_sources - array.shape[1])
+    return np.pad(array, pad, constant_values=fill)
+
+
+def _write_index(data_dir: str, arrays):
+    path = os.path.join(data_dir, METADATA_INDEX_FILENAME)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+def has_metadata_index(data_dir: str):
+    return os.path.isfile(os.path.join(data_dir, METADATA_INDEX_FILENAME))
+
+
+class MetadataIndex(object):
+    def __init__(self, data_dir: str):
+        """
+        Metadata of every scene as arrays, rows sorted by scene index
+        """
+        with np.load(os.path.join(data_dir, METADATA_INDEX_FILENAME)) as index:
+            self.scenes = index["scenes"]
+            self.seeds = index["seeds"]
+            self.positions = index["positions"]  # scenes x sources x 3
+            self.gains = index["gains"]  # scenes x sources
+            self.filenames = index["filenames"]  # scenes x sources
+
+    def __len__(self):
+        return len(self.scenes)
+
+    def rows(self, scene_idxs):
+        """
+        Row of every scene index, raises KeyError for unindexed scenes
+        """
+        scene_idxs = np.asarray(scene_idxs)
+        rows = np.searchsorted(self.scenes, scene_idxs)
+        rows = np.minimum(rows, len(self.scenes) - 1)
+        if len(self.scenes) == 0 or np.any(self.scenes[rows] != scene_idxs):
+            raise KeyError("Scenes missing from the metadata index")
+        return rows
+
+    def directions(self, scene_idxs=None, source_idx: int = 0):
+        """
+        Angle in radians (-pi to pi) of one source of every scene
+        """
+        positions = self.positions[:, source_idx] if scene_idxs is None else \
+            self.positions[self.rows(scene_idxs), source_idx]
+        return np.arctan2(positions[:, 1], positions[:, 0])
+
+    def direction_bins(self, num_bins: int, scene_idxs=None, source_idx: int = 0):
+        """
+        Directional bin of one source of every scene, as in direction_labels
+        """
+        angles = self.directions(scene_idxs, source_idx)
+        return np.floor((angles + np.pi) * num_bins / (2 * np.pi)).astype(np.int64)
+
+    def metadata(self, scene_idx: int):
+        """
+        One scene's metadata in the metadata.json layout
+        """
+        row = self.rows([scene_idx])[0]
+        metadata = {}
+        for source_idx in range(self.positions.shape[1]):
+            if np.isnan(self.positions[row, source_idx, 0]):
+                continue
+            filename = str(self.filenames[row, source_idx])
+            metadata["source{:02d}".format(source_idx)] = {
+                "position": self.positions[row, source_idx].tolist(),
+                "filename": filename.split(os.pathsep) if os.pathsep in filename
+                else filename,
+                "gain": float(self.gains[row, source_idx]),
+            }
+        return metadata
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Index the metadata of every scene of a rendered dataset')
+    parser.add_argument("data_dir", type=str, help="Rendered dataset directory")
+    args = parser.parse_args()
+
+    print("Indexed {} scenes".format(build_metadata_index(args.data_dir)))
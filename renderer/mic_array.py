@@ -0,0 +1,181 @@
+"""
+Mic array geometries with precomputed per-mic delay and gain grids, so
+many source or candidate positions can be placed with a bulk lookup
+instead of a norm, delay and attenuation per (source, mic) pair.
+"""
+import numpy as np
+
+from d3audiorecon.renderer.constants import SPEED_OF_SOUND, ATTENUATION_ALPHA
+from d3audiorecon.renderer.classes import Microphone
+
+DEFAULT_RADIUS = 0.3  # m, radius of the circular array used so far
+DEFAULT_GRID_RESOLUTION = 0.05  # m between grid points
+MIN_GRID_DISTANCE = 1e-3  # m, keeps gains finite on top of a mic
+
+
+class MicArray(object):
+    def __init__(self, positions):
+        """
+        Arbitrary 3D layout.
+
+        Args:
+            positions: num_mics x 3 mic positions in meters
+        """
+        self.positions = np.array(positions, dtype=np.float64).reshape(-1, 3)
+
+    @classmethod
+    def circular(cls, num_mics: int, radius: float = DEFAULT_RADIUS,
+                 center=(0.0, 0.0, 0.0)):
+        """
+        Planar circle in the xy plane, mic 0 on the +x axis
+        """
+        angles = 2 * np.pi / num_mics * np.arange(num_mics)
+        positions = np.stack([radius * np.cos(angles),
+                              radius * np.sin(angles),
+                              np.zeros(num_mics)], axis=1)
+        return cls(positions + np.array(center))
+
+    @classmethod
+    def linear(cls, num_mics: int, spacing: float, center=(0.0, 0.0, 0.0),
+               axis=(1.0, 0.0, 0.0)):
+        """
+        Evenly spaced line through center along axis
+        """
+        axis = np.array(axis, dtype=np.float64)
+        axis /= np.linalg.norm(axis)
+        offsets = spacing * (np.arange(num_mics) - (num_mics - 1) / 2.0)
+        return cls(np.array(center) + offsets[:, None] * axis[None, :])
+
+    def __len__(self):
+        return len(self.positions)
+
+    def microphones(self):
+        """
+        One Microphone per position, for building a Scene
+        """
+        return [Microphone(list(position)) for position in self.positions]
+
+    def distances(self, points):
+        """
+        num_points x num_mics exact distances from points (num_points x 3)
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        diff = points[:, None, :] - self.positions[None, :, :]
+        # Same dot product as Scene.distances so exact renders do not change
+        return np.sqrt((diff[..., None, :] @ diff[..., :, None])[..., 0, 0])
+
+    def delays_gains(self, points, sample_rate: int):
+        """
+        num_points x num_mics delays in samples and amplitude gains
+        (spherical spreading and absorption, as in Scene.render)
+        """
+        return delays_gains(self.distances(points), sample_rate)
+
+    def lookup_grid(self, extent, sample_rate: int,
+                    resolution: float = DEFAULT_GRID_RESOLUTION,
+                    height: float = 0.0):
+        """
+        Precompute delays and gains on a regular xy grid at a fixed height.
+
+        Args:
+            extent: half width of a square area centered on the origin, or
+                (x min, x max, y min, y max) in meters
+            resolution: meters between grid points
+            height: z of the plane sources are placed on
+        """
+        return DelayGainGrid(self, extent, sample_rate, resolution, height)
+
+
+def delays_gains(distances, sample_rate: int):
+    """
+    Delays in samples and gains for an array of distances
+    """
+    delays = distances * (sample_rate / SPEED_OF_SOUND)
+    gains = np.exp(-ATTENUATION_ALPHA * distances) / \
+        np.maximum(distances, MIN_GRID_DISTANCE)**2
+    return delays, gains
+
+
+class DelayGainGrid(object):
+    def __init__(self, mic_array: MicArray, extent, sample_rate: int,
+                 resolution: float = DEFAULT_GRID_RESOLUTION,
+                 height: float = 0.0):
+        """
+        Dense grid of every mic's distance, delay and gain over a room area.
+        Queries are bilinearly interpolated, points off the grid plane or
+        outside its area fall back to exact computation.
+        """
+        if np.isscalar(extent):
+            extent = (-extent, extent, -extent, extent)
+        self.mic_array = mic_array
+        self.sample_rate = sample_rate
+        self.resolution = resolution
+        self.height = height
+        self.origin = np.array([extent[0], extent[2]], dtype=np.float64)
+        self.shape = (int(np.ceil((extent[1] - extent[0]) / resolution)) + 1,
+                      int(np.ceil((extent[3] - extent[2]) / resolution)) + 1)
+
+        xs = self.origin[0] + resolution * np.arange(self.shape[0])
+        ys = self.origin[1] + resolution * np.arange(self.shape[1])
+        grid_x, grid_y = np.meshgrid(xs, ys, indexing="ij")
+        points = np.stack([grid_x.ravel(), grid_y.ravel(),
+                           np.full(grid_x.size, height)], axis=1)
+
+        # nx x ny x num_mics, interpolated with one gather per corner
+        distances = mic_array.distances(points)
+        delays, gains = delays_gains(distances, sample_rate)
+        grid_shape = self.shape + (len(mic_array),)
+        self.distance_grid = distances.reshape(grid_shape)
+        self.delay_grid = delays.reshape(grid_shape)
+        self.gain_grid = gains.reshape(grid_shape)
+
+    @property
+    def nbytes(self):
+        return self.distance_grid.nbytes + self.delay_grid.nbytes + \
+            self.gain_grid.nbytes
+
+    def _interpolate(self, grids, points):
+        """
+        Bilinear lookup of every grid at points (num_points x 3), returns
+        one num_points x num_mics array per grid and the on-grid mask
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        coords = (points[:, :2] - self.origin) / self.resolution
+        on_grid = np.all((coords >= 0) & (coords <= np.array(self.shape) - 1),
+                         axis=1) & np.isclose(points[:, 2], self.height)
+
+        # Clip so off grid points index safely, they are replaced afterwards
+        cell = np.clip(np.floor(coords).astype(int), 0,
+                       np.array(self.shape) - 2)
+        frac = np.clip(coords - cell, 0.0, 1.0)
+        ix, iy = cell[:, 0], cell[:, 1]
+        fx, fy = frac[:, 0, None], frac[:, 1, None]
+
+        results = []
+        for grid in grids:
+            low = grid[ix, iy] * (1 - fy) + grid[ix, iy + 1] * fy
+            high = grid[ix + 1, iy] * (1 - fy) + grid[ix + 1, iy + 1] * fy
+            results.append(low * (1 - fx) + high * fx)
+        return results, on_grid, points
+
+    def distances(self, points):
+        """
+        num_points x num_mics distances from points (num_points x 3)
+        """
+        (distances,), on_grid, points = self._interpolate(
+            (self.distance_grid,), points)
+        if not np.all(on_grid):
+            distances[~on_grid] = self.mic_array.distances(points[~on_grid])
+        return distances
+
+    def lookup(self, points):
+        """
+        num_points x num_mics delays in samples and gains for points
+        (num_points x 3)
+        """
+        (delays, gains), on_grid, points = self._interpolate(
+            (self.delay_grid, self.gain_grid), points)
+        if not np.all(on_grid):
+            delays[~on_grid], gains[~on_grid] = self.mic_array.delays_gains(
+                points[~on_grid], self.sample_rate)
+        return delays, gains
@@ -0,0 +1,107 @@
+"""
+Multi-node generation. Node i of n renders every scene with
+index % n == i into output_dir/part-<i>, e.g. from a job array:
+
+    python -m d3audiorecon.renderer.main ... out --shard-index $i --num-shards $n
+
+Once all parts are done, merging verifies them and writes one dataset
+index over all parts, without moving any audio:
+
+    python -m d3audiorecon.renderer.partition out
+"""
+import argparse
+import os
+import glob
+import json
+
+from d3audiorecon.renderer.manifest import Manifest, MANIFEST_FILENAME, \
+    scene_complete
+from d3audiorecon.renderer.shards import ShardReader, is_sharded
+
+PART_PREFIX = "part-"
+DATASET_INDEX_FILENAME = "dataset_index.json"
+
+
+def part_dir(output_dir: str, shard_index: int):
+    return os.path.join(output_dir, "{}{:04d}".format(PART_PREFIX, shard_index))
+
+
+def in_partition(data_sample_idx: int, shard_index: int, num_shards: int):
+    """
+    Strided so a scene stays on the same node when --num-scenes grows
+    """
+    return data_sample_idx % num_shards == shard_index
+
+
+def merge_parts(output_dir: str):
+    """
+    Check that every part was rendered with the same settings and that all
+    scenes are complete, then write output_dir/dataset_index.json mapping
+    every scene to its part, and the metadata index of the merged dataset.
+    Returns the indices of missing scenes.
+    """
+    part_dirs = sorted(glob.glob(os.path.join(output_dir, PART_PREFIX + "*")))
+    if len(part_dirs) == 0:
+        raise ValueError("No parts found in {}".format(output_dir))
+    manifests = [Manifest.load(os.path.join(x, MANIFEST_FILENAME)) for x in part_dirs]
+
+    num_shards = manifests[0].params["num_shards"]
+    if sorted(x.params["shard_index"] for x in manifests) != list(range(num_shards)):
+        raise ValueError("Expected parts 0 to {} in {}".format(num_shards - 1, output_dir))
+    for manifest in manifests[1:]:
+        # Nodes render from their own copies of the corpus, mtimes differ
+        manifests[0].check_compatible(manifest, ignore=("shard_index",), portable=True)
+
+    scenes = {}
+    for part_idx, (curr_dir, manifest) in enumerate(zip(part_dirs, manifests)):
+        shard_scenes = set(ShardReader(curr_dir).entries) \
+            if is_sharded(curr_dir) else set()
+        for idx in manifest.completed:
+            if scene_complete(curr_dir, manifest.params, idx, shard_scenes):
+                scenes[idx] = part_idx
+
+    num_scenes = max(x.num_scenes for x in manifests)
+    missing = [idx for idx in range(num_scenes) if idx not in scenes]
+
+    index = {
+        "output_format": manifests[0].params["output_format"],
+        "parts": [os.path.basename(x) for x in part_dirs],
+        "scenes": sorted(scenes.items()),  # [scene idx, part idx]
+    }
+    tmp_path = os.path.join(output_dir, DATASET_INDEX_FILENAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(output_dir, DATASET_INDEX_FILENAME))
+
+    # Imported here, the metadata index reads merged datasets through this module
+    from d3audiorecon.renderer.metadata_index import build_metadata_index
+    build_metadata_index(output_dir)
+    return missing
+
+
+def has_dataset_index(data_dir: str):
+    return os.path.isfile(os.path.join(data_dir, DATASET_INDEX_FILENAME))
+
+
+def load_dataset_index(data_dir: str):
+    """
+    Returns the output format, the part directories and the
+    (scene idx, part directory) of every merged scene
+    """
+    with open(os.path.join(data_dir, DATASET_INDEX_FILENAME)) as f:
+        index = json.load(f)
+    part_dirs = [os.path.join(data_dir, x) for x in index["parts"]]
+    scenes = [(idx, part_dirs[part_idx]) for idx, part_idx in index["scenes"]]
+    return index["output_format"], part_dirs, scenes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Verify and index the parts of a multi-node render')
+    parser.add_argument("output_dir", type=str, help="Directory holding the part-XXXX outputs")
+    args = parser.parse_args()
+
+    missing = merge_parts(args.output_dir)
+    if missing:
+        print("{} scenes missing, first few: {}".format(len(missing), missing[:20]))
+    else:
+        print("All scenes present")
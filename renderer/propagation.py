@@ -0,0 +1,60 @@
+import numpy as np
+
+from d3audiorecon.renderer.constants import ATMOSPHERE_TEMPERATURE, \
+    ATMOSPHERE_HUMIDITY, ATMOSPHERE_PRESSURE
+
+REFERENCE_PRESSURE = 101.325  # kPa
+REFERENCE_TEMPERATURE = 293.15  # K
+TRIPLE_POINT_TEMPERATURE = 273.16  # K
+
+
+def atmospheric_absorption(frequencies,
+                           temperature: float = ATMOSPHERE_TEMPERATURE,
+                           humidity: float = ATMOSPHERE_HUMIDITY,
+                           pressure: float = ATMOSPHERE_PRESSURE):
+    """
+    Frequency dependent atmospheric absorption coefficient from ISO 9613-1.
+    At 1 kHz and the default conditions this is ATTENUATION_ALPHA.
+
+    Args:
+        frequencies: array of frequencies in Hz
+        temperature: in C
+        humidity: relative humidity in %
+        pressure: in kPa
+    """
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    temperature = temperature + 273.15
+    rel_pressure = pressure / REFERENCE_PRESSURE
+    rel_temperature = temperature / REFERENCE_TEMPERATURE
+
+    # Molar concentration of water vapour
+    sat_pressure = 10**(-6.8346 * (TRIPLE_POINT_TEMPERATURE / temperature)**1.261
+                        + 4.6151)
+    h = humidity * sat_pressure / rel_pressure
+
+    # Relaxation frequencies of oxygen and nitrogen
+    fr_o = rel_pressure * (24 + 4.04e4 * h * (0.02 + h) / (0.391 + h))
+    fr_n = rel_pressure * rel_temperature**-0.5 * (
+        9 + 280 * h * np.exp(-4.170 * (rel_temperature**(-1 / 3) - 1)))
+
+    f2 = frequencies**2
+    return 8.686 * f2 * (
+        1.84e-11 / rel_pressure * rel_temperature**0.5 +
+        rel_temperature**-2.5 *
+        (0.01275 * np.exp(-2239.1 / temperature) / (fr_o + f2 / fr_o) +
+         0.1068 * np.exp(-3352.0 / temperature) / (fr_n + f2 / fr_n)))
+
+
+def fractional_delay_response(frequencies, delays, sample_rate: int):
+    """
+    Frequency response of a (sub-sample) delay, for every delay at once
+
+    Args:
+        frequencies: F array in Hz
+        delays: array of delays in samples, any shape
+    Returns:
+        delays.shape + (F,) complex array
+    """
+    delays = np.asarray(delays, dtype=np.float64)
+    phase = (-2j * np.pi / sample_rate) * frequencies
+    return np.exp(delays[..., None] * phase)
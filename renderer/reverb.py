@@ -0,0 +1,109 @@
+"""
+In-process reverb: sources are convolved with room impulse responses by
+batched FFT convolution instead of running sox once per source-mic pair.
+"""
+import os
+
+import numpy as np
+import librosa
+import scipy.fft
+
+MIN_BLOCK_SAMPLES = 16384  # Overlap-add block, at least the IR length
+RT60_RANGE = (0.2, 0.8)  # s, range of synthetic reverb times
+REVERB_WET_ENERGY = 0.3  # Energy of the synthetic tail relative to the direct path
+
+
+def fft_convolve(signal, impulse_responses, num_samples: int,
+                 block_samples: int = None):
+    """
+    Convolves one signal with several impulse responses at once by FFT
+    overlap-add. Every signal block is transformed once and shared by all
+    responses.
+
+    Args:
+        signal: samples
+        impulse_responses: channels x ir_samples
+        num_samples: output length, the tail after it is dropped
+    Returns:
+        channels x num_samples float32
+    """
+    impulse_responses = np.atleast_2d(impulse_responses)
+    num_channels, ir_samples = impulse_responses.shape
+    if block_samples is None:
+        block_samples = max(ir_samples, MIN_BLOCK_SAMPLES)
+    n_fft = scipy.fft.next_fast_len(block_samples + ir_samples - 1, real=True)
+    ir_spectra = scipy.fft.rfft(impulse_responses, n=n_fft, axis=-1)
+
+    signal = signal[:num_samples]
+    out = np.zeros((num_channels, num_samples + n_fft), dtype=np.float32)
+    for block_start in range(0, len(signal), block_samples):
+        spectrum = scipy.fft.rfft(signal[block_start:block_start + block_samples],
+                                  n=n_fft)
+        out[:, block_start:block_start + n_fft] += scipy.fft.irfft(
+            ir_spectra * spectrum, n=n_fft, axis=-1)
+    return out[:, :num_samples]
+
+
+def synthetic_impulse_response(num_channels: int, sample_rate: int,
+                               rt60: float, rng=np.random):
+    """
+    Unit direct path followed by exponentially decaying noise, 60 dB down
+    after rt60 seconds. Every channel gets its own tail.
+    """
+    num_samples = max(int(rt60 * sample_rate), 1)
+    decay = 10**(-3.0 * np.arange(num_samples) / (rt60 * sample_rate))
+    decay *= np.sqrt(REVERB_WET_ENERGY / np.sum(decay**2))
+    impulse_responses = rng.normal(size=(num_channels, num_samples)) * decay
+    impulse_responses[:, 0] = 1.0
+    return impulse_responses.astype(np.float32)
+
+
+class ImpulseResponsePool(object):
+    def __init__(self, impulse_responses=None, ir_dir: str = None,
+                 sample_rate: int = None):
+        """
+        Room responses that scenes draw their reverb from.
+
+        Args:
+            impulse_responses: list of ir_samples or channels x ir_samples
+                arrays. Mono responses are shared by every mic, multichannel
+                ones need one channel per mic
+            ir_dir: directory of audio files to load at sample_rate instead
+        """
+        if ir_dir is not None:
+            impulse_responses = [
+                librosa.core.load(os.path.join(ir_dir, name), sr=sample_rate,
+                                  mono=False)[0]
+                for name in sorted(os.listdir(ir_dir))]
+        if not impulse_responses:
+            raise ValueError("No impulse responses given")
+        self.impulse_responses = [np.atleast_2d(x).astype(np.float32)
+                                  for x in impulse_responses]
+
+    def __len__(self):
+        return len(self.impulse_responses)
+
+    def sample(self, num_mics: int, rng=np.random):
+        """
+        channels x ir_samples response, channels is 1 or num_mics
+        """
+        impulse_responses = self.impulse_responses[rng.randint(len(self))]
+        if impulse_responses.shape[0] not in (1, num_mics):
+            raise ValueError("Impulse response has {} channels for {} mics".format(
+                impulse_responses.shape[0], num_mics))
+        return impulse_responses
+
+
+def scene_impulse_responses(num_mics: int, sample_rate: int,
+                            impulse_responses: ImpulseResponsePool = None,
+                            rng=np.random):
+    """
+    The room of one scene: a response drawn from impulse_responses, or
+    synthesized with a random RT60. channels x ir_samples, channels is 1
+    or num_mics.
+    """
+    if impulse_responses is not None:
+        return impulse_responses.sample(num_mics, rng=rng)
+    rt60 = rng.uniform(*RT60_RANGE)
+    return synthetic_impulse_response(num_mics, sample_rate, rt60, rng=rng)
+
@@ -0,0 +1,214 @@
+"""
+Shoebox room image source model (Allen & Berkley). Produces one impulse
+response per mic for a source position, with image positions, delays and
+gains computed as arrays, and caches them by geometry.
+
+Usage: python -m d3audiorecon.renderer.room
+       (benchmarks simulated and cached RIR sets/sec)
+"""
+import time
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+from d3audiorecon.renderer.constants import SPEED_OF_SOUND, ATTENUATION_ALPHA
+
+DEFAULT_MAX_ORDER = 8  # Highest number of wall reflections per image
+GEOMETRY_QUANTUM = 0.005  # m, a coarse cache key that nearby geometries share
+DEFAULT_CACHE_BYTES = 256 * 1024**2  # 256 MiB
+
+
+class RIRCache(object):
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        """
+        In-memory LRU of room impulse responses keyed by geometry, holding
+        at most max_bytes of responses
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        rirs = self.entries.get(key)
+        if rirs is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return rirs
+
+    def put(self, key, rirs):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old.nbytes
+        self.entries[key] = rirs
+        self.bytes += rirs.nbytes
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.nbytes
+
+
+DEFAULT_RIR_CACHE = RIRCache()
+
+
+class ShoeboxRoom(object):
+    def __init__(self,
+                 lower,
+                 upper,
+                 absorption=0.3,
+                 max_order: int = DEFAULT_MAX_ORDER,
+                 quantum: float = None,
+                 cache: RIRCache = DEFAULT_RIR_CACHE):
+        """
+        Args:
+            lower, upper: x,y,z corners of the room in scene coordinates
+            absorption: energy absorption of the walls, one value or six
+                (x low, x high, y low, y high, z low, z high)
+            max_order: images with more reflections than this are dropped
+            quantum: positions are rounded to this many meters in the cache
+                key, so nearby geometries share the entry of the first one
+                simulated, e.g. GEOMETRY_QUANTUM. None keys on the exact
+                positions
+            cache: None disables caching
+        """
+        self.lower = np.array(lower, dtype=np.float64)
+        self.upper = np.array(upper, dtype=np.float64)
+        absorption = np.broadcast_to(np.asarray(absorption, dtype=np.float64), (6,))
+        self.reflection = np.sqrt(1.0 - absorption).reshape(3, 2)  # axis x (low, high)
+        self.max_order = max_order
+        self.quantum = quantum
+        self.cache = cache
+        self._images = self._image_lattice()
+
+    def _image_lattice(self):
+        """
+        Mirror parity, cell index and reflection count of every image with
+        at most max_order reflections, as arrays of shape images x 3
+        """
+        cells = np.arange(-self.max_order, self.max_order + 1)
+        parity, cell = np.meshgrid([0, 1], cells, indexing="ij")
+        parity, cell = parity.ravel(), cell.ravel()
+
+        # Per axis: image coordinate is (1 - 2 parity) x + 2 cell L and it
+        # hits the low wall |cell - parity| and the high wall |cell| times
+        low_hits = np.abs(cell - parity)
+        high_hits = np.abs(cell)
+        per_axis = np.stack([parity, cell, low_hits, high_hits], axis=-1)
+
+        idx = np.stack(np.meshgrid(*[np.arange(len(per_axis))] * 3,
+                                   indexing="ij"), axis=-1).reshape(-1, 3)
+        images = per_axis[idx]  # images x 3 axes x (parity, cell, low, high)
+        order = images[..., 2].sum(axis=1) + images[..., 3].sum(axis=1)
+        return images[order <= self.max_order]
+
+    def _quantize(self, positions):
+        positions = np.asarray(positions, dtype=np.float64)
+        if self.quantum is None:
+            return positions
+        return np.round(positions / self.quantum) * self.quantum
+
+    def key(self):
+        return (tuple(self.lower), tuple(self.upper),
+                tuple(self.reflection.ravel()), self.max_order)
+
+    def impulse_responses(self, source_position, mic_positions,
+                          sample_rate: int, geometric_attenuation=True,
+                          atmospheric_attenuation=True):
+        """
+        num_mics x samples impulse responses, using the same integer delays
+        and attenuation laws as Scene.render for every image, so a room
+        with absorption 1 gives exactly the free field direct path of a
+        source starting at 0
+        """
+        source_position = np.asarray(source_position, dtype=np.float64)
+        mic_positions = np.asarray(mic_positions, dtype=np.float64)
+        for position in (source_position, *mic_positions):
+            if np.any(position < self.lower) or np.any(position > self.upper):
+                raise ValueError("Position {} is outside the room".format(position))
+        key = (self.key(), tuple(self._quantize(source_position)),
+               tuple(self._quantize(mic_positions).ravel()), sample_rate,
+               geometric_attenuation, atmospheric_attenuation)
+        if self.cache is not None:
+            rirs = self.cache.get(key)
+            if rirs is not None:
+                return rirs
+
+        rirs = self._simulate(source_position, mic_positions, sample_rate,
+                              geometric_attenuation, atmospheric_attenuation)
+        if self.cache is not None:
+            rirs.setflags(write=False)  # Shared between callers
+            self.cache.put(key, rirs)
+        return rirs
+
+    def _simulate(self, source_position, mic_positions, sample_rate,
+                  geometric_attenuation, atmospheric_attenuation):
+        size = self.upper - self.lower
+        parity, cell = self._images[..., 0], self._images[..., 1]
+        local_source = source_position - self.lower
+        image_positions = (1 - 2 * parity) * local_source + 2 * cell * size \
+            + self.lower  # images x 3
+        gains = np.prod(self.reflection[:, 0]**self._images[..., 2] *
+                        self.reflection[:, 1]**self._images[..., 3], axis=1)
+
+        # Same distances and delays as Scene.distances and Scene.start_samples
+        diff = mic_positions[:, None, :] - image_positions[None, :, :]
+        distances = np.sqrt(
+            (diff[..., None, :] @ diff[..., :, None])[..., 0, 0])  # mics x images
+        delays = (sample_rate * distances / SPEED_OF_SOUND).astype(int)
+        gains = np.broadcast_to(gains, distances.shape)
+        if geometric_attenuation:
+            gains = gains / distances**2
+        if atmospheric_attenuation:
+            gains = gains * np.exp(-ATTENUATION_ALPHA * distances)
+
+        # Scatter all taps of all mics at once
+        num_mics = len(mic_positions)
+        num_samples = delays.max() + 1
+        flat_idx = delays + num_samples * np.arange(num_mics)[:, None]
+        rirs = np.bincount(flat_idx.ravel(), weights=gains.ravel(),
+                           minlength=num_mics * num_samples)
+        return rirs.reshape(num_mics, num_samples).astype(np.float32)
+
+
+def benchmark(room: ShoeboxRoom, mic_positions, sample_rate: int,
+              num_sources: int, seed: int = 0):
+    """
+    RIR sets (one response per mic) per second for num_sources random
+    source positions, simulated and then served from the room's cache
+    """
+    rng = np.random.RandomState(seed)
+    sources = rng.uniform(room.lower, room.upper, (num_sources, 3))
+    rates = {}
+    for name in ("simulated", "cached"):
+        start = time.perf_counter()
+        for source_position in sources:
+            room.impulse_responses(source_position, mic_positions, sample_rate)
+        rates[name] = num_sources / (time.perf_counter() - start)
+    return rates
+
+
+if __name__ == "__main__":
+    from d3audiorecon.renderer.mic_array import MicArray
+
+    parser = argparse.ArgumentParser(description='Benchmark shoebox room impulse responses')
+    parser.add_argument("--size", type=float, nargs=3, default=(24.0, 24.0, 4.0), help="Room size in m, centered on the mic array in x and y")
+    parser.add_argument("--absorption", type=float, default=0.3)
+    parser.add_argument("--max-order", type=int, default=DEFAULT_MAX_ORDER)
+    parser.add_argument("--num-mics", type=int, default=8, help="Circular array at the room's center, 1 m above the floor")
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--num-sources", type=int, default=200, help="Source positions timed")
+    args = parser.parse_args()
+
+    size = np.array(args.size)
+    lower = np.array([-size[0] / 2, -size[1] / 2, -1.0])
+    room = ShoeboxRoom(lower, lower + size, args.absorption, args.max_order,
+                       cache=RIRCache())
+    mic_positions = MicArray.circular(args.num_mics).positions
+    rates = benchmark(room, mic_positions, args.sample_rate, args.num_sources)
+    print("{} images, {} mics".format(len(room._images), args.num_mics))
+    for name, rate in rates.items():
+        print("{:<10} {:8.0f} RIR sets/sec {:9.0f} single-mic RIRs/sec".format(
+            name, rate, rate * args.num_mics))
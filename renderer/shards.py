@@ -0,0 +1,148 @@
+"""
+Sharded scene storage: many rendered scenes per shard file instead of a
+directory of WAVs per scene.
+
+Each shard is <name>.bin, holding for every scene its num_mics x samples
+mix followed by its num_mics x num_sources x samples ground truth, and
+<name>.index.jsonl with one line per scene giving its byte offset, shapes
+and metadata (source positions and filenames). Shards are append only and
+a scene's index line is written after its audio, so a crashed writer never
+leaves an index entry pointing at missing data.
+"""
+import os
+import glob
+import json
+import socket
+
+import numpy as np
+
+DATA_SUFFIX = ".bin"
+INDEX_SUFFIX = ".index.jsonl"
+
+
+def default_shard_name():
+    """
+    Shard name unique to this process, so workers never share a file
+    """
+    return "shard-{}-{}".format(socket.gethostname(), os.getpid())
+
+
+def is_sharded(data_dir: str):
+    return len(glob.glob(os.path.join(data_dir, "*" + INDEX_SUFFIX))) > 0
+
+
+class ShardWriter(object):
+    def __init__(self, path_prefix: str):
+        """
+        Appends scenes to path_prefix.bin and path_prefix.index.jsonl.
+        Files are created on the first write.
+        """
+        self.path_prefix = path_prefix
+        self.data_file = None
+        self.index_file = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path_prefix) or ".", exist_ok=True)
+        self.data_file = open(self.path_prefix + DATA_SUFFIX, "ab")
+        self.index_file = open(self.path_prefix + INDEX_SUFFIX, "a")
+
+    def write(self, scene_idx: int, mix, sources_gt, sample_rate: int,
+              metadata: dict):
+        """
+        Args:
+            mix: num_mics x samples
+            sources_gt: num_mics x num_sources x samples, same dtype as mix
+            metadata: json serializable, e.g. source positions and filenames
+        """
+        if self.data_file is None:
+            self._open()
+        mix = np.ascontiguousarray(mix)
+        sources_gt = np.ascontiguousarray(sources_gt, dtype=mix.dtype)
+        offset = self.data_file.tell()
+        self.data_file.write(mix.tobytes())
+        self.data_file.write(sources_gt.tobytes())
+        self.data_file.flush()
+
+        entry = {
+            "scene": scene_idx,
+            "offset": offset,
+            "dtype": mix.dtype.str,
+            "num_mics": sources_gt.shape[0],
+            "num_sources": sources_gt.shape[1],
+            "num_samples": sources_gt.shape[2],
+            "sample_rate": sample_rate,
+            "metadata": metadata,
+        }
+        self.index_file.write(json.dumps(entry) + "\n")
+        self.index_file.flush()
+
+    def close(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+
+
+class ShardReader(object):
+    def __init__(self, data_dirs):
+        """
+        Random access by scene index to every shard in data_dirs, a
+        directory or a list of them. Audio is returned as read only views of
+        the memory mapped shard files. Scenes written more than once resolve
+        to their last entry.
+        """
+        if isinstance(data_dirs, str):
+            data_dirs = [data_dirs]
+        index_paths = [x for data_dir in data_dirs for x in
+                       sorted(glob.glob(os.path.join(data_dir, "*" + INDEX_SUFFIX)))]
+        self.entries = {}  # scene idx -> (data path, index entry)
+        for index_path in index_paths:
+            data_path = index_path[:-len(INDEX_SUFFIX)] + DATA_SUFFIX
+            with open(index_path) as f:
+                for line in f:
+                    if not line.endswith("\n"):  # Partially written last line
+                        break
+                    entry = json.loads(line)
+                    self.entries[entry["scene"]] = (data_path, entry)
+        self.scene_idxs = sorted(self.entries)
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.scene_idxs)
+
+    def __getstate__(self):
+        # Remap in each DataLoader worker instead of pickling the audio
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    def _map(self, data_path: str, end: int):
+        data = self._maps.get(data_path)
+        if data is None or len(data) < end:  # Shard grew since it was mapped
+            data = np.memmap(data_path, dtype=np.uint8, mode="r")
+            self._maps[data_path] = data
+        return data
+
+    def scene(self, scene_idx: int):
+        """
+        Returns mix (num_mics x samples), sources_gt
+        (num_mics x num_sources x samples) and the index entry of one scene
+        """
+        data_path, entry = self.entries[scene_idx]
+        dtype = np.dtype(entry["dtype"])
+        mix_shape = (entry["num_mics"], entry["num_samples"])
+        gt_shape = (entry["num_mics"], entry["num_sources"], entry["num_samples"])
+        mix_bytes = int(np.prod(mix_shape)) * dtype.itemsize
+        gt_bytes = int(np.prod(gt_shape)) * dtype.itemsize
+
+        start = entry["offset"]
+        data = self._map(data_path, start + mix_bytes + gt_bytes)
+        mix = data[start:start + mix_bytes].view(dtype).reshape(mix_shape)
+        start += mix_bytes
+        sources_gt = data[start:start + gt_bytes].view(dtype).reshape(gt_shape)
+        return mix, sources_gt, entry
+
+    def __getitem__(self, idx: int):
+        """
+        The idx-th scene in scene index order
+        """
+        return self.scene(self.scene_idxs[idx])
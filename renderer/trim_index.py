@@ -0,0 +1,161 @@
+"""
+Silence trim bounds of every file in a directory of source audio,
+computed once in batches and stored next to the files, so SoundSource
+slices instead of running librosa.effects.trim on every load.
+
+A single file sliced by its bounds is the same as trimming it. A
+concatenation of several files is cut at the first file's start and the
+last file's end, each measured against its own file's peak, where
+trimming the concatenation measures against the peak of all of them. The
+index therefore changes concatenated voices, and is part of the
+manifest's corpus_fingerprint.
+
+Usage: python -m d3audiorecon.renderer.trim_index voices_dir
+"""
+import argparse
+import os
+import json
+import multiprocessing as mp
+
+import numpy as np
+import librosa
+
+TRIM_INDEX_FILENAME = "trim_index.json"
+TRIM_BATCH_SIZE = 32  # Files decoded and trimmed together
+TRIM_FRAME_LENGTH = 2048  # librosa.effects.trim defaults
+TRIM_HOP_LENGTH = 512
+TRIM_AMIN = 1e-5
+
+
+def trim_bounds(audio):
+    """
+    [start, end) of audio after the same silence trim SoundSource does
+    """
+    return batch_trim_bounds([audio])[0]
+
+
+def batch_trim_bounds(audios):
+    """
+    trim_bounds of several signals from one framed RMS pass over all of
+    them, zero padded to the longest. Matches librosa.effects.trim at
+    top_db=20, falling back to top_db=80 for results under 100 samples.
+    """
+    lengths = np.array([len(audio) for audio in audios])
+    batch = np.zeros((len(audios), lengths.max()), dtype=np.result_type(*audios))
+    for row, audio in zip(batch, audios):
+        row[:len(audio)] = audio
+
+    rms = librosa.feature.rms(y=batch, frame_length=TRIM_FRAME_LENGTH,
+                              hop_length=TRIM_HOP_LENGTH)[:, 0, :]
+    # Frames past a signal's own end only exist because of the padding
+    num_frames = 1 + lengths // TRIM_HOP_LENGTH
+    valid = np.arange(rms.shape[1])[None, :] < num_frames[:, None]
+    rms[~valid] = 0.0
+
+    # librosa.amplitude_to_db with ref=np.max, per signal
+    ref = np.max(rms, axis=1, keepdims=True)
+    db = 10.0 * np.log10(np.maximum(TRIM_AMIN**2, rms**2)) - \
+        10.0 * np.log10(np.maximum(TRIM_AMIN**2, ref**2))
+
+    bounds = []
+    for curr_db, curr_valid, length in zip(db, valid, lengths):
+        for top_db in (20, 80):
+            nonzero = np.flatnonzero((curr_db > -top_db) & curr_valid)
+            if nonzero.size > 0:
+                start = int(nonzero[0]) * TRIM_HOP_LENGTH
+                end = min(int(length), (int(nonzero[-1]) + 1) * TRIM_HOP_LENGTH)
+            else:
+                start, end = 0, 0
+            if end - start >= 100:
+                break
+        bounds.append((start, end))
+    return bounds
+
+
+def _decode(job):
+    filename, sample_rate = job
+    audio, _ = librosa.core.load(filename, sr=sample_rate, mono=True)
+    return audio
+
+
+def build_trim_index(audio_dir: str, sample_rate: int, num_workers=None):
+    """
+    Decode every file under audio_dir at sample_rate and write
+    audio_dir/trim_index.json with its length and trim bounds, keyed by
+    path relative to audio_dir
+    """
+    filenames = sorted(os.path.join(root, name)
+                       for root, _, names in os.walk(audio_dir)
+                       for name in names if name != TRIM_INDEX_FILENAME and
+                       not name.endswith(".tmp"))
+    entries = {}
+    with mp.Pool(num_workers) as pool:
+        for batch_start in range(0, len(filenames), TRIM_BATCH_SIZE):
+            batch = filenames[batch_start:batch_start + TRIM_BATCH_SIZE]
+            audios = pool.map(_decode, [(x, sample_rate) for x in batch])
+            for filename, audio, (start, end) in zip(batch, audios,
+                                                     batch_trim_bounds(audios)):
+                stat = os.stat(filename)
+                entries[os.path.relpath(filename, audio_dir)] = \
+                    [stat.st_size, stat.st_mtime_ns, len(audio), start, end]
+
+    index = {"sample_rate": sample_rate, "entries": entries}
+    path = os.path.join(audio_dir, TRIM_INDEX_FILENAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(path + ".tmp", path)
+    return index
+
+
+def has_trim_index(audio_dir: str):
+    return os.path.isfile(os.path.join(audio_dir, TRIM_INDEX_FILENAME))
+
+
+class TrimIndex(object):
+    def __init__(self, audio_dir: str):
+        """
+        Trim bounds written by build_trim_index for the files in audio_dir
+        """
+        self.audio_dir = os.path.abspath(audio_dir)
+        with open(os.path.join(audio_dir, TRIM_INDEX_FILENAME)) as f:
+            index = json.load(f)
+        self.sample_rate = index["sample_rate"]
+        self.entries = index["entries"]  # relpath -> [size, mtime_ns, length, start, end]
+
+    def bounds(self, filename: str, sample_rate: int, length: int):
+        """
+        (start, end) of filename decoded at sample_rate to length samples,
+        or None if it is not indexed or changed since it was
+        """
+        if sample_rate != self.sample_rate:
+            return None
+        entry = self.entries.get(
+            os.path.relpath(os.path.abspath(filename), self.audio_dir))
+        if entry is None or entry[2] != length:
+            return None
+        stat = os.stat(filename)
+        if [stat.st_size, stat.st_mtime_ns] != entry[:2]:
+            return None
+        return entry[3], entry[4]
+
+    def fingerprint(self):
+        """
+        The sample rate and every file's size, length and bounds, the same
+        for copies of the index next to copies of the files
+        """
+        entries = sorted((relpath, entry[0], entry[2], entry[3], entry[4])
+                         for relpath, entry in self.entries.items())
+        return json.dumps([self.sample_rate, entries])
+
+
+if __name__ == "__main__":
+    from d3audiorecon.renderer.classes import INPUT_OUTPUT_TARGET_SAMPLE_RATE
+
+    parser = argparse.ArgumentParser(description='Precompute silence trim bounds of a directory of audio')
+    parser.add_argument("audio_dir", type=str, help="Voices or background sounds directory")
+    parser.add_argument("--sample-rate", type=int, default=INPUT_OUTPUT_TARGET_SAMPLE_RATE, help="Rate the renderer decodes at")
+    parser.add_argument("--num-workers", type=int, default=None, help="Decode processes, defaults to the core count")
+    args = parser.parse_args()
+
+    index = build_trim_index(args.audio_dir, args.sample_rate, args.num_workers)
+    print("Indexed {} files".format(len(index["entries"])))
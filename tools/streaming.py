@@ -0,0 +1,362 @@
+"""
+Streaming log-CQT and log-mel: audio is pushed in chunks of any size and
+only the spectrogram frames the new samples complete come back, for live
+multi-mic input. Frames are the same as log_cqt / log_mel_spec_tfm of the
+whole signal, except that power_to_db's top_db clip needs the peak of the
+whole signal; apply top_db_clip to all frames to get the offline output.
+
+Run as a script to check that streamed log-CQT frames arrive within
+StreamingLogCQT.latency and equal log_cqt_audio.
+"""
+import argparse
+import functools
+
+import numpy as np
+import librosa
+import soxr
+
+from d3audiorecon.tools.utils import cqt_filter_bank, log_cqt_audio, \
+    FEATURE_SAMPLE_RATE, CQT_N_BINS, CQT_AMIN, CQT_TOP_DB, CQT_RES_TYPE, \
+    CQT_HOP_LENGTH, MEL_N_FFT, MEL_HOP_LENGTH, MEL_N_MELS, MEL_FMIN
+
+RING_CAPACITY = 4096  # Initial samples per ring buffer, doubled when a chunk does not fit
+
+
+def top_db_clip(spec_db, top_db=CQT_TOP_DB):
+    """
+    The top_db clip of power_to_db, per channel of channels x freq x time
+    streamed frames
+    """
+    return np.maximum(spec_db, spec_db.max(axis=(1, 2), keepdims=True) - top_db)
+
+
+def _to_db(S):
+    return 10.0 * np.log10(np.maximum(CQT_AMIN, S))
+
+
+def _as_chunk(chunk, num_channels: int):
+    chunk = np.asarray(chunk, dtype=np.float32)
+    return chunk.reshape(num_channels, -1)
+
+
+class RingBuffer(object):
+    def __init__(self, shape, dtype, capacity: int = RING_CAPACITY):
+        """
+        Preallocated FIFO of shape x samples arrays along the last axis.
+        Every sample is stored twice, capacity apart, so the oldest samples
+        are always one contiguous view. Only a chunk that does not fit
+        reallocates, doubling the capacity.
+        """
+        self.data = np.zeros(tuple(shape) + (2 * capacity,), dtype=dtype)
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, values):
+        count = values.shape[-1]
+        if self.size + count > self.capacity:
+            self._grow(self.size + count)
+        stop = (self.start + self.size) % self.capacity
+        below = min(count, self.capacity - stop)  # Values before the first copy wraps
+        self.data[..., stop:stop + count] = values
+        self.data[..., stop + self.capacity:stop + self.capacity + below] = values[..., :below]
+        if below < count:
+            self.data[..., :count - below] = values[..., below:]
+        self.size += count
+
+    def peek(self, count: int):
+        """
+        View of the oldest count samples, valid until the next append
+        """
+        return self.data[..., self.start:self.start + min(count, self.size)]
+
+    def drop(self, count: int):
+        count = min(count, self.size)
+        self.start = (self.start + count) % self.capacity
+        self.size -= count
+
+    def _grow(self, size: int):
+        capacity = self.capacity
+        while capacity < size:
+            capacity *= 2
+        data = np.zeros(self.data.shape[:-1] + (2 * capacity,), dtype=self.data.dtype)
+        data[..., :self.size] = self.peek(self.size)
+        data[..., capacity:capacity + self.size] = data[..., :self.size]
+        self.data, self.capacity, self.start = data, capacity, 0
+
+
+class StreamingSTFT(object):
+    def __init__(self, num_channels: int, n_fft: int, hop_length: int, window):
+        """
+        librosa.stft(center=True, pad_mode="constant") of a signal that
+        arrives in chunks. Only samples of frames still to come are kept,
+        in a RingBuffer.
+        """
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.window = window
+        self.num_samples = 0
+        self.num_frames = 0  # Frames returned so far
+        # Starts at the next frame's left edge, n_fft // 2 samples of padding
+        self.buffer = RingBuffer((num_channels,), np.float32,
+                                 max(RING_CAPACITY, 2 * n_fft))
+        self.buffer.append(np.zeros((num_channels, n_fft // 2), dtype=np.float32))
+        self.skip = 0  # Samples before the next frame that have not arrived yet
+
+    def push(self, samples):
+        """
+        channels x freq x frames STFT of the frames samples complete
+        """
+        self.num_samples += samples.shape[1]
+        skipped = min(self.skip, samples.shape[1])
+        self.skip -= skipped
+        self.buffer.append(samples[:, skipped:])
+        return self._frames((self.num_samples - self.n_fft // 2) // self.hop_length + 1)
+
+    def finish(self):
+        """
+        The remaining frames, over the right padding
+        """
+        self.buffer.append(np.zeros((self.buffer.data.shape[0], self.n_fft - self.n_fft // 2),
+                                    dtype=np.float32))
+        return self._frames(1 + self.num_samples // self.hop_length)
+
+    def _frames(self, num_complete):
+        num_new = max(0, num_complete - self.num_frames)
+        if num_new == 0:
+            return np.zeros((self.buffer.data.shape[0], self.n_fft // 2 + 1, 0),
+                            dtype=np.complex64)
+        end = (num_new - 1) * self.hop_length + self.n_fft
+        stft = librosa.stft(self.buffer.peek(end), n_fft=self.n_fft,
+                            hop_length=self.hop_length, window=self.window,
+                            center=False, dtype=np.complex64)
+        self.num_frames += num_new
+        # With hop_length > n_fft the next frame can start past the buffer
+        self.skip = max(0, num_new * self.hop_length - len(self.buffer))
+        self.buffer.drop(num_new * self.hop_length)
+        return stft
+
+
+class StreamingLogMel(object):
+    def __init__(self, sample_rate: int, num_channels: int = 1):
+        """
+        log_mel_spec_tfm of a stream of channels x samples chunks at
+        sample_rate, before the top_db clip
+        """
+        self.num_channels = num_channels
+        self.mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=MEL_N_FFT,
+                                             n_mels=MEL_N_MELS, fmin=MEL_FMIN,
+                                             fmax=sample_rate / 2)
+        self.stft = StreamingSTFT(num_channels, MEL_N_FFT, MEL_HOP_LENGTH, "hann")
+
+    def push(self, chunk):
+        """
+        channels x MEL_N_MELS x frames dB of the frames chunk completes
+        """
+        return self._log_mel(self.stft.push(_as_chunk(chunk, self.num_channels)))
+
+    def finish(self):
+        return self._log_mel(self.stft.finish())
+
+    def _log_mel(self, stft):
+        # Same product as librosa.feature.melspectrogram
+        S = np.einsum("...ft,mf->...mt", np.abs(stft)**2.0, self.mel_basis, optimize=True)
+        return _to_db(S)
+
+
+@functools.lru_cache(maxsize=None)
+def resampler_lag(factor: int, num_blocks: int = 4):
+    """
+    Most input samples a factor:1 soxr ResampleStream holds back, measured
+    by pushing one sample at a time through its first num_blocks output
+    blocks. soxr emits fixed blocks, so the lag repeats from there on, and
+    larger chunks never hold back more.
+    """
+    stream = soxr.ResampleStream(factor, 1, 1, dtype="float32", quality=CQT_RES_TYPE)
+    sample = np.zeros((1, 1), dtype=np.float32)
+    lag = num_in = num_out = blocks = 0
+    while blocks < num_blocks:
+        num_in += 1
+        out = stream.resample_chunk(sample).shape[0]
+        blocks += out > 0
+        num_out += out
+        lag = max(lag, num_in - factor * num_out)
+    return lag
+
+
+class StreamingResampler(object):
+    def __init__(self, num_channels: int, factor: int):
+        """
+        librosa.resample(orig_sr=factor, target_sr=1, res_type=CQT_RES_TYPE,
+        scale=True) of a signal that arrives in chunks. soxr's stream gives
+        the same samples as its one-shot resample, but emits them in
+        blocks: after n inputs at least (n - lag) / factor outputs are out.
+        """
+        self.factor = factor
+        self.lag = resampler_lag(factor)
+        self.stream = soxr.ResampleStream(factor, 1, num_channels, dtype="float32",
+                                          quality=CQT_RES_TYPE)
+
+    def push(self, y, last=False):
+        """
+        channels x outputs of the outputs y releases
+        """
+        if y.shape[1] == 0 and not last:
+            return y
+        y_hat = self.stream.resample_chunk(np.ascontiguousarray(y.T), last=last).T
+        y_hat = np.array(y_hat, dtype=np.float32).reshape(y.shape[0], -1)
+        y_hat /= np.sqrt(1.0 / self.factor)  # As librosa.resample's scale
+        return y_hat
+
+    def needed(self, num_out: int):
+        """
+        Inputs after which num_out outputs are certainly out
+        """
+        return self.factor * (num_out - 1) + self.lag + 1 if num_out > 0 else 0
+
+
+class StreamingLogCQT(object):
+    def __init__(self, sample_rate: int, num_channels: int = 1):
+        """
+        log_cqt of a stream of channels x samples chunks at sample_rate,
+        before the top_db clip; after top_db_clip the frames equal log_cqt's.
+
+        Runs the octave recursion of multi_channel_log_cqt incrementally:
+        every octave has its own StreamingSTFT, fed by a StreamingResampler
+        from the octave above. Exact equality costs latency: every soxr
+        stream holds back up to its lag at its own rate, so frame t comes
+        out once t * CQT_HOP_LENGTH + latency samples are pushed. latency is
+        set by the lowest octave, about 10 s at 22.5 kHz. StreamingLogMel
+        trails by only n_fft / 2 samples.
+        """
+        self.num_channels = num_channels
+        self.filter_bank = cqt_filter_bank(sample_rate)
+        self.early_resampler = StreamingResampler(
+            num_channels, 2**self.filter_bank.downsample_count) \
+            if self.filter_bank.downsample_count > 0 else None
+
+        self.stfts = []
+        self.resamplers = []  # Into the next octave, None where the rate stays
+        hop_length = self.filter_bank.hop_length
+        for octave_idx, (_, n_fft) in enumerate(self.filter_bank.octaves):
+            self.stfts.append(StreamingSTFT(num_channels, n_fft, hop_length, "ones"))
+            if hop_length % 2 == 0 and octave_idx < len(self.filter_bank.octaves) - 1:
+                hop_length //= 2
+                self.resamplers.append(StreamingResampler(num_channels, 2))
+            else:
+                self.resamplers.append(None)
+        # Responses computed but not yet returned, per octave
+        self.pending = [RingBuffer((num_channels, fft_basis.shape[0]), np.complex64)
+                        for fft_basis, _ in self.filter_bank.octaves]
+        self.latency = self._latency()
+
+    def _latency(self):
+        """
+        Input samples frame 0 needs, the most of any octave. Each
+        requirement is affine in the frame, so frame t needs t *
+        CQT_HOP_LENGTH more.
+        """
+        latency = 0
+        resamplers = [self.early_resampler]
+        for stft, resampler in zip(self.stfts, self.resamplers):
+            needed = stft.n_fft // 2
+            for upstream in reversed(resamplers):
+                if upstream is not None:
+                    needed = upstream.needed(needed)
+            latency = max(latency, needed)
+            resamplers.append(resampler)
+        return latency
+
+    def push(self, chunk):
+        """
+        channels x CQT_N_BINS x frames dB of the frames chunk completes
+        """
+        y = _as_chunk(chunk, self.num_channels)
+        if self.early_resampler is not None:
+            y = self.early_resampler.push(y)
+        for octave_idx, stft in enumerate(self.stfts):
+            self._respond(octave_idx, stft.push(y))
+            if self.resamplers[octave_idx] is not None:
+                y = self.resamplers[octave_idx].push(y)
+        return self._emit(min(len(x) for x in self.pending))
+
+    def finish(self):
+        """
+        The remaining frames once the stream ends, after which the frame
+        count is the same as log_cqt's
+        """
+        y = np.zeros((self.num_channels, 0), dtype=np.float32)
+        if self.early_resampler is not None:
+            y = self.early_resampler.push(y, last=True)
+        for octave_idx, stft in enumerate(self.stfts):
+            self._respond(octave_idx, stft.push(y))
+            self._respond(octave_idx, stft.finish())
+            if self.resamplers[octave_idx] is not None:
+                y = self.resamplers[octave_idx].push(y, last=True)
+        return self._emit(min(len(x) for x in self.pending))
+
+    def _respond(self, octave_idx: int, stft):
+        fft_basis = self.filter_bank.octaves[octave_idx][0]
+        num_channels, num_freqs, num_frames = stft.shape
+        response = fft_basis.dot(stft.transpose(1, 0, 2).reshape(num_freqs, -1))
+        self.pending[octave_idx].append(
+            response.reshape(fft_basis.shape[0], num_channels, num_frames).transpose(1, 0, 2))
+
+    def _emit(self, num_frames: int):
+        cqt = np.empty((self.num_channels, CQT_N_BINS, num_frames), dtype=np.complex64)
+        end = CQT_N_BINS
+        for pending in self.pending:
+            num_octave_bins = min(end, pending.data.shape[1])
+            cqt[:, end - num_octave_bins:end] = pending.peek(num_frames)[:, -num_octave_bins:]
+            end -= num_octave_bins
+            pending.drop(num_frames)
+        cqt /= np.sqrt(self.filter_bank.lengths)[:, np.newaxis]
+        return _to_db(np.abs(cqt))
+
+
+def check_streaming_log_cqt(audio, sample_rate: int, chunk_samples: int):
+    """
+    Streams channels x samples audio through StreamingLogCQT in chunks of
+    chunk_samples, asserting that frame t has come out once t *
+    CQT_HOP_LENGTH + latency samples are in, and that the clipped frames
+    equal log_cqt_audio. Returns the latency in samples.
+    """
+    audio = np.atleast_2d(audio).astype(np.float32)
+    stream = StreamingLogCQT(sample_rate, num_channels=audio.shape[0])
+    frames = []
+    num_frames = 0
+    for start in range(0, audio.shape[1], chunk_samples):
+        frames.append(stream.push(audio[:, start:start + chunk_samples]))
+        num_frames += frames[-1].shape[-1]
+        pushed = min(start + chunk_samples, audio.shape[1])
+        due = max(0, (pushed - stream.latency) // CQT_HOP_LENGTH + 1)
+        assert num_frames >= due, "{} of {} due frames after {} samples".format(
+            num_frames, due, pushed)
+    frames.append(stream.finish())
+    streamed = top_db_clip(np.concatenate(frames, axis=-1))
+
+    offline = np.stack([log_cqt_audio(channel, sample_rate) for channel in audio])
+    assert streamed.shape == offline.shape, "{} frames, log_cqt has {}".format(
+        streamed.shape, offline.shape)
+    assert np.array_equal(streamed, offline), "{:.6f} dB from log_cqt".format(
+        np.abs(streamed - offline).max())
+    return stream.latency
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="checks StreamingLogCQT latency and equality with log_cqt on a chirp")
+    parser.add_argument("--sample-rate", type=int, default=FEATURE_SAMPLE_RATE)
+    parser.add_argument("--seconds", type=float, default=15.0)
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--chunk-samples", type=int, default=1000)
+    args = parser.parse_args()
+
+    chirp = librosa.chirp(fmin=32.7, fmax=args.sample_rate / 3, sr=args.sample_rate,
+                          duration=args.seconds)
+    audio = np.stack([chirp * 0.5**channel for channel in range(args.channels)])
+    latency = check_streaming_log_cqt(audio, args.sample_rate, args.chunk_samples)
+    print("Latency {} samples ({:.2f} s), frames equal log_cqt".format(
+        latency, latency / args.sample_rate))
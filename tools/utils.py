@@ -1,44 +1,394 @@
 import os
+import hashlib
+import tempfile
+import functools
 
 import cv2
 import librosa
 import numpy as np
+import scipy.sparse
 from scipy.io import wavfile
 
+from d3audiorecon.renderer.audio_cache import AudioCache
 
-def read_file(filename, sample_rate=None, trim=False):
+FEATURE_SAMPLE_RATE = 22500  # Network features are computed at this rate
+
+# log_cqt parameters, the rest are librosa.cqt and librosa.power_to_db defaults
+CQT_HOP_LENGTH = 256
+CQT_N_BINS = 256
+CQT_BINS_PER_OCTAVE = 32
+CQT_FILTER_SCALE = 0.1
+CQT_SPARSITY = 0.01
+CQT_RES_TYPE = "soxr_hq"
+CQT_AMIN = 1e-10
+CQT_TOP_DB = 80.0
+CQT_FILTER_CACHE_DIR = os.path.join(tempfile.gettempdir(), "d3audiorecon_cqt_filters")
+CQT_CHECK_SECONDS = 1.0  # Noise every new filter bank is checked against librosa.cqt on
+CQT_CHECK_TOLERANCE = 1e-3  # dB
+DECIMATION_TOLERANCE = 1e-7  # Relative size of the smallest resampler tap kept
+# log_mel_spec_tfm parameters, fmax is always the Nyquist frequency
+MEL_N_FFT = 512
+MEL_HOP_LENGTH = 16
+MEL_N_MELS = 128  # 128 is better for the direction part
+MEL_FMIN = 20
+
+
+def read_file(filename, sample_rate=None, trim=False, cache: AudioCache = None):
+    """
+    Reads in a wav file and returns it as an np.float32 array in the range [-1,1].
+    With a cache, audio that has to be resampled to sample_rate is stored
+    there, and repeat reads map the cached array instead of resampling.
+    Those arrays are read only.
+    """
+    if cache is not None and _needs_resample(filename, sample_rate):
+        data = cache.cached(filename, ("read_file", sample_rate),
+                            lambda: _read_resampled(filename, sample_rate)[0])
+        file_sr = sample_rate
+    else:
+        data, file_sr = _read_resampled(filename, sample_rate)
+    if trim and len(data) > 1:
+        data = librosa.effects.trim(data, top_db=40)[0]
+    return data, file_sr
+
+
+def read_multi_file(filenames, sample_rate=None, cache: AudioCache = None):
     """
-    Reads in a wav file and returns it as an np.float32 array in the range [-1,1]
+    read_file of equal length mono wav files, e.g. every mic of a scene, as
+    a new channels x samples array. Files missing from the cache are read
+    together by read_multi_frames and resampled in one call, which gives
+    the same rows as resampling each file.
+    """
+    if cache is None or not filenames or not _needs_resample(filenames[0], sample_rate):
+        return resample(*read_multi_frames(filenames), sample_rate)
+
+    resampled = []  # Filled on the first cache miss
+
+    def decode(row):
+        if not resampled:
+            audio, file_sr = read_multi_frames(filenames)
+            resampled.append(resample(audio, file_sr, sample_rate)[0])
+        return resampled[0][row]
+    audio = [cache.cached(filename, ("read_file", sample_rate),
+                          functools.partial(decode, row))
+             for row, filename in enumerate(filenames)]
+    return np.stack(audio), sample_rate
+
+
+def _needs_resample(filename, sample_rate):
+    """
+    Whether reading filename at sample_rate resamples, from its header
+    """
+    return sample_rate is not None and wavfile.read(filename, mmap=True)[0] != sample_rate
+
+
+def _read_resampled(filename, sample_rate=None):
+    data, file_sr = read_frames(filename)
+    return resample(data, file_sr, sample_rate)
+
+
+def read_frames(filename, start=0, stop=None):
     """
-    file_sr, data = wavfile.read(filename)
+    Samples [start, stop) of a wav file as np.float32 in the range [-1,1],
+    through a memory map of its PCM data. float32 files return a copy on
+    write view of the file, int16 files convert only the requested range.
+    Returns data and its sample rate.
+    """
+    file_sr, data = wavfile.read(filename, mmap=True)
+    _check_wav_dtype(data.dtype)
+    data = data[start:stop]
     if data.dtype == np.int16:
         data = np.float32(data) / np.iinfo(np.int16).max
-    elif data.dtype != np.float32:
-        raise OSError('Encounted unexpected dtype: {}'.format(data.dtype))
+    return data, file_sr
+
+
+def read_multi_frames(filenames, start=0, stop=None):
+    """
+    The same samples [start, stop) of several mono wav files, e.g. every
+    mic of a scene, as a channels x samples np.float32 array. Every file
+    is converted straight into its row.
+    """
+    maps = [wavfile.read(filename, mmap=True) for filename in filenames]
+    lengths = set(len(data[start:stop]) for _, data in maps)
+    if len(lengths) > 1 or len(set(file_sr for file_sr, _ in maps)) > 1:
+        raise ValueError("Files differ in sample rate or length of the range")
+
+    audio = np.empty((len(maps), lengths.pop() if lengths else 0), dtype=np.float32)
+    for row, (_, data) in zip(audio, maps):
+        _check_wav_dtype(data.dtype)
+        if data.dtype == np.int16:
+            np.divide(data[start:stop], np.iinfo(np.int16).max, out=row,
+                      dtype=np.float32)
+        else:
+            row[:] = data[start:stop]
+    return audio, maps[0][0] if maps else None
+
+
+def _check_wav_dtype(dtype):
+    if dtype != np.int16 and dtype != np.float32:
+        raise OSError('Encounted unexpected dtype: {}'.format(dtype))
+
+
+def resample(data, file_sr, sample_rate=None):
+    """
+    Resamples audio the same way read_file does. Returns data and its sample rate
+    """
     if sample_rate is not None and sample_rate != file_sr:
-        if len(data) > 0:
-            data = librosa.core.resample(data, file_sr, sample_rate, res_type='kaiser_fast')
+        if data.shape[-1] > 0:
+            data = librosa.core.resample(data, orig_sr=file_sr, target_sr=sample_rate,
+                                         res_type='kaiser_fast')
         file_sr = sample_rate
-    if trim and len(data) > 1:
-        data = librosa.effects.trim(data, top_db=40)[0]
     return data, file_sr
 
 
-def log_cqt(fname, sample_rate=None):
+def log_cqt(fname, sample_rate=None, cache: AudioCache = None):
     """
     Generates a constant Q transform in dB magnitude
     """
-    y, sample_rate = read_file(fname, sample_rate=sample_rate)
-    fmin = None
-    hop_length = 256
-    n_bins = 256
-    bins_per_octave = 32
-    filter_scale = 0.1
+    y, sample_rate = read_file(fname, sample_rate=sample_rate, cache=cache)
+    return log_cqt_audio(y, sample_rate)
 
-    C = np.abs(librosa.cqt(y, sr=sample_rate, hop_length=hop_length, fmin=fmin,
-                           n_bins=n_bins, filter_scale=filter_scale, bins_per_octave=bins_per_octave))
-    C_db = librosa.power_to_db(C)
-    return C_db
+
+def multi_file_log_cqt(fnames, sample_rate=None, cache: AudioCache = None):
+    """
+    log_cqt of equal length files, e.g. every mic of a scene, in one batch
+    """
+    audio, sample_rate = read_multi_file(fnames, sample_rate=sample_rate, cache=cache)
+    return multi_channel_log_cqt(audio, sample_rate)
+
+
+def log_cqt_audio(y, sample_rate):
+    """
+    log_cqt of audio already in memory
+    """
+    return multi_channel_log_cqt(np.asarray(y)[np.newaxis], sample_rate)[0]
+
+
+def cqt_bins():
+    """
+    Center frequency and relative bandwidth of every log_cqt bin, as
+    librosa.cqt derives them
+    """
+    freqs = librosa.cqt_frequencies(n_bins=CQT_N_BINS, fmin=librosa.note_to_hz("C1"),
+                                    bins_per_octave=CQT_BINS_PER_OCTAVE)
+    bins_per_octave = np.empty_like(freqs)
+    log_freqs = np.log2(freqs)
+    bins_per_octave[0] = 1 / (log_freqs[1] - log_freqs[0])
+    bins_per_octave[-1] = 1 / (log_freqs[-1] - log_freqs[-2])
+    bins_per_octave[1:-1] = 2 / (log_freqs[2:] - log_freqs[:-2])
+    alpha = (2.0 ** (2 / bins_per_octave) - 1) / (2.0 ** (2 / bins_per_octave) + 1)
+    return freqs, alpha
+
+
+class CQTFilterBank(object):
+    def __init__(self, downsample_count, hop_length, octaves, lengths):
+        """
+        What librosa.cqt derives from the sample rate alone: how often the
+        input is halved before the first octave, the hop after that, the
+        sparse FFT basis and n_fft of every octave from the top down, and
+        the filter lengths the response is normalized by
+        """
+        self.downsample_count = downsample_count
+        self.hop_length = hop_length
+        self.octaves = octaves  # [(filters x n_fft // 2 + 1 csr, n_fft)]
+        self.lengths = lengths
+
+    @classmethod
+    def build(cls, sample_rate):
+        """
+        Same steps as librosa.cqt with the CQT_* parameters
+        """
+        freqs, alpha = cqt_bins()
+        n_octaves = int(np.ceil(float(CQT_N_BINS) / CQT_BINS_PER_OCTAVE))
+        n_filters = min(CQT_BINS_PER_OCTAVE, CQT_N_BINS)
+        _, filter_cutoff = librosa.filters.wavelet_lengths(
+            freqs=freqs, sr=sample_rate, filter_scale=CQT_FILTER_SCALE, alpha=alpha)
+        if filter_cutoff > sample_rate / 2.0:
+            raise ValueError("CQT filters exceed the Nyquist frequency at {} Hz".format(sample_rate))
+
+        # Early downsampling while the top octave still fits and the hop divides
+        hop_twos = 0
+        while CQT_HOP_LENGTH % 2**(hop_twos + 1) == 0:
+            hop_twos += 1
+        downsample_count = min(
+            max(0, int(np.ceil(np.log2(sample_rate / 2.0 / filter_cutoff)) - 1) - 1),
+            max(0, hop_twos - n_octaves + 1))
+        early_sr = sample_rate / float(2**downsample_count)
+        hop_length = CQT_HOP_LENGTH // 2**downsample_count
+
+        octaves = []
+        curr_sr, curr_hop = early_sr, hop_length
+        fft = librosa.get_fftlib()
+        for octave_idx in range(n_octaves):
+            if octave_idx == 0:
+                sl = slice(-n_filters, None)
+            else:
+                sl = slice(-n_filters * (octave_idx + 1), -n_filters * octave_idx)
+            basis, basis_lengths = librosa.filters.wavelet(
+                freqs=freqs[sl], sr=curr_sr, filter_scale=CQT_FILTER_SCALE,
+                norm=1, pad_fft=True, alpha=alpha[sl])
+            n_fft = basis.shape[1]
+            basis *= basis_lengths[:, np.newaxis] / float(n_fft)
+            fft_basis = fft.fft(basis, n=n_fft, axis=1)[:, :(n_fft // 2) + 1]
+            fft_basis = librosa.util.sparsify_rows(fft_basis, quantile=CQT_SPARSITY,
+                                                   dtype=np.complex64)
+            fft_basis[:] *= np.sqrt(early_sr / curr_sr)
+            octaves.append((fft_basis, n_fft))
+            if curr_hop % 2 == 0:
+                curr_hop //= 2
+                curr_sr /= 2.0
+
+        lengths, _ = librosa.filters.wavelet_lengths(
+            freqs=freqs, sr=early_sr, filter_scale=CQT_FILTER_SCALE, alpha=alpha)
+        filter_bank = cls(downsample_count, hop_length, octaves, lengths)
+        filter_bank.check(sample_rate)
+        return filter_bank
+
+    def check(self, sample_rate):
+        """
+        Raises if log_cqt through this bank differs from librosa.cqt on
+        seeded noise, i.e. the installed librosa derives its CQT
+        differently from build
+        """
+        y = np.random.RandomState(0).randn(int(CQT_CHECK_SECONDS * sample_rate))
+        y = y.astype(np.float32)
+        expected = librosa.power_to_db(np.abs(librosa.cqt(
+            y, sr=sample_rate, hop_length=CQT_HOP_LENGTH, n_bins=CQT_N_BINS,
+            bins_per_octave=CQT_BINS_PER_OCTAVE, filter_scale=CQT_FILTER_SCALE,
+            sparsity=CQT_SPARSITY, res_type=CQT_RES_TYPE)), amin=CQT_AMIN, top_db=CQT_TOP_DB)
+        actual = multi_channel_log_cqt(y[np.newaxis], sample_rate, filter_bank=self)[0]
+        if actual.shape != expected.shape or \
+                not np.allclose(actual, expected, rtol=0.0, atol=CQT_CHECK_TOLERANCE):
+            raise RuntimeError("CQTFilterBank does not match librosa.cqt of librosa {} at {} Hz, "
+                               "update CQTFilterBank.build".format(librosa.__version__, sample_rate))
+
+    def save(self, path):
+        arrays = {"downsample_count": self.downsample_count,
+                  "hop_length": self.hop_length, "lengths": self.lengths}
+        for octave_idx, (fft_basis, n_fft) in enumerate(self.octaves):
+            arrays["data{}".format(octave_idx)] = fft_basis.data
+            arrays["indices{}".format(octave_idx)] = fft_basis.indices
+            arrays["indptr{}".format(octave_idx)] = fft_basis.indptr
+            arrays["n_fft{}".format(octave_idx)] = n_fft
+        # Written atomically, other processes may be loading the same bank
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            octaves = []
+            octave_idx = 0
+            while "n_fft{}".format(octave_idx) in arrays:
+                n_fft = int(arrays["n_fft{}".format(octave_idx)])
+                indptr = arrays["indptr{}".format(octave_idx)]
+                fft_basis = scipy.sparse.csr_matrix(
+                    (arrays["data{}".format(octave_idx)],
+                     arrays["indices{}".format(octave_idx)], indptr),
+                    shape=(len(indptr) - 1, n_fft // 2 + 1))
+                octaves.append((fft_basis, n_fft))
+                octave_idx += 1
+            return cls(int(arrays["downsample_count"]), int(arrays["hop_length"]),
+                       octaves, arrays["lengths"])
+
+
+@functools.lru_cache(maxsize=None)
+def cqt_filter_bank(sample_rate, cache_dir=CQT_FILTER_CACHE_DIR):
+    """
+    CQTFilterBank for sample_rate, built once per process and shared
+    between processes through cache_dir (None to skip the disk cache)
+    """
+    if cache_dir is None:
+        return CQTFilterBank.build(sample_rate)
+    key = repr((librosa.__version__, float(sample_rate), CQT_HOP_LENGTH, CQT_N_BINS,
+                CQT_BINS_PER_OCTAVE, CQT_FILTER_SCALE, CQT_SPARSITY))
+    path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npz")
+    try:
+        return CQTFilterBank.load(path)
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    filter_bank = CQTFilterBank.build(sample_rate)
+    os.makedirs(cache_dir, exist_ok=True)
+    filter_bank.save(path)
+    return filter_bank
+
+
+def multi_channel_log_cqt(audio, sample_rate, filter_bank: CQTFilterBank = None):
+    """
+    log_cqt of every channel of channels x samples float32 audio in one
+    pass: one STFT and one sparse product per octave for all channels,
+    with the filter bank from cqt_filter_bank by default. Returns
+    channels x CQT_N_BINS x frames dB, each channel clipped to CQT_TOP_DB
+    below its own peak as log_cqt does.
+    """
+    if filter_bank is None:
+        filter_bank = cqt_filter_bank(sample_rate)
+    y = np.asarray(audio, dtype=np.float32)
+    if filter_bank.downsample_count > 0:
+        y = librosa.resample(y, orig_sr=2**filter_bank.downsample_count, target_sr=1,
+                             res_type=CQT_RES_TYPE, scale=True)
+
+    responses = []
+    hop_length = filter_bank.hop_length
+    for octave_idx, (fft_basis, n_fft) in enumerate(filter_bank.octaves):
+        stft = librosa.stft(y, n_fft=n_fft, hop_length=hop_length, window="ones",
+                            pad_mode="constant", dtype=np.complex64)
+        num_channels, num_freqs, num_frames = stft.shape
+        # Channels side by side so every octave is a single sparse product
+        response = fft_basis.dot(stft.transpose(1, 0, 2).reshape(num_freqs, -1))
+        responses.append(response.reshape(-1, num_channels, num_frames))
+        if hop_length % 2 == 0 and octave_idx < len(filter_bank.octaves) - 1:
+            hop_length //= 2
+            y = librosa.resample(y, orig_sr=2, target_sr=1, res_type=CQT_RES_TYPE,
+                                 scale=True)
+
+    # Stack the octaves from the bottom up, trimmed to the shortest
+    num_frames = min(x.shape[-1] for x in responses)
+    cqt = np.empty((y.shape[0], CQT_N_BINS, num_frames), dtype=np.complex64)
+    end = CQT_N_BINS
+    for response in responses:
+        num_octave_bins = min(end, response.shape[0])
+        cqt[:, end - num_octave_bins:end] = \
+            response[-num_octave_bins:, :, :num_frames].transpose(1, 0, 2)
+        end -= num_octave_bins
+    cqt /= np.sqrt(filter_bank.lengths)[:, np.newaxis]
+
+    # librosa.power_to_db of the magnitude, per channel
+    C_db = 10.0 * np.log10(np.maximum(CQT_AMIN, np.abs(cqt)))
+    return np.maximum(C_db, C_db.max(axis=(1, 2), keepdims=True) - CQT_TOP_DB)
+
+
+def decimation_kernel(factor: int, size: int = 16384):
+    """
+    Taps of the soxr_hq factor:1 downsampling librosa.cqt uses, read off
+    its impulse responses: output n is sum over m of taps[m] *
+    x[factor * n - m]. Returns the taps and the largest m, taps below
+    DECIMATION_TOLERANCE of the peak are dropped.
+    """
+    responses = {}
+    for phase in range(factor):
+        impulse = np.zeros(size)
+        impulse[size // 2 + phase] = 1.0
+        response = librosa.resample(impulse, orig_sr=factor, target_sr=1,
+                                    res_type=CQT_RES_TYPE, scale=True)
+        for n, value in enumerate(response):
+            responses[factor * n - size // 2 - phase] = value
+    offsets = np.array(sorted(responses))
+    taps = np.array([responses[m] for m in offsets])
+    keep = np.flatnonzero(np.abs(taps) > DECIMATION_TOLERANCE * np.abs(taps).max())
+    return taps[keep[0]:keep[-1] + 1], offsets[keep[-1]]
+
+
+def voice_mask(voice_specgram, bg_specgrams):
+    """
+    Binary mask of the time-frequency bins where the voice is louder than
+    every background. Specgrams are NUM_MICS x Freq x Time dB.
+    """
+    bg_max = np.full_like(voice_specgram, -np.inf)
+    for bg_specgram in bg_specgrams:
+        bg_max = np.maximum(bg_max, bg_specgram)
+    return voice_specgram > bg_max
 
 
 def log_mel_spec_tfm_overlap(fname, sample_rate=None):
@@ -59,7 +409,7 @@ def log_mel_spec_tfm_overlap(fname, sample_rate=None):
     fmin = 20
     fmax = sample_rate / 2
 
-    mel_spec_power = librosa.feature.melspectrogram(x, sr=sample_rate, n_fft=n_fft,
+    mel_spec_power = librosa.feature.melspectrogram(y=x, sr=sample_rate, n_fft=n_fft,
                                                     hop_length=hop_length,
                                                     n_mels=n_mels, power=2.0,
                                                     fmin=fmin, fmax=fmax)
@@ -72,17 +422,17 @@ def log_mel_spec_tfm(fname, sample_rate=None):
     Generates a mel spectrogram with dB magnitude
     """
     x, sample_rate = read_file(fname, sample_rate=sample_rate)
-    
-    n_fft = 512
-    hop_length = 16
-    n_mels = 128  # 128 is better for the direction part
-    fmin = 20
-    fmax = sample_rate / 2 
-    
-    mel_spec_power = librosa.feature.melspectrogram(x, sr=sample_rate, n_fft=n_fft, 
-                                                    hop_length=hop_length, 
-                                                    n_mels=n_mels, power=2.0, 
-                                                    fmin=fmin, fmax=fmax)
+    return log_mel_audio(x, sample_rate)
+
+
+def log_mel_audio(x, sample_rate):
+    """
+    log_mel_spec_tfm of audio already in memory
+    """
+    mel_spec_power = librosa.feature.melspectrogram(y=x, sr=sample_rate, n_fft=MEL_N_FFT,
+                                                    hop_length=MEL_HOP_LENGTH,
+                                                    n_mels=MEL_N_MELS, power=2.0,
+                                                    fmin=MEL_FMIN, fmax=sample_rate / 2)
     mel_spec_db = librosa.power_to_db(mel_spec_power)
     return mel_spec_db
 